@@ -1,6 +1,41 @@
-from gpt.chatgpt import generate_text_from_keywords
-from text_to_music import generate_music_from_text
-from melody_to_music import generate_music_from_melody
+import importlib
+import threading
+
+# The mode modules pull in torch, transformers, diffusers and friends, and gpt.chatgpt pulls in openai.
+# They start loading in the background once a mode is chosen and are only imported where they are called,
+# so no prompt waits for them (see benchmarks/startup.py)
+MODE_MODULES = {'text': 'text_to_music', 'melody': 'melody_to_music'}
+TEXT_MODULE = 'gpt.chatgpt'
+
+_preloading = None  # thread importing the preloaded modules
+_preload_errors = {}  # module -> exception its background import raised
+
+
+def _import_all(modules: tuple[str, ...]) -> None:
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as error:
+            _preload_errors[module] = error
+
+
+def preload(*modules: str) -> None:
+    """
+    Import modules one after another on a background thread, so they load while the user is typing.
+    One thread, as first imports of torch and transformers from several threads at once can fail.
+    """
+    global _preloading
+    _preloading = threading.Thread(target=_import_all, args=(modules,), daemon=True)
+    _preloading.start()
+
+
+def wait_for_preload(module: str) -> None:
+    """Call before importing a preloaded module, raises what its background import raised"""
+    if _preloading is not None:
+        _preloading.join()
+    if module in _preload_errors:
+        raise _preload_errors[module]
+
 
 def get_keywords():
     keywords = input("Please enter keywords separated by spaces: ")
@@ -21,15 +56,20 @@ def choose_mode():
 
 def main():
     mode = choose_mode()
+    preload(TEXT_MODULE, MODE_MODULES[mode])
 
     if mode == 'text':
         # Text-to-Music Mode
         keywords = get_keywords()
+        wait_for_preload(TEXT_MODULE)
+        from gpt.chatgpt import generate_text_from_keywords
         description = generate_text_from_keywords(keywords)
         if not description:
             print("Failed to generate text description. Exiting.")
             return
         print(f"Generated text description: {description}")
+        wait_for_preload('text_to_music')
+        from text_to_music import generate_music_from_text
         generate_music_from_text(description)
     
     elif mode == 'melody':
@@ -37,12 +77,16 @@ def main():
         n_segments = int(input("Enter the number of EEG segments to process: "))
 
         keywords = get_keywords()
+        wait_for_preload(TEXT_MODULE)
+        from gpt.chatgpt import generate_text_from_keywords
         description = generate_text_from_keywords(keywords)
         if not description:
             print("Failed to generate text description. Exiting.")
             return
 
         print(f"Processing {n_segments} segments with description: {description}")
+        wait_for_preload('melody_to_music')
+        from melody_to_music import generate_music_from_melody
         generate_music_from_melody(description, n_segments)
 
 if __name__ == "__main__":
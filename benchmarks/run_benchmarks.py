@@ -0,0 +1,198 @@
+"""
+Stage-level CPU benchmarks of the EEG to music pipeline.
+
+    python -m benchmarks.run_benchmarks                  # run, write results, compare with the baseline
+    python -m benchmarks.run_benchmarks --save-baseline  # run and store the results as the new baseline
+
+Every stage is timed on its own with the same deterministic inputs. Riffusion is replaced by
+StubImg2ImgPipeline, so nothing is downloaded. The sample recording is used when it exists,
+otherwise a synthetic one. Results are written as JSON. A stage whose median time exceeds the
+baseline median by more than the tolerance is flagged as a regression, and the exit code is then 1.
+Baselines depend on the machine, so store one per machine that compares results.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+import numpy as np
+import torch
+
+from benchmarks.stub_diffusion import StubImg2ImgPipeline
+from src.data.audio_buffer import AudioBuffer
+from src.data.audio_effects import postprocess_segment_
+from src.data.audio_writer import StreamingAudioWriter
+from src.data.eeg_cache import open_eeg_recording
+from src.data.eeg_features import extract_all_features
+from src.data.spectral_transform import combine_spectrograms, filter_spectrogram, transform_spectrogram
+from src.data.torch_utils import SpectrogramConverter, get_pipeline_spectrogram_params
+from src.parameters import ChannelParameters
+from src.constants import SAMPLE_EEG_PATH, SAMPLE_RATE, SEGMENT_LEN_S, N_CHANNELS, SPECTROGRAM_SHIFT, \
+    CROSSFADE_SAVE_MS
+
+from typing import Callable
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARK_FOLDER, 'results', 'latest.json')
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARK_FOLDER, 'baseline.json')
+REGRESSION_TOLERANCE = 0.25  # relative slowdown of the median that counts as a regression
+NOISE_FLOOR_S = 1e-3  # slowdowns smaller than this are never flagged
+SEED = 0
+
+
+def make_synthetic_eeg(duration_s: float, n_channels: int = N_CHANNELS, sample_rate: int = SAMPLE_RATE,
+                       seed: int = SEED) -> np.ndarray:
+    """Theta, alpha and beta rhythms over brown noise, (signal, channels) in microvolts"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(round(duration_s * sample_rate)) / sample_rate
+    eeg = np.empty((t.size, n_channels))
+    for ch in range(n_channels):
+        rhythms = sum(amp * np.sin(2 * np.pi * freq * t + rng.uniform(0, 2 * np.pi))
+                      for freq, amp in ((6, 20), (10, 30), (20, 8)))
+        drift = np.cumsum(rng.normal(0, 1, t.size))
+        eeg[:, ch] = rhythms + drift - drift.mean() + rng.normal(0, 5, t.size)
+    return eeg
+
+
+def load_benchmark_eeg(duration_s: float = SEGMENT_LEN_S) -> tuple[np.ndarray, str]:
+    if os.path.exists(SAMPLE_EEG_PATH):
+        data = open_eeg_recording(SAMPLE_EEG_PATH).samples(n_channels=N_CHANNELS)
+        n_samples = round(duration_s * SAMPLE_RATE)
+        if data.shape[0] >= n_samples:
+            return np.array(data[:n_samples], dtype=np.float64), SAMPLE_EEG_PATH
+    print(f'{SAMPLE_EEG_PATH} not found, using a synthetic recording')
+    return make_synthetic_eeg(duration_s), 'synthetic'
+
+
+def time_stage(func: Callable[[], object], repeats: int, warmup: int = 1) -> dict[str, float]:
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {'median_s': float(np.median(times)), 'min_s': float(times.min()),
+            'p90_s': float(np.percentile(times, 90)), 'repeats': repeats}
+
+
+def run_benchmarks(repeats: int = 5, include_sgd: bool = False) -> dict:
+    torch.manual_seed(SEED)
+    eeg, eeg_source = load_benchmark_eeg()
+    params = {i: ChannelParameters() for i in range(N_CHANNELS)}
+    # configured like generate_audio_from_segments: warm started Griffin-Lim with early stopping, after the
+    # warmup call every timed call continues the phase of the one before, as consecutive segments do
+    converter = SpectrogramConverter(get_pipeline_spectrogram_params(), device="cpu")
+
+    # inputs of every stage, computed once outside of the timings
+    spectrograms = extract_all_features((eeg, params))
+    combined = combine_spectrograms(spectrograms)
+    rolled = np.roll(combined, shift=SPECTROGRAM_SHIFT, axis=0)
+    stub = StubImg2ImgPipeline()
+    transformed = transform_spectrogram(combined, riffusion_model=stub, measure_difference=False)
+    mel = torch.from_numpy(transformed).float()
+    linear = converter.linear_from_mel(mel)
+    wave = converter.buffer_from_spectrogram(transformed).samples
+    segments = [AudioBuffer(wave) for _ in range(20)]
+
+    def concatenate():
+        writer = StreamingAudioWriter(crossfade_ms=CROSSFADE_SAVE_MS)
+        for segment in segments:
+            writer.write(segment)
+        return writer.close()
+
+    stages = {
+        'extract_features': lambda: extract_all_features((eeg, params)),
+        'combine_spectrograms': lambda: combine_spectrograms(spectrograms),
+        'filter_spectrogram': lambda: filter_spectrogram(rolled),
+        'diffusion_stub': lambda: transform_spectrogram(combined, riffusion_model=stub, measure_difference=False),
+        'inverse_mel_pinv': lambda: converter.linear_from_mel(mel, backend="pinv"),
+        'griffin_lim': lambda: converter.waveform_from_amplitudes(linear, use_mel=False),
+        'post_processing': lambda: postprocess_segment_(wave.copy()),
+        'concatenation_20_segments': concatenate,
+    }
+    if include_sgd:
+        stages['inverse_mel_sgd'] = lambda: converter.linear_from_mel(mel, backend="sgd")
+
+    results = {}
+    for name, func in stages.items():
+        results[name] = time_stage(func, repeats=1 if name == 'inverse_mel_sgd' else repeats)
+        print(f"{name:<28} median {results[name]['median_s'] * 1000:9.2f} ms")
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+        },
+        'eeg_source': eeg_source,
+        'results': results,
+    }
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list[str]:
+    """Names of the stages whose median got slower than the baseline allows"""
+    if baseline.get('machine') != report['machine']:
+        print('WARNING: the baseline was recorded on a different machine or software versions')
+    regressions = []
+    for name, result in report['results'].items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None:
+            print(f'{name:<28} no baseline')
+            continue
+        ratio = result['median_s'] / reference['median_s']
+        slower = result['median_s'] - reference['median_s']
+        flagged = ratio > 1 + tolerance and slower > NOISE_FLOOR_S
+        print(f"{name:<28} {ratio:6.2f}x baseline{'  REGRESSION' if flagged else ''}")
+        if flagged:
+            regressions.append(name)
+    return regressions
+
+
+def write_json(data: dict, path: str) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--include-sgd', action='store_true', help='also time the slow SGD inverse mel backend')
+    args = parser.parse_args()
+
+    report = run_benchmarks(repeats=args.repeats, include_sgd=args.include_sgd)
+    write_json(report, args.output)
+    print(f'Results written to {args.output}')
+    if args.save_baseline:
+        write_json(report, args.baseline)
+        print(f'Baseline written to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create one')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(report, baseline, tolerance=args.tolerance)
+    report['regressions'] = regressions
+    write_json(report, args.output)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""
+Startup time of the interactive CLI.
+
+    python -m benchmarks.startup            # report, fails if a heavy library is imported before the first prompt
+    python -m benchmarks.startup --top 30   # list more of the slowest imports
+
+`import app` runs in fresh interpreters with `python -X importtime`, and the slowest imports are listed by
+cumulative time. Then app.py itself is started and the time until its first prompt appears is measured,
+followed by the time from choosing a mode until the next prompt appears.
+Heavy libraries must only load once a mode needs them, and in the background while the later prompts are
+answered: the exit code is 1 if any of HEAVY_MODULES is imported by `import app`, or if either prompt takes
+longer than the budget.
+"""
+import argparse
+import json
+import os
+import re
+import select
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+
+from typing import Optional
+
+BENCHMARK_FOLDER = os.path.dirname(os.path.abspath(__file__))
+REPO_FOLDER = os.path.dirname(BENCHMARK_FOLDER)
+DEFAULT_RESULTS_PATH = os.path.join(BENCHMARK_FOLDER, 'results', 'startup.json')
+HEAVY_MODULES = ('torch', 'torchaudio', 'transformers', 'diffusers', 'pydub', 'librosa', 'skimage', 'scipy',
+                 'openai', 'demucs', 'pywt')
+FIRST_PROMPT = 'Choose mode'
+FIRST_PROMPT_BUDGET_S = 1.  # generous, an interpreter alone starts in a few tens of milliseconds
+MODE_ANSWER = 'text'
+SECOND_PROMPT = 'Please enter keywords'
+SECOND_PROMPT_BUDGET_S = 1.  # the mode libraries load behind this prompt, it must not wait for them
+_IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+@dataclass
+class ImportRecord:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int  # nesting level, 0 for modules imported by the measured statement itself
+
+
+def parse_importtime(stderr: str) -> list[ImportRecord]:
+    records = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            records.append(ImportRecord(module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return records
+
+
+def measure_imports(statement: str = 'import app') -> tuple[float, list[ImportRecord]]:
+    """Wall time of running the statement in a fresh interpreter, and the imports it triggered"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=REPO_FOLDER,
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'`{statement}` failed:\n{result.stderr[-2000:]}')
+    return elapsed, parse_importtime(result.stderr)
+
+
+def measure_prompt_times(script: str = 'app.py', prompts: tuple[str, ...] = (FIRST_PROMPT, SECOND_PROMPT),
+                         answers: tuple[str, ...] = (MODE_ANSWER,), timeout_s: float = 60.) -> list[Optional[float]]:
+    """
+    Seconds until every prompt is printed, the first one counted from starting the script and every later one
+    from answering the prompt before it with `answers`. None for the prompts that never show up
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-u', script], cwd=REPO_FOLDER, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    times = []
+    output = b''
+    try:
+        for i, prompt in enumerate(prompts):
+            while prompt.encode() not in output:
+                remaining = timeout_s - (time.perf_counter() - start)
+                if remaining <= 0 or not select.select([process.stdout], [], [], remaining)[0]:
+                    return times + [None] * (len(prompts) - i)
+                chunk = os.read(process.stdout.fileno(), 4096)
+                if not chunk:
+                    return times + [None] * (len(prompts) - i)
+                output += chunk
+            times.append(time.perf_counter() - start)
+            if i < len(answers):
+                output = b''
+                start = time.perf_counter()
+                process.stdin.write(answers[i].encode() + b'\n')
+                process.stdin.flush()
+        return times
+    finally:
+        process.kill()
+        process.wait()
+
+
+def run_startup_benchmark(repeats: int = 3, top: int = 15) -> dict:
+    baseline_s, _ = min((measure_imports('pass') for _ in range(repeats)), key=lambda r: r[0])
+    runs = [measure_imports('import app') for _ in range(repeats)]
+    import_s, records = min(runs, key=lambda r: r[0])
+    prompt_times = [measure_prompt_times() for _ in range(repeats)]
+    prompt_s, second_prompt_s = (min((t for t in times if t is not None), default=None)
+                                 for times in zip(*prompt_times))
+
+    imported = {r.module.split('.')[0] for r in records}
+    heavy = sorted(imported.intersection(HEAVY_MODULES))
+    slowest = sorted(records, key=lambda r: r.cumulative_us, reverse=True)[:top]
+
+    print(f"{'interpreter start':<40} {baseline_s * 1000:9.1f} ms")
+    print(f"{'import app':<40} {import_s * 1000:9.1f} ms")
+    print(f"{'first prompt of app.py':<40} " + (f'{prompt_s * 1000:9.1f} ms' if prompt_s is not None
+                                                  else 'never appeared'))
+    print(f"{'prompt after choosing a mode':<40} " + (f'{second_prompt_s * 1000:9.1f} ms'
+                                                        if second_prompt_s is not None else 'never appeared'))
+    print(f'Slowest imports by cumulative time:')
+    for r in slowest:
+        print(f"  {r.module:<38} {r.cumulative_us / 1000:9.1f} ms (self {r.self_us / 1000:.1f} ms)")
+    if heavy:
+        print(f"Heavy modules imported at startup: {', '.join(heavy)}")
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'interpreter_start_s': baseline_s,
+        'import_app_s': import_s,
+        'first_prompt_s': prompt_s,
+        'second_prompt_s': second_prompt_s,
+        'heavy_modules': heavy,
+        'slowest_imports': [asdict(r) for r in slowest],
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    parser.add_argument('--budget', type=float, default=FIRST_PROMPT_BUDGET_S,
+                        help='seconds the first prompt may take')
+    parser.add_argument('--second-budget', type=float, default=SECOND_PROMPT_BUDGET_S,
+                        help='seconds the prompt after choosing a mode may take')
+    parser.add_argument('--output', default=DEFAULT_RESULTS_PATH)
+    args = parser.parse_args()
+
+    report = run_startup_benchmark(repeats=args.repeats, top=args.top)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
+    too_slow = False
+    for name, key, budget in (('first prompt', 'first_prompt_s', args.budget),
+                              ('prompt after choosing a mode', 'second_prompt_s', args.second_budget)):
+        if report[key] is None or report[key] > budget:
+            print(f'The {name} took longer than the {budget:.2f} s budget')
+            too_slow = True
+    return 1 if report['heavy_modules'] or too_slow else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
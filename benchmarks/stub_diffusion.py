@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from PIL import Image, ImageFilter
+
+from typing import Any, Optional, Union
+
+
+class StubImg2ImgOutput:
+    def __init__(self, images: list[Image.Image]):
+        self.images = images
+
+
+class StubImg2ImgPipeline:
+    """
+    Deterministic stand-in for StableDiffusionImg2ImgPipeline with the interface run_img2img and
+    run_img2img_batch use. Every image is blurred and mixed with seeded noise, the amount depending on
+    strength, and every denoising step costs one small convolution, so timings still scale with the settings.
+    Nothing is downloaded and the output only depends on the inputs and the generator seeds.
+    """
+
+    def __init__(self, embedding_shape: tuple[int, int] = (77, 768)):
+        self.embedding_shape = embedding_shape
+        self.device = torch.device('cpu')
+
+    def encode_prompt(self, prompt: str, device: Any, num_images_per_prompt: int, do_classifier_free_guidance: bool,
+                      negative_prompt: Optional[str] = None) -> tuple[torch.Tensor, torch.Tensor]:
+        def embed(text: Optional[str]) -> torch.Tensor:
+            seed = sum(map(ord, text or ''))
+            generator = torch.Generator().manual_seed(seed)
+            return torch.randn((num_images_per_prompt, *self.embedding_shape), generator=generator)
+        return embed(prompt), embed(negative_prompt)
+
+    def __call__(self, prompt_embeds: torch.Tensor, image: Union[Image.Image, list[Image.Image]], strength: float,
+                 num_inference_steps: int, guidance_scale: float, negative_prompt_embeds: torch.Tensor,
+                 num_images_per_prompt: int = 1, generator: Any = None, **kwargs: Any) -> StubImg2ImgOutput:
+        images = image if isinstance(image, list) else [image]
+        generators = generator if isinstance(generator, list) else [generator] * len(images)
+        n_steps = max(int(num_inference_steps * strength), 1)
+        outputs = []
+        for img, gen in zip(images, generators):
+            seed = int(gen.initial_seed()) if gen is not None else 0
+            noise = np.random.default_rng(seed).normal(0, 255 * strength * 0.1, (img.height, img.width, 3))
+            result = img
+            for _ in range(n_steps):
+                result = result.filter(ImageFilter.GaussianBlur(radius=1))
+            mixed = np.asarray(result, dtype=np.float32) * (1 - 0.2 * strength) + noise
+            outputs.append(Image.fromarray(mixed.clip(0, 255).astype(np.uint8)))
+        return StubImg2ImgOutput(outputs)
@@ -1,18 +1,29 @@
 import time
-from pydub import AudioSegment
+from itertools import islice
 import torch
-from src.data.eeg_features import extract_features
-from src.data.spectral_transform import combine_spectrograms, transform_spectrogram
-from src.data.utils import save_pydub_audio_file, produce_audio_from_spectrogram_with_torch, apply_audio_filters
-from src.data.torch_utils import SpectrogramConverter
-from src.data.riffusion import load_stable_diffusion_img2img_pipeline
-from src.data.sample_gen import get_offline_eeg_segments
+from src.data.eeg_features import extract_all_features, make_streaming_filters
+from src.data.spectral_transform import combine_spectrograms, transform_spectrogram, transform_spectrograms
+from src.data.audio_effects import postprocess_segment_
+from src.data.audio_buffer import AudioBuffer
+from src.data.audio_writer import StreamingAudioWriter
+from src.data.live import DeadlineScheduler, LiveEegStream, PlaybackQueue, open_live_source
+from src.data.quality import AdaptiveQualityController
+from src.data.metrics import MetricsRecorder, record_stage, record_iter
+from src.data.torch_utils import SpectrogramConverter, get_pipeline_spectrogram_params
+from src.data.riffusion import load_stable_diffusion_img2img_pipeline, describe_img2img_pipeline_settings, \
+    estimate_img2img_pipeline_bytes, choose_img2img_batch_size
+from src.data.sample_gen import iter_offline_eeg_segments
+from src.data.pipeline import Stage, StageFailure, StagePipeline
+from src.data.process_pool import ProcessStages
+from src.data.model_registry import MODEL_REGISTRY
+from src.data.diffusion_cache import DiffusionCache
 from src.parameters import ChannelParameters
-from src.constants import N_CHANNELS
+from src.constants import N_CHANNELS, LIVE_DEADLINE_S, SEGMENT_LEN_S, METRICS_JSONL_PATH, METRICS_PROMETHEUS_PATH
 
-from pydub import AudioSegment
+import numpy as np
 import time
 import os
+from typing import Callable, Iterable, Optional
 
 # 常量配置
 AUDIO_SAMPLE_RATE = 44100
@@ -24,87 +35,275 @@ CROSSFADE_SAVE_MS = 500
 ANTISPIKE_THRESHOLD = 20e6
 DEFAULT_SAVE_AUDIO_FOLDER = 'uncombined'
 
-def generate_audio_from_segments(n_segments: int):
+def generate_audio_from_segments(n_segments: Optional[int], eeg_segments: Optional[Iterable[np.ndarray]] = None,
+                                 filter_mode: str = 'zero_phase', queue_size: int = 2,
+                                 diffusion_batch_size: Optional[int] = None, use_diffusion_cache: bool = True,
+                                 warm_start_griffin_lim: bool = True, output_path: Optional[str] = None,
+                                 crossfade_ms: float = 0, scheduler: Optional[DeadlineScheduler] = None,
+                                 playback: Optional[PlaybackQueue] = None,
+                                 quality: Optional[AdaptiveQualityController] = None,
+                                 metrics: Optional[MetricsRecorder] = None, n_workers: int = 0):
     """
     Generate audio by processing EEG segments into spectrograms, transforming them,
     and combining the resulting audio segments.
 
     Parameters:
-        n_segments (int): Number of EEG segments to process.
+        n_segments (int, optional): Number of EEG segments to process, None runs until the source is exhausted.
+        eeg_segments (Iterable[np.ndarray], optional): Segments of shape (samples, channels), e.g. the lazy
+            iter_offline_eeg_segments() reader. Only the first n_segments are consumed.
+            Defaults to streaming the sample recording.
+        filter_mode (str): 'zero_phase' filters every segment on its own (offline),
+            'causal' carries the band-pass filter state from one segment to the next,
+            which requires consecutive, non-overlapping segments.
+        queue_size (int): Capacity of the queues between pipeline stages.
+        diffusion_batch_size (int, optional): Number of spectrograms sent through Riffusion per call.
+            None picks the largest batch that fits into the free memory of the device
+            once the Riffusion weights are loaded.
+        use_diffusion_cache (bool): Reuse Riffusion outputs stored on disk by earlier runs.
+            The model is only loaded once a segment misses the cache.
+        warm_start_griffin_lim (bool): Seed Griffin-Lim with the phase the previous segment ended with
+            and stop iterating once spectral convergence stalls, instead of a fixed number of iterations
+            from random phase.
+        output_path (str, optional): Stream the combined audio into this WAV file as segments arrive,
+            memory then stays constant however many segments are processed.
+        crossfade_ms (float): Crossfade between consecutive segments, 0 simply concatenates them.
+        scheduler (DeadlineScheduler, optional): Deadlines of live windows, every finished segment is checked
+            against it and latency is reported at the end.
+        playback (PlaybackQueue, optional): Finished segments are handed to it for playback as they arrive.
+        quality (AdaptiveQualityController, optional): Watches the stage latencies and lowers diffusion steps
+            and strength and Griffin-Lim iterations, or bypasses diffusion when the pipeline
+            falls behind the segment cadence. Without it the full quality constants are used.
+        metrics (MetricsRecorder, optional): Records wall time, CPU time and memory of every stage of every
+            segment (read, filter, cwt, combine, diffusion, inverse_mel, griffin_lim, post_processing, export)
+            and writes its JSON lines and Prometheus files. Closed when the run ends, also when it fails.
+            Recording does not change how stages overlap, memory peaks are process-wide and shared with the
+            stages running at the same time.
+            Stages run in worker processes are only recorded as a whole.
+        n_workers (int): Run feature extraction, spectrogram filtering and the vocoder in this many worker
+            processes, several segments at a time, while diffusion stays in this process. 0 runs every stage
+            on a thread of this process. Needs filter_mode 'zero_phase', and Griffin-Lim is not warm started,
+            since workers process segments independently. Results still come out in segment order.
 
     Returns:
-        AudioSegment: Combined audio segment generated from EEG data.
+        AudioBuffer: Combined audio generated from EEG data, use to_pydub() or write_wav() to leave the pipeline.
+            None when the audio was streamed into output_path.
     """
     # Initialize components and parameters
-    converter = SpectrogramConverter()
-    riffusion_model = load_stable_diffusion_img2img_pipeline(device='mps' if torch.backends.mps.is_available() else "cuda" )
-    eeg_segments = get_offline_eeg_segments()
+    # worker processes vocode segments independently, so only the early stop of warm start applies to them
+    converter = SpectrogramConverter(get_pipeline_spectrogram_params(warm_start_griffin_lim,
+                                                                     carry_phase=n_workers == 0))
+    device = 'mps' if torch.backends.mps.is_available() else "cuda"
+    riffusion_model = MODEL_REGISTRY.lazy(f'riffusion@{device}',
+                                          lambda: load_stable_diffusion_img2img_pipeline(device=device),
+                                          info=describe_img2img_pipeline_settings(device=device),
+                                          size_bytes=estimate_img2img_pipeline_bytes(device))
+    diffusion_cache = DiffusionCache() if use_diffusion_cache else None
+    if diffusion_batch_size is None:
+        # sized before the pipeline loads, queue sizes and worker blocks depend on it: the weights are
+        # reserved unless they are resident already, e.g. from an earlier call in this process
+        diffusion_batch_size = choose_img2img_batch_size(
+            device, reserved_bytes=0 if riffusion_model.loaded else riffusion_model.size_bytes)
+        print(f"Using Riffusion batches of {diffusion_batch_size} segments")
+    if eeg_segments is None:
+        eeg_segments = iter_offline_eeg_segments()
     parameters = {i: ChannelParameters() for i in range(N_CHANNELS)}
-
-    # Debugging: Print the number of samples in EEG segments
-    print(f"Number of samples in segment 0: {len(eeg_segments[0])}")
-    print(f"Number of samples in segment 1: {len(eeg_segments[1])}")
-
-    # Initialize an empty AudioSegment to concatenate results
-    combined_audio = AudioSegment.empty()
+    if filter_mode not in ('zero_phase', 'causal'):
+        raise ValueError('filter_mode can only be "zero_phase" or "causal"')
+    filters = make_streaming_filters(parameters) if filter_mode == 'causal' else None
+    if n_workers > 0 and filter_mode != 'zero_phase':
+        raise ValueError('filter_mode can only be "zero_phase" when n_workers > 0')
+    queue_size = max(queue_size, diffusion_batch_size)
+    workers = ProcessStages(n_workers, parameters, converter.p, queue_size=queue_size,
+                            batch_size=diffusion_batch_size) if n_workers > 0 else None
 
     # Ensure the output folder exists
     os.makedirs(DEFAULT_SAVE_AUDIO_FOLDER, exist_ok=True)
+    started = {}
+
+    def features_stage(i: int, segment: np.ndarray) -> np.ndarray:
+        started[i] = time.time()
+        if i == 0:
+            # Debugging: Print the number of samples in EEG segments
+            print(f"Number of samples per segment: {len(segment)}")
+        if workers is not None:
+            # Steps 1-2 and the filtering before diffusion in a worker process
+            return workers.submit_features(segment)
+
+        # Step 1: Extract spectrograms for all channels at once -> (channels, freqs, time)
+        spectrograms = extract_all_features((segment, parameters), filters=filters)
 
-    # Process each EEG segment
-    for i, segment in enumerate(eeg_segments[:n_segments]):
-        start = time.time()
+        # Step 2: Combine spectrograms from all channels
+        with record_stage('combine'):
+            return combine_spectrograms(spectrograms)
 
-        try:
-            # Step 1: Extract spectrograms for each channel
-            spectrograms = []
-            for ch in range(N_CHANNELS):
-                spectrogram = extract_features(segment, ch=ch, channel_params=parameters[ch])
-                spectrograms.append(spectrogram)
+    def diffusion_settings() -> dict:
+        if quality is None:
+            return dict(riffusion_model=riffusion_model)
+        level = quality.level
+        return dict(riffusion_model=riffusion_model if level.use_diffusion else None,
+                    strength=level.denoising_strength, steps=level.inference_steps)
 
-            # Step 2: Combine spectrograms from all channels
-            combined_spectrogram = combine_spectrograms(spectrograms)
+    def diffusion_inputs(payload) -> tuple[np.ndarray, Optional[np.ndarray]]:
+        # workers hand over the combined spectrogram together with its filtered version
+        return workers.take_spectrograms(payload) if workers is not None else (payload, None)
 
-            # Step 3: Transform the spectrogram using the Riffusion model
-            transformed_spectrogram = transform_spectrogram(
+    def diffusion_stage(i: int, payload) -> np.ndarray:
+        # Step 3: Transform the spectrogram using the Riffusion model
+        combined_spectrogram, prepared = diffusion_inputs(payload)
+        with record_stage('diffusion'):
+            return transform_spectrogram(
                 combined_spectrogram,
-                riffusion_model=riffusion_model,
-                measure_difference=True
+                measure_difference=True,
+                diffusion_cache=diffusion_cache,
+                prepared=prepared,
+                **diffusion_settings()
             )
 
-            # Step 4: Generate audio from the spectrogram
-            audio = produce_audio_from_spectrogram_with_torch(transformed_spectrogram, converter)
+    def batched_diffusion_stage(indices: list[int], payloads: list) -> list[np.ndarray]:
+        # Step 3: Transform several spectrograms in a single Riffusion call
+        combined_spectrograms, prepared = zip(*map(diffusion_inputs, payloads))
+        with record_stage('diffusion'):
+            return transform_spectrograms(
+                list(combined_spectrograms),
+                measure_difference=True,
+                diffusion_cache=diffusion_cache,
+                prepared=None if workers is None else list(prepared),
+                **diffusion_settings()
+            )
+
+    def process_audio_stage(i: int, transformed_spectrogram: np.ndarray):
+        # Steps 4-7 in a worker process, the wave comes back through shared memory in the export stage
+        num_griffin_lim_iters = quality.level.num_griffin_lim_iters if quality is not None else None
+        return workers.submit_vocoder(i, transformed_spectrogram, num_griffin_lim_iters, target_db=DESIRED_DB,
+                                      fade_ms=CROSSFADE_SAVE_MS)
 
-            # Step 5: Apply audio filters
-            audio = apply_audio_filters(audio)
+    def audio_stage(i: int, transformed_spectrogram: np.ndarray) -> AudioBuffer:
+        # Step 4: Generate audio from the spectrogram
+        if quality is not None:
+            converter.set_iterations(quality.level.num_griffin_lim_iters)
+        audio = converter.buffer_from_spectrogram(transformed_spectrogram)
+        if converter.last_griffin_lim_iters is not None:
+            print(f"Griffin-Lim for segment {i + 1}: {converter.last_griffin_lim_iters} iterations, "
+                  f"spectral convergence {converter.last_spectral_convergence:.4f}")
 
-            # Step 6: Normalize volume to desired dB level
-            audio = audio.apply_gain(DESIRED_DB - audio.dBFS)
+        # Steps 5-7: Normalize, bring the volume to DESIRED_DB, fade and limit spikes, in place on the samples
+        with record_stage('post_processing'):
+            spiked = postprocess_segment_(audio.samples, audio.sample_rate, target_db=DESIRED_DB,
+                                          fade_ms=CROSSFADE_SAVE_MS)
+        if spiked:
+            print(f"Spike detected in segment {i + 1}, applying crossfade.")
+        return audio
 
-            # Step 7: Check for spikes and apply crossfade if necessary
-            if max(audio.get_array_of_samples()) > ANTISPIKE_THRESHOLD:
+    def export_stage(i: int, audio) -> AudioBuffer:
+        if workers is not None:
+            result, audio = audio, workers.take_audio(audio)
+            if result.griffin_lim_iters is not None:
+                print(f"Griffin-Lim for segment {i + 1}: {result.griffin_lim_iters} iterations, "
+                      f"spectral convergence {result.spectral_convergence:.4f}")
+            if result.spiked:
                 print(f"Spike detected in segment {i + 1}, applying crossfade.")
-                audio = audio.fade_in(CROSSFADE_SAVE_MS).fade_out(CROSSFADE_SAVE_MS)
 
-            # Step 8: Save individual audio segment
-            segment_path = os.path.join(DEFAULT_SAVE_AUDIO_FOLDER, f"segment_{i + 1}.wav")
-            audio.export(segment_path, format="wav")
-            print(f"Segment {i + 1} saved to {segment_path}")
+        # Step 8: Save individual audio segment
+        segment_path = os.path.join(DEFAULT_SAVE_AUDIO_FOLDER, f"segment_{i + 1}.wav")
+        with record_stage('export'):
+            audio.write_wav(segment_path)
+        print(f"Segment {i + 1} saved to {segment_path}")
+        return audio
+
+    # Each stage runs on its own thread, so the CPU stages of neighbouring segments overlap with diffusion.
+    # With workers, the CPU stages keep up to max_in_flight segments busy in the process pool
+    max_in_flight = workers.max_in_flight if workers is not None else 0
+    pipeline = StagePipeline([
+        Stage('features', features_stage, max_in_flight=max_in_flight),
+        Stage('diffusion', diffusion_stage) if diffusion_batch_size == 1
+        else Stage('diffusion', batched_diffusion_stage, batch_size=diffusion_batch_size),
+        Stage('audio', process_audio_stage, max_in_flight=max_in_flight) if workers is not None
+        else Stage('audio', audio_stage),
+        Stage('export', export_stage),
+    ], queue_size=queue_size, observer=quality.observe if quality is not None else None)
+
+    # Segments are assembled in linear time, either in memory or straight into output_path
+    writer = StreamingAudioWriter(output_path, sample_rate=converter.p.sample_rate, crossfade_ms=crossfade_ms)
+    pipeline_start = time.time()
+    n_processed = 0
+
+    # Process each EEG segment, results arrive in segment order
+    if metrics is not None:
+        metrics.activate()
+        eeg_segments = record_iter(eeg_segments, 'read')
+    results = pipeline.run(islice(eeg_segments, n_segments))
+    try:
+        for i, result in results:
+            if isinstance(result, StageFailure):
+                # Catch any errors and print debug information
+                print(f"Error processing segment {i + 1} in stage '{result.stage}': {result.error}")
+                continue
+
+            missed_deadline = scheduler is not None and scheduler.finish(i).missed
+            if quality is not None:
+                quality.update(i, missed_deadline=missed_deadline)
+            if playback is not None:
+                playback.put(i, result)
 
             # Step 9: Concatenate the processed audio
-            combined_audio += audio
+            writer.write(result)
 
             end = time.time()
-            print(f'Processed segment {i + 1} in {end - start:.2f} s')
+            print(f'Processed segment {i + 1} in {end - started.pop(i, end):.2f} s')
+            n_processed += 1
+    finally:
+        # stop the stage threads before the worker processes and their shared memory go away
+        results.close()
+        if workers is not None:
+            workers.close()
+        # a WAV header is only complete once closed, so a failed run still leaves a playable file
+        audio = writer.close()
+        if metrics is not None:
+            metrics.close()
+
+    elapsed = time.time() - pipeline_start
+    if n_processed > 0:
+        print(f'Throughput: {n_processed / elapsed:.3f} segments/s ({n_processed} segments in {elapsed:.2f} s)')
+    if diffusion_cache is not None:
+        print(f'Diffusion cache | {diffusion_cache.stats()}')
+    if scheduler is not None:
+        print(f'Live timing | {scheduler.report()}')
+    if quality is not None:
+        print(f'Quality changes: {len(quality.changes)}, final level: {quality.level.name}')
+    if metrics is not None:
+        for stage, summary in metrics.summary().items():
+            print(f"Stage {stage} | n={summary['count']}, wall p50={summary['wall_s_p50']:.3f} s, "
+                  f"p99={summary['wall_s_p99']:.3f} s, cpu p50={summary['cpu_s_p50']:.3f} s")
 
-        except Exception as e:
-            # Catch any errors and print debug information
-            print(f"Error processing segment {i + 1}: {e}")
+    # Return the combined audio
+    return audio
+
+def generate_live_audio(source: str, n_segments: Optional[int] = None, output_path: Optional[str] = None,
+                        deadline_s: float = LIVE_DEADLINE_S, player: Optional[Callable[[AudioBuffer], None]] = None,
+                        adaptive_quality: bool = True, **kwargs) -> Optional[AudioBuffer]:
+    """
+    Live mode: read EEG from source as it arrives ('tcp://host:port', 'pipe://path' or a CSV replayed
+    at wall-clock rate), process every window on a deadline and play the audio as soon as it is ready.
+    With adaptive_quality, quality is traded for speed whenever the pipeline cannot keep up.
+    Further keyword arguments are passed to generate_audio_from_segments.
+    """
+    scheduler = DeadlineScheduler(deadline_s)
+    playback = PlaybackQueue(player, scheduler=scheduler)
+    stream = LiveEegStream(open_live_source(source, n_channels=N_CHANNELS), scheduler)
+    # windows arrive one at a time, so waiting for a diffusion batch would only add latency
+    kwargs.setdefault('diffusion_batch_size', 1)
+    if adaptive_quality:
+        kwargs.setdefault('quality', AdaptiveQualityController(budget_s=SEGMENT_LEN_S))
+    try:
+        return generate_audio_from_segments(n_segments, eeg_segments=stream, filter_mode='causal',
+                                            output_path=output_path, scheduler=scheduler, playback=playback,
+                                            **kwargs)
+    finally:
+        playback.close()
+        print(f'Playback underruns: {playback.underruns}')
 
-    # Return the combined audio segment
-    return combined_audio
 
 if __name__ == "__main__":
     n_segments = 8  # Specify the number of segments you want to process
-    combined_audio = generate_audio_from_segments(n_segments) 
-    save_pydub_audio_file(combined_audio, './gen_musci_new.wav')
\ No newline at end of file
+    generate_audio_from_segments(n_segments, output_path='./gen_musci_new.wav',
+                                 metrics=MetricsRecorder(METRICS_JSONL_PATH, METRICS_PROMETHEUS_PATH))
\ No newline at end of file
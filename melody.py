@@ -1,74 +1,98 @@
-from demucs import pretrained
-from demucs.apply import apply_model
-from demucs.audio import convert_audio
+import argparse
 import torch
 import torchaudio
-from transformers import AutoProcessor, MusicgenMelodyForConditionalGeneration
-
-
-# 检查是否支持 MPS
-device = torch.device("mps") if torch.has_mps else torch.device("cpu")
-print(f"Using device: {device}")
+from melody_to_music import load_musicgen_melody
+from src.data.stem_separation import StemCache, remix
+from src.constants import DEMUCS_MODEL, DEMUCS_MAX_BYTES
 
 # 替换以下路径为你的 .wav 文件路径
-wav_file_path = "/Users/chenyanting/Desktop/test/pure/gen_musci.wav"
-
-# 加载自己的 .wav 音频
-waveform, sample_rate = torchaudio.load(wav_file_path)
-
-# 将音频数据转换为 Tensor 并进行标准化
-wav = waveform.mean(dim=0)  # 如果是多通道音频，取平均转为单通道
-wav = wav.to(torch.float32).to(device)  # 将音频加载到 MPS 设备
-
-# 加载 Demucs 模型
-demucs = pretrained.get_model('htdemucs').to(device)  # 将模型加载到 MPS 设备
-
-# 将音频转换为 Demucs 模型所需的采样率和通道数
-wav = convert_audio(wav[None], sample_rate, demucs.samplerate, demucs.audio_channels).to(device)
-
-# 使用 Demucs 分离音频
-demucs_result = apply_model(demucs, wav[None])
-
-# 打印结果的形状
-print(f"Demucs result shape: {demucs_result.shape}")
-
-# 合成所有音轨并转换为单通道
-combined_music = demucs_result.sum(dim=1).squeeze(0)  # 合并 4 个音轨 -> [channels, samples]
-combined_music = combined_music.mean(dim=0, keepdim=True).to("cpu")  # 转换为单通道 -> [1, num_samples]
-
-# 打印最终形状，确保符合 [1, num_samples]
-print(f"Combined music shape for MusicGen: {combined_music.shape}")
-
-# ==========================
-# MusicGen 模型部分
-# ==========================
-
-# 加载 MusicGen 模型和处理器
-processor = AutoProcessor.from_pretrained("facebook/musicgen-melody")
-model = MusicgenMelodyForConditionalGeneration.from_pretrained("facebook/musicgen-melody").to(device)
-
-# 准备输入
-inputs = processor(
-    audio=combined_music,
-    sampling_rate=demucs.samplerate,
-    text=["An ethereal, dynamic soundscape designed to enhance the brain's activity during the REM sleep stage. The music incorporates gentle, oscillating frequencies in the theta range (4–8 Hz), with light, airy melodies that evoke a dreamlike quality. Layered textures of soft chimes, subtle arpeggios, and flowing pads create a sense of fluid motion, mirroring the vividness and creativity of REM sleep. Gradual tonal shifts and delicate rhythms enhance the immersive experience without disrupting the sleep cycle, fostering an environment of relaxation and imaginative dreaming. Ideal for facilitating lucid dreams and mental rejuvenation."],  # 自定义描述
-    padding=True,
-    return_tensors="pt",
-)
-
-# 强制切换到 CPU 执行生成
-inputs = {k: v.to("cpu") for k, v in inputs.items()}
-model = model.to("cpu")
-
-# 生成新音乐
-generated_audio = model.generate(
-    **inputs,
-    do_sample=True,
-    guidance_scale=3.0,  # 控制生成的灵活性
-    max_new_tokens=768   # 控制生成长度
-)
-
-# 保存生成的音乐
-generated_audio_path = "./generated_music.wav"
-torchaudio.save(generated_audio_path, generated_audio.squeeze(0).to("cpu"), demucs.samplerate)
-print(f"Generated music saved to: {generated_audio_path}")
+WAV_FILE_PATH = "/Users/chenyanting/Desktop/test/pure/gen_musci.wav"
+DESCRIPTION = "An ethereal, dynamic soundscape designed to enhance the brain's activity during the REM sleep stage. The music incorporates gentle, oscillating frequencies in the theta range (4–8 Hz), with light, airy melodies that evoke a dreamlike quality. Layered textures of soft chimes, subtle arpeggios, and flowing pads create a sense of fluid motion, mirroring the vividness and creativity of REM sleep. Gradual tonal shifts and delicate rhythms enhance the immersive experience without disrupting the sleep cycle, fostering an environment of relaxation and imaginative dreaming. Ideal for facilitating lucid dreams and mental rejuvenation."
+
+
+def melody_from_file(wav_file_path, sources=None, device=None, model_name=DEMUCS_MODEL,
+                     max_bytes=DEMUCS_MAX_BYTES, use_stem_cache=True):
+    """
+    Load a .wav file and keep the chosen Demucs stems of it as a mono melody for MusicGen.
+
+    Args:
+        wav_file_path (str): The audio file.
+        sources (list[str], optional): Stems to keep, e.g. ["vocals", "other"]. None keeps all of them,
+            their sum is the file itself, so Demucs is not run at all.
+        device (torch.device, optional): The device Demucs runs on.
+        model_name (str): The pretrained Demucs model.
+        max_bytes (float): Memory ceiling of the separation, longer files are separated in overlapping chunks.
+        use_stem_cache (bool): Reuse stems separated by earlier runs from the same audio and model.
+
+    Returns:
+        tuple[torch.Tensor, int]: The melody, [1, num_samples], and its sample rate.
+    """
+    # 加载自己的 .wav 音频
+    waveform, sample_rate = torchaudio.load(wav_file_path)
+
+    # 将音频数据转换为 Tensor 并进行标准化
+    wav = waveform.mean(dim=0).to(torch.float32)  # 如果是多通道音频，取平均转为单通道
+
+    # 使用 Demucs 分离音频并合成所选音轨（分离结果按音频哈希和模型名缓存）
+    stem_cache = StemCache() if use_stem_cache else None
+    combined_music, sample_rate = remix(wav, sample_rate, sources, model_name=model_name, device=device,
+                                        max_bytes=max_bytes, cache=stem_cache)
+    if stem_cache is not None:
+        print(f"Stem cache | {stem_cache.stats()}")
+
+    # 转换为单通道
+    combined_music = combined_music.reshape(-1, combined_music.shape[-1]).mean(dim=0, keepdim=True)  # -> [1, num_samples]
+
+    # 打印最终形状，确保符合 [1, num_samples]
+    print(f"Combined music shape for MusicGen: {combined_music.shape}")
+    return combined_music, sample_rate
+
+
+def generate_music(melody, sample_rate, description=DESCRIPTION, generated_audio_path="./generated_music.wav"):
+    """Generate music conditioned on a melody, [1, num_samples], and a text description and save it"""
+    # ==========================
+    # MusicGen 模型部分
+    # ==========================
+
+    # 加载 MusicGen 模型和处理器，强制切换到 CPU 执行生成
+    processor, model = load_musicgen_melody(torch.device("cpu"))
+
+    # 准备输入
+    inputs = processor(
+        audio=melody,
+        sampling_rate=sample_rate,
+        text=[description],  # 自定义描述
+        padding=True,
+        return_tensors="pt",
+    )
+
+    # 生成新音乐
+    generated_audio = model.generate(
+        **inputs,
+        do_sample=True,
+        guidance_scale=3.0,  # 控制生成的灵活性
+        max_new_tokens=768   # 控制生成长度
+    )
+
+    # 保存生成的音乐
+    torchaudio.save(generated_audio_path, generated_audio.squeeze(0).to("cpu"), model.config.audio_encoder.sampling_rate)
+    print(f"Generated music saved to: {generated_audio_path}")
+    return generated_audio_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate music from the melody of a .wav file")
+    parser.add_argument("wav_file_path", nargs="?", default=WAV_FILE_PATH)
+    parser.add_argument("--stems", nargs="+", default=None,
+                        help="Demucs stems to keep, e.g. vocals other; all of them skip the separation")
+    parser.add_argument("--max-bytes", type=float, default=DEMUCS_MAX_BYTES, help="memory ceiling of the separation")
+    parser.add_argument("--no-stem-cache", action="store_true")
+    args = parser.parse_args()
+
+    # 检查是否支持 MPS
+    device = torch.device("mps") if torch.backends.mps.is_available() else torch.device("cpu")
+    print(f"Using device: {device}")
+
+    melody, sample_rate = melody_from_file(args.wav_file_path, args.stems, device=device, max_bytes=args.max_bytes,
+                                           use_stem_cache=not args.no_stem_cache)
+    generate_music(melody, sample_rate)
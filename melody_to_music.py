@@ -2,9 +2,30 @@ import torch
 import torchaudio
 from transformers import AutoProcessor, MusicgenMelodyForConditionalGeneration
 from eeg_to_music import generate_audio_from_segments
+from src.data.model_registry import get_model
+from src.data.musicgen import MusicgenStreamer, prepare_variations, variation_path, as_description_list
+from src.data.audio_writer import StreamingAudioWriter
 import os
 
-def generate_music_from_melody(description, n_segments=5):
+
+def load_musicgen_melody(device):
+    """Processor and model for MusicGen melody, loaded once per process and device"""
+    def loader():
+        processor = AutoProcessor.from_pretrained("facebook/musicgen-melody")
+        model = MusicgenMelodyForConditionalGeneration.from_pretrained("facebook/musicgen-melody").to(device)
+        return processor, model
+    return get_model(f"musicgen-melody@{device}", loader)
+
+
+def generate_music_from_melody(description, n_segments=5, stream=False, playback=None, n_variations=1):
+    """
+    Generate music conditioned on the melody of n_segments EEG segments and text descriptions.
+    All descriptions run through MusicGen as one padded batch with n_variations clips each; the melody
+    conditioning is computed once and the text encoded once per description.
+    Clips are saved under names derived from description and variation, their paths are returned.
+    With stream, audio is decoded in chunks while tokens are generated and appended to the output files,
+    time to first audio is reported. A PlaybackQueue also plays the chunks of the first clip and implies stream.
+    """
     # ==========================
     # Audio Generation from EEG Segments
     # ==========================
@@ -13,53 +34,70 @@ def generate_music_from_melody(description, n_segments=5):
     print(f"Using device: {device}")
 
     # 从 EEG 数据生成音频
-    combined_audio_segment = generate_audio_from_segments(n_segments)
-
-    # 保存生成的音频用于后续调试
-    temp_audio_path = "./temp_generated_audio.wav"
-    combined_audio_segment.export(temp_audio_path, format="wav")
-    print(f"Intermediate audio saved to: {temp_audio_path}")
+    combined_audio = generate_audio_from_segments(n_segments)
+    sample_rate = combined_audio.sample_rate
 
-    # 加载生成的音频
-    waveform, sample_rate = torchaudio.load(temp_audio_path)
-
-    # 将音频数据转换为 Tensor
-    wav = waveform.mean(dim=0)  # 如果是多通道音频，转为单通道
-    wav = wav.to(torch.float32).to(device)  # 加载到指定设备
+    # 直接使用内存中的音频数据，无需写入临时文件再读取
+    wav = combined_audio.mono().to_tensor(device)[0]  # 转为单通道并加载到指定设备
 
     # ==========================
     # MusicGen Part
     # ==========================
 
-    # 加载 MusicGen 模型和处理器
-    processor = AutoProcessor.from_pretrained("facebook/musicgen-melody")
-    model = MusicgenMelodyForConditionalGeneration.from_pretrained("facebook/musicgen-melody").to(device)
+    # 加载 MusicGen 模型和处理器（同一进程内复用）
+    processor, model = load_musicgen_melody(device)
 
     # 准备输入
+    descriptions = as_description_list(description)
     inputs = processor(
         audio=wav.unsqueeze(0),  # 增加批次维度 -> [1, num_samples]
         sampling_rate=sample_rate,
-        text=[description],
+        text=descriptions,
         padding=True,
         return_tensors="pt",
     )
+    # 旋律特征只计算一次，所有描述共用
+    inputs["input_features"] = inputs["input_features"].expand(len(descriptions), -1, -1)
 
     inputs = {k: v.to(device) for k, v in inputs.items()}
+    inputs = prepare_variations(inputs, n_variations, guidance_scale=5.0)  # 控制生成的灵活性
+
+    # check if output directory exists
+    os.makedirs('output', exist_ok=True)
+    output_rate = model.config.audio_encoder.sampling_rate
+    generated_audio_paths = [variation_path('./output', 'melody', d, v)
+                             for d in descriptions for v in range(n_variations)]
+
+    streamer = None
+    if stream or playback is not None:
+        # 边生成边解码，音频块实时写入文件（并播放）
+        writers = [StreamingAudioWriter(path, sample_rate=output_rate) for path in generated_audio_paths]
+
+        def on_audio(chunks):
+            for writer, chunk in zip(writers, chunks):
+                writer.write(chunk)
+            if playback is not None:
+                playback.put(streamer.n_chunks - 1, chunks[0])
+        streamer = MusicgenStreamer(model, on_audio)
 
     # 生成新音乐
     generated_audio = model.generate(
         **inputs,
         do_sample=True,
-        guidance_scale=5.0,  # 控制生成的灵活性
-        max_new_tokens=768   # 控制生成长度
+        max_new_tokens=768,  # 控制生成长度
+        streamer=streamer
     )
-
-    # check if output directory exists
-    os.makedirs('output', exist_ok=True)
-    # 保存生成的音乐
-    generated_audio_path = "./output/final_melody.wav"
-    torchaudio.save(generated_audio_path, generated_audio.squeeze(0).to("cpu"), sample_rate)
-    print(f"Generated music saved to: {generated_audio_path}")
+    if streamer is not None:
+        for writer in writers:
+            writer.close()
+        print(f"Streaming | {streamer.report()}")
+    else:
+        # 保存生成的音乐
+        for path, audio in zip(generated_audio_paths, generated_audio):
+            torchaudio.save(path, audio.to("cpu"), output_rate)
+    for path in generated_audio_paths:
+        print(f"Generated music saved to: {path}")
+    return generated_audio_paths
 
 if __name__ == "__main__":
     description = "An ethereal, dynamic soundscape designed to enhance the brain's activity during the REM sleep stage. The music incorporates gentle, oscillating frequencies in the theta range (4 to 8 Hz), with light, airy melodies that evoke a dreamlike quality. Layered textures of soft chimes, subtle arpeggios, and flowing pads create a sense of fluid motion, mirroring the vividness and creativity of REM sleep. Gradual tonal shifts and delicate rhythms enhance the immersive experience without disrupting the sleep cycle, fostering an environment of relaxation and imaginative dreaming. Ideal for facilitating lucid dreams and mental rejuvenation."
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.signal import butter
 
 
 N_CHANNELS = 2
@@ -13,7 +12,13 @@ SAMPLE_RATE = 256
 SEGMENT_LEN_S = 5 
 CHANNEL_IDS = (0, 1, 2, 3)
 SAMPLE_EEG_PATH = "./samples/eeg_samples/2min_16hz.csv"
-BANDPASS_FILTER = butter(4, (MIN_EEG_FREQUENCY, MAX_EEG_FREQUENCY), 'bp', output='sos', fs=SAMPLE_RATE)
+EEG_READ_CHUNK_S = 20  # seconds of EEG parsed per read when streaming a recording
+EEG_CACHE_SUFFIX = '.f32.bin'  # binary memory-mapped copy stored next to the source CSV
+CWT_BACKEND = 'fft'  # 'fft' uses the cached wavelet bank, 'pywt' calls pywt.cwt directly
+WAVELET_BANK_CACHE_SIZE = 8
+LIVE_CHUNK_S = 0.1  # granularity at which live sources deliver samples
+LIVE_DEADLINE_S = SEGMENT_LEN_S  # audio of a window is due this long after its last sample arrived
+# BANDPASS_FILTER is designed on first access, see __getattr__ at the end
 
 # Spectrogram constants -------
 SPECTROGRAM_WIDTH = 512
@@ -22,7 +27,7 @@ SPECTROGRAM_SHIFT = 30  # shift frequencies to higher notes
 SPECTROGRAM_POWER = 4  # for converting it to audio
 SPECTROGRAM_MAX_VALUE = 30e6
 MEL_NOTES = [51, 66, 76, 91]
-NOTE_MASK = np.load('./samples/c2_to_c6_mask.npy')
+NOTE_MASK_PATH = './samples/c2_to_c6_mask.npy'  # NOTE_MASK is loaded from it on first access
 
 # Model constants -------------
 RIFFUSION_CHECKPOINT = "riffusion/riffusion-model-v1"
@@ -40,13 +45,61 @@ DENOISING_STRENGTH = 0.65
 GUIDANCE_SCALE = 7.0
 INFERENCE_STEPS = 15
 SEED = 42
+RIFFUSION_MAX_BATCH = 8  # upper bound for images per img2img call
+RIFFUSION_BYTES_PER_IMAGE = 1.5e9  # rough activation memory of one 512x512 image with classifier-free guidance
+RIFFUSION_MEMORY_FRACTION = 0.7  # share of the free memory batches are allowed to use
+RIFFUSION_MODEL_PARAMS = 1.37e9  # UNet, text encoder, VAE and safety checker of Stable Diffusion 1.5
+DIFFUSION_CACHE_FOLDER = './cache/diffusion'
+DIFFUSION_CACHE_MAX_BYTES = 2e9
+MODEL_RAM_BUDGET_BYTES = 16e9  # models are evicted least-recently-used beyond this estimated size
+MUSICGEN_PLAY_STEPS = 50  # codec frames per streamed chunk, MusicGen's codec runs at 50 frames per second
+MUSICGEN_CONTEXT_STEPS = 25  # frames decoded again before every chunk to warm up the codec decoder
+MUSICGEN_LOOKAHEAD_STEPS = 5  # frames held back until the next chunk, the decoder convolutions look ahead
+QUALITY_HIGH_WATER = 0.9  # step quality down once the slowest stage needs this share of the segment length
+QUALITY_LOW_WATER = 0.5  # step it back up while the slowest stage stays below this share
+QUALITY_WINDOW = 3  # segments averaged before deciding, also the wait after every change
+METRICS_HISTORY = 10000  # values per stage kept for percentiles
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+METRICS_RSS_INTERVAL_S = 0.02  # sampling period of memory and library thread CPU while stages are measured
+METRICS_JSONL_PATH = './output/metrics.jsonl'
+METRICS_PROMETHEUS_PATH = './output/metrics.prom'
 
 # Audio constants -------------
 AUDIO_SAMPLE_RATE = 44100
 MIN_AUDIO_FREQUENCY = 0
 MAX_AUDIO_FREQUENCY = 10000
 PLAYBACK_SLEEP_TIME_S = 4.98
+PLAYBACK_QUEUE_SIZE = 4
 DESIRED_DB = -20
 CROSSFADE_SAVE_MS = 500
 ANTISPIKE_THRESHOLD = 20e6
+ANTISPIKE_PEAK = 1.  # float full scale, after the gain to DESIRED_DB louder peaks would clip on export
+NORMALIZE_HEADROOM_DB = 0.1
 DEFAULT_SAVE_AUDIO_FOLDER = 'uncombined'
+DEMUCS_MODEL = 'htdemucs'
+DEMUCS_MAX_BYTES = 2e9  # memory ceiling of a separation, the model weights not included
+DEMUCS_SEGMENT_BYTES = 0.9e9  # activations of one Demucs segment, needed whatever the chunk length
+DEMUCS_BYTES_PER_SAMPLE = 64  # per input sample of a chunk: stems, overlap-add weights and shifted copies
+DEMUCS_OVERLAP_S = 2.  # crossfade between neighbouring chunks
+STEM_CACHE_FOLDER = './cache/stems'
+STEM_CACHE_MAX_BYTES = 4e9
+
+
+# Lazy constants --------------
+# Built on first access and then stored like any other constant, so importing this module stays cheap
+def _design_bandpass_filter() -> np.ndarray:
+    from scipy.signal import butter
+    return butter(4, (MIN_EEG_FREQUENCY, MAX_EEG_FREQUENCY), 'bp', output='sos', fs=SAMPLE_RATE)
+
+
+_LAZY_CONSTANTS = {
+    'BANDPASS_FILTER': _design_bandpass_filter,
+    'NOTE_MASK': lambda: np.load(NOTE_MASK_PATH),
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_CONSTANTS:
+        value = globals()[name] = _LAZY_CONSTANTS[name]()
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,13 +4,17 @@ from PIL import Image
 from diffusers import StableDiffusionImg2ImgPipeline
 
 from src.data.utils import normalize_spectrogram_for_image
-from src.data.riffusion import run_img2img
-from src.constants import TEXT_PROMPT, TEXT_NEGATIVE_PROMPT, DENOISING_STRENGTH, GUIDANCE_SCALE, INFERENCE_STEPS
+from src.data.riffusion import run_img2img, run_img2img_batch, describe_img2img_pipeline
+from src.data.diffusion_cache import DiffusionCache
+from src.data.model_registry import LazyModel, resolve_model, get_model
+from src.constants import TEXT_PROMPT, TEXT_NEGATIVE_PROMPT, DENOISING_STRENGTH, GUIDANCE_SCALE, INFERENCE_STEPS, SEED
+
+from typing import Optional, Union
 
 
 def load_rave_model(model_name: str):
     torch.set_grad_enabled(False)
-    model = torch.jit.load(f"../../models/{model_name}.ts").eval()
+    model = get_model(f'rave:{model_name}', lambda: torch.jit.load(f"../../models/{model_name}.ts").eval())
     return model
 
 
@@ -23,17 +27,98 @@ def run_rave(wave: np.ndarray, rave_model) -> np.ndarray:
     return y
 
 
-def run_riffusion(spectrogram: np.ndarray, riffusion_model: StableDiffusionImg2ImgPipeline) -> np.ndarray:
+def spectrogram_to_riffusion_image(spectrogram: np.ndarray) -> Image.Image:
     prepare_img = 255 - normalize_spectrogram_for_image(np.flipud(spectrogram))
-    img = Image.fromarray(prepare_img).convert('RGB')
+    return Image.fromarray(prepare_img).convert('RGB')
+
+
+def riffusion_image_to_spectrogram(res: Image.Image) -> np.ndarray:
+    res_numpy = np.flipud(np.array(res.convert('L')))
+    return (np.median(res_numpy) - res_numpy).clip(min=0)
+
+
+def get_riffusion_model_info(riffusion_model: Union[StableDiffusionImg2ImgPipeline, LazyModel]) -> dict[str, str]:
+    """
+    Checkpoint, scheduler, dtype and device of the model, read from the pipeline once it is loaded.
+    A LazyModel that is not loaded yet is described by its info instead, if it has one.
+    """
+    if isinstance(riffusion_model, LazyModel) and not riffusion_model.loaded and riffusion_model.info is not None:
+        return riffusion_model.info
+    return describe_img2img_pipeline(resolve_model(riffusion_model))
+
+
+def get_riffusion_cache_key(img: Image.Image, model_info: dict[str, str],
+                            prompt: str = TEXT_PROMPT, negative_prompt: str = TEXT_NEGATIVE_PROMPT,
+                            strength: float = DENOISING_STRENGTH, steps: int = INFERENCE_STEPS) -> str:
+    return DiffusionCache.make_key(
+        img, prompt=prompt, negative_prompt=negative_prompt, strength=strength,
+        steps=steps, guidance=GUIDANCE_SCALE, seed=SEED, **model_info
+    )
+
+
+def run_riffusion(spectrogram: np.ndarray, riffusion_model: Union[StableDiffusionImg2ImgPipeline, LazyModel],
+                  cache: Optional[DiffusionCache] = None, prompt: str = TEXT_PROMPT,
+                  negative_prompt: str = TEXT_NEGATIVE_PROMPT, strength: float = DENOISING_STRENGTH,
+                  steps: int = INFERENCE_STEPS) -> np.ndarray:
+    """
+    Pass the spectrogram through Riffusion img2img.
+    With a cache, results are looked up first, keyed by the model as get_riffusion_model_info describes it.
+    A LazyModel with info is not loaded when the result is cached.
+    """
+    img = spectrogram_to_riffusion_image(spectrogram)
+    key = None
+    if cache is not None:
+        key = get_riffusion_cache_key(img, get_riffusion_model_info(riffusion_model),
+                                      prompt=prompt, negative_prompt=negative_prompt,
+                                      strength=strength, steps=steps)
+        res = cache.get(key)
+        if res is not None:
+            return riffusion_image_to_spectrogram(res)
+
     res = run_img2img(
-        pipeline=riffusion_model,
-        prompt=TEXT_PROMPT,
+        pipeline=resolve_model(riffusion_model),
+        prompt=prompt,
         init_image=img,
-        denoising_strength=DENOISING_STRENGTH,
-        num_inference_steps=INFERENCE_STEPS,
+        denoising_strength=strength,
+        num_inference_steps=steps,
         guidance_scale=GUIDANCE_SCALE,
-        negative_prompt=TEXT_NEGATIVE_PROMPT
+        negative_prompt=negative_prompt
     )
-    res_numpy = np.flipud(np.array(res.convert('L')))
-    return (np.median(res_numpy) - res_numpy).clip(min=0)
+    if cache is not None:
+        cache.put(key, res)
+    return riffusion_image_to_spectrogram(res)
+
+
+def run_riffusion_batch(spectrograms: list[np.ndarray],
+                        riffusion_model: Union[StableDiffusionImg2ImgPipeline, LazyModel],
+                        cache: Optional[DiffusionCache] = None, prompt: str = TEXT_PROMPT,
+                        negative_prompt: str = TEXT_NEGATIVE_PROMPT, strength: float = DENOISING_STRENGTH,
+                        steps: int = INFERENCE_STEPS) -> list[np.ndarray]:
+    """run_riffusion for several spectrograms in a single img2img call, only cache misses are rendered"""
+    images = [spectrogram_to_riffusion_image(s) for s in spectrograms]
+    results = [None] * len(images)
+    keys = [None] * len(images)
+    if cache is not None:
+        model_info = get_riffusion_model_info(riffusion_model)
+        for i, img in enumerate(images):
+            keys[i] = get_riffusion_cache_key(img, model_info,
+                                              prompt=prompt, negative_prompt=negative_prompt,
+                                              strength=strength, steps=steps)
+            results[i] = cache.get(keys[i])
+
+    missing = [i for i, res in enumerate(results) if res is None]
+    if missing:
+        rendered = run_img2img_batch(
+            pipeline=resolve_model(riffusion_model),
+            prompt=prompt,
+            init_images=[images[i] for i in missing],
+            denoising_strength=strength,
+            num_inference_steps=steps,
+            guidance_scale=GUIDANCE_SCALE,
+            negative_prompt=negative_prompt
+        )
+        for i, res in zip(missing, rendered):
+            results[i] = res
+            if cache is not None:
+                cache.put(keys[i], res)
+    return [riffusion_image_to_spectrogram(res) for res in results]
@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+import numpy as np
+import torch
+from pydub import AudioSegment
+from scipy.io import wavfile
+
+from src.constants import AUDIO_SAMPLE_RATE
+
+from typing import Iterable, Union
+
+
+@dataclass
+class AudioBuffer:
+    """
+    Float32 audio of shape (channels, samples) in [-1, 1] together with its sample rate.
+    Passed between pipeline stages as is, converted to pydub or WAV only when the audio leaves the program.
+    Conversions from and to NumPy arrays and CPU tensors share memory whenever the dtype allows it.
+    """
+    samples: np.ndarray
+    sample_rate: int = AUDIO_SAMPLE_RATE
+
+    def __post_init__(self):
+        samples = np.asarray(self.samples, dtype=np.float32)
+        if samples.ndim == 1:
+            samples = samples[np.newaxis]
+        assert samples.ndim == 2, "samples must be of shape (samples,) or (channels, samples)"
+        self.samples = samples
+
+    @classmethod
+    def from_wave(cls, wave: np.ndarray, sample_rate: int = AUDIO_SAMPLE_RATE, normalize: bool = True) -> 'AudioBuffer':
+        """Wave of arbitrary scale, normalize=True scales its peak to full scale like produce_audio_from_wave"""
+        wave = np.asarray(wave, dtype=np.float32)
+        if normalize:
+            peak = np.max(np.abs(wave))
+            if peak > 0:
+                wave = wave / peak
+        return cls(wave, sample_rate)
+
+    @classmethod
+    def from_tensor(cls, waveform: torch.Tensor, sample_rate: int = AUDIO_SAMPLE_RATE) -> 'AudioBuffer':
+        return cls(waveform.detach().to('cpu', torch.float32).numpy(), sample_rate)
+
+    @classmethod
+    def from_pydub(cls, audio: AudioSegment) -> 'AudioBuffer':
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
+        samples = samples.reshape(-1, audio.channels).T / float(1 << (8 * audio.sample_width - 1))
+        return cls(samples, int(audio.frame_rate))
+
+    @classmethod
+    def read_wav(cls, filepath: str) -> 'AudioBuffer':
+        sample_rate, data = wavfile.read(filepath, mmap=True)
+        samples = data.T
+        if data.dtype == np.uint8:  # 8-bit WAV is unsigned
+            samples = (samples.astype(np.float32) - 128) / 128
+        elif np.issubdtype(data.dtype, np.integer):
+            samples = samples / np.float32(-np.iinfo(data.dtype).min)
+        return cls(samples, sample_rate)
+
+    @classmethod
+    def concatenate(cls, buffers: Iterable['AudioBuffer']) -> 'AudioBuffer':
+        buffers = list(buffers)
+        assert len(buffers) > 0, "nothing to concatenate"
+        assert len({b.sample_rate for b in buffers}) == 1, "all buffers must share the sample rate"
+        return cls(np.concatenate([b.samples for b in buffers], axis=1), buffers[0].sample_rate)
+
+    @property
+    def n_channels(self) -> int:
+        return self.samples.shape[0]
+
+    @property
+    def n_samples(self) -> int:
+        return self.samples.shape[1]
+
+    @property
+    def duration_s(self) -> float:
+        return self.n_samples / self.sample_rate
+
+    def mono(self) -> 'AudioBuffer':
+        if self.n_channels == 1:
+            return self
+        return AudioBuffer(self.samples.mean(axis=0), self.sample_rate)
+
+    def to_tensor(self, device: Union[str, torch.device] = 'cpu') -> torch.Tensor:
+        """(channels, samples) tensor, shares memory with the buffer on the CPU"""
+        return torch.from_numpy(self.samples).to(device)
+
+    def to_int16(self) -> np.ndarray:
+        """Interleaved (samples, channels) PCM"""
+        return (np.clip(self.samples.T, -1, 1) * np.iinfo(np.int16).max).astype(np.int16)
+
+    def to_pydub(self) -> AudioSegment:
+        return AudioSegment(data=self.to_int16().tobytes(), sample_width=2, frame_rate=self.sample_rate,
+                            channels=self.n_channels)
+
+    def write_wav(self, filepath: str) -> None:
+        pcm = self.to_int16()
+        wavfile.write(filepath, rate=self.sample_rate, data=pcm[:, 0] if self.n_channels == 1 else pcm)
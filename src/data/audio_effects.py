@@ -0,0 +1,112 @@
+"""
+Vectorized float32 counterparts of the pydub effects applied to every segment.
+Functions ending in an underscore modify the (..., samples) array in place, full scale is 1.
+"""
+import numpy as np
+
+from src.constants import AUDIO_SAMPLE_RATE, DESIRED_DB, CROSSFADE_SAVE_MS, ANTISPIKE_PEAK, NORMALIZE_HEADROOM_DB
+
+
+def dbfs(samples: np.ndarray) -> float:
+    """Loudness of the RMS level relative to full scale, -inf for silence"""
+    rms = np.sqrt(np.mean(np.square(samples, dtype=np.float64)))
+    return 20 * np.log10(rms) if rms > 0 else -np.inf
+
+
+def peak(samples: np.ndarray) -> float:
+    return float(np.max(np.abs(samples))) if samples.size else 0.
+
+
+def apply_gain_(samples: np.ndarray, gain_db: float) -> np.ndarray:
+    samples *= np.float32(10 ** (gain_db / 20))
+    return samples
+
+
+def gain_to_dbfs_(samples: np.ndarray, target_db: float = DESIRED_DB) -> np.ndarray:
+    level = dbfs(samples)
+    if np.isfinite(level):
+        apply_gain_(samples, target_db - level)
+    return samples
+
+
+def normalize_(samples: np.ndarray, headroom: float = NORMALIZE_HEADROOM_DB) -> np.ndarray:
+    """Scale the peak to `headroom` dB below full scale, like pydub.effects.normalize"""
+    current = peak(samples)
+    if current > 0:
+        samples *= np.float32(10 ** (-headroom / 20) / current)
+    return samples
+
+
+def has_spike(samples: np.ndarray, threshold: float = ANTISPIKE_PEAK) -> bool:
+    return peak(samples) > threshold
+
+
+def limit_spikes_(samples: np.ndarray, threshold: float = ANTISPIKE_PEAK) -> np.ndarray:
+    np.clip(samples, -threshold, threshold, out=samples)
+    return samples
+
+
+def fade_in_(samples: np.ndarray, duration_ms: float, sample_rate: int = AUDIO_SAMPLE_RATE) -> np.ndarray:
+    """Linear amplitude ramp from silence, as pydub fade_in"""
+    n = min(int(sample_rate * duration_ms / 1000), samples.shape[-1])
+    samples[..., :n] *= np.linspace(0, 1, n, endpoint=False, dtype=np.float32)
+    return samples
+
+
+def fade_out_(samples: np.ndarray, duration_ms: float, sample_rate: int = AUDIO_SAMPLE_RATE) -> np.ndarray:
+    n = min(int(sample_rate * duration_ms / 1000), samples.shape[-1])
+    if n > 0:
+        samples[..., -n:] *= np.linspace(1, 0, n, endpoint=False, dtype=np.float32)
+    return samples
+
+
+def postprocess_segment_(samples: np.ndarray, sample_rate: int = AUDIO_SAMPLE_RATE, target_db: float = DESIRED_DB,
+                         headroom: float = NORMALIZE_HEADROOM_DB, spike_threshold: float = ANTISPIKE_PEAK,
+                         fade_ms: float = CROSSFADE_SAVE_MS) -> bool:
+    """
+    Same chain as apply_audio_filters followed by the gain to DESIRED_DB and the spike check in eeg_to_music:
+    normalize with headroom, bring the RMS to target_db and, if a peak exceeds spike_threshold,
+    fade in and out and clip what is left of the spike. Returns whether a spike was found.
+    """
+    # the first gain of apply_audio_filters is undone by normalize, so it is skipped
+    normalize_(samples, headroom)
+    gain_to_dbfs_(samples, target_db)
+    if not has_spike(samples, spike_threshold):
+        return False
+    fade_in_(samples, fade_ms, sample_rate)
+    fade_out_(samples, fade_ms, sample_rate)
+    limit_spikes_(samples, spike_threshold)
+    return True
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from src.data.audio_buffer import AudioBuffer
+    from src.data.utils import apply_audio_filters
+
+    def pydub_chain(buffer: AudioBuffer) -> bool:
+        audio = apply_audio_filters(buffer.to_pydub())
+        audio = audio.apply_gain(DESIRED_DB - audio.dBFS)
+        # int16 samples saturate during apply_gain, so this check can never fire
+        spiked = max(audio.get_array_of_samples()) > np.iinfo(np.int16).max * ANTISPIKE_PEAK
+        if spiked:
+            audio = audio.fade_in(CROSSFADE_SAVE_MS).fade_out(CROSSFADE_SAVE_MS)
+        AudioBuffer.from_pydub(audio)
+        return spiked
+
+    rng = np.random.default_rng(0)
+    wave = rng.standard_normal(5 * AUDIO_SAMPLE_RATE).astype(np.float32)
+    wave[rng.integers(0, wave.size, 5)] *= 30  # a few spikes
+    for name, func in (('pydub', lambda: pydub_chain(AudioBuffer.from_wave(wave))),
+                       ('numpy', lambda: postprocess_segment_(AudioBuffer.from_wave(wave).samples))):
+        start = perf_counter()
+        for _ in range(20):
+            spiked = func()
+        print(f'{name}: {(perf_counter() - start) / 20 * 1000:.2f} ms per segment, spike detected: {spiked}')
+
+    reference = apply_audio_filters(AudioBuffer.from_wave(wave).to_pydub())
+    reference = AudioBuffer.from_pydub(reference.apply_gain(DESIRED_DB - reference.dBFS))
+    samples = AudioBuffer.from_wave(wave).samples
+    normalize_(samples)
+    gain_to_dbfs_(samples, DESIRED_DB)
+    print(f'dBFS after the chain | pydub {dbfs(reference.samples):.3f}, numpy {dbfs(samples):.3f}')
@@ -0,0 +1,110 @@
+import wave
+import numpy as np
+
+from src.data.audio_buffer import AudioBuffer
+from src.constants import AUDIO_SAMPLE_RATE
+
+from typing import Optional
+
+
+class StreamingAudioWriter:
+    """
+    Assembles consecutive segments into one recording in linear time.
+    Only the last crossfade_ms of the latest segment is held back, everything before it is written straight
+    to a 16-bit WAV file at `path`, so memory stays constant however long the session runs.
+    Without a path the finished pieces are kept and concatenated once by close().
+    The crossfade matches pydub's append: linear fade out of the tail overlaid with a linear fade in of the head.
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: int = AUDIO_SAMPLE_RATE, n_channels: int = 1,
+                 crossfade_ms: float = 0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.n_channels = n_channels
+        self.crossfade_len = int(sample_rate * crossfade_ms / 1000)
+        self.n_samples = 0
+        self.n_segments = 0
+        self._tail = None
+        self._pieces = []
+        self._file = None
+        if path is not None:
+            self._file = wave.open(path, 'wb')
+            self._file.setnchannels(n_channels)
+            self._file.setsampwidth(2)
+            self._file.setframerate(sample_rate)
+
+    def __enter__(self) -> 'StreamingAudioWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    @property
+    def duration_s(self) -> float:
+        return self.n_samples / self.sample_rate
+
+    def _emit(self, samples: np.ndarray) -> None:
+        if samples.shape[1] == 0:
+            return
+        self.n_samples += samples.shape[1]
+        if self._file is not None:
+            self._file.writeframes(AudioBuffer(samples, self.sample_rate).to_int16().tobytes())
+        else:
+            self._pieces.append(samples.copy())
+
+    def write(self, audio: AudioBuffer) -> None:
+        assert audio.sample_rate == self.sample_rate, "segment sample rate must match the writer"
+        assert audio.n_channels == self.n_channels, "segment channels must match the writer"
+        samples = audio.samples
+        if self._tail is not None:
+            n = min(self._tail.shape[1], samples.shape[1])
+            self._emit(self._tail[:, :self._tail.shape[1] - n])
+            if n > 0:
+                ramp = np.linspace(0, 1, n, endpoint=False, dtype=np.float32)
+                self._emit(self._tail[:, -n:] * ramp[::-1] + samples[:, :n] * ramp)
+            samples = samples[:, n:]
+
+        keep = min(self.crossfade_len, samples.shape[1])
+        self._emit(samples[:, :samples.shape[1] - keep])
+        self._tail = samples[:, samples.shape[1] - keep:].copy()
+        self.n_segments += 1
+
+    def close(self) -> Optional[AudioBuffer]:
+        """Flush the held back tail, returns the assembled audio when writing to memory"""
+        if self._tail is not None:
+            self._emit(self._tail)
+            self._tail = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            return None
+        if self.path is not None:
+            return None
+        if not self._pieces:
+            return AudioBuffer(np.zeros((self.n_channels, 0), dtype=np.float32), self.sample_rate)
+        assembled = AudioBuffer(np.concatenate(self._pieces, axis=1), self.sample_rate)
+        self._pieces = [assembled.samples]
+        return assembled
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+    from time import perf_counter
+
+    segment = AudioBuffer(np.random.default_rng(0).uniform(-0.5, 0.5, 5 * AUDIO_SAMPLE_RATE))
+    for n_segments in (10, 40, 160):
+        start = perf_counter()
+        combined = segment.to_pydub()
+        for _ in range(n_segments - 1):
+            combined = combined.append(segment.to_pydub(), crossfade=500)
+        pydub_time = perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as folder:
+            start = perf_counter()
+            with StreamingAudioWriter(os.path.join(folder, 'out.wav'), crossfade_ms=500) as writer:
+                for _ in range(n_segments):
+                    writer.write(segment)
+            writer_time = perf_counter() - start
+        assert abs(writer.n_samples - len(combined.get_array_of_samples())) <= n_segments
+        print(f'{n_segments} segments | pydub append {pydub_time:.2f} s, streaming writer {writer_time:.2f} s')
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+from PIL import Image
+
+from src.constants import DIFFUSION_CACHE_FOLDER, DIFFUSION_CACHE_MAX_BYTES
+
+from typing import Any, Optional
+
+
+class DiffusionCache:
+    """
+    Persistent content-addressed store of img2img outputs.
+    Entries are PNG files named by the hash of the init image and every setting that influences the result,
+    least recently used entries are removed once the folder grows beyond max_bytes.
+    """
+
+    def __init__(self, folder: str = DIFFUSION_CACHE_FOLDER, max_bytes: float = DIFFUSION_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def make_key(init_image: Image.Image, **settings: Any) -> str:
+        digest = hashlib.sha256()
+        digest.update(f'{init_image.mode}:{init_image.size}'.encode('utf-8'))
+        digest.update(np.asarray(init_image).tobytes())
+        digest.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f'{key}.png')
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        path = self._path(key)
+        try:
+            with Image.open(path) as img:
+                img.load()
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return img
+
+    def put(self, key: str, image: Image.Image) -> None:
+        # written under a temporary name first, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format='PNG')
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits into max_bytes"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.}
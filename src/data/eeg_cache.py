@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+from pandas import read_csv
+
+from src.constants import SAMPLE_RATE, EEG_CACHE_SUFFIX, EEG_READ_CHUNK_S
+
+from typing import Optional, Union
+
+# File layout: magic | uint32 header length | JSON header | padding to EEG_CACHE_ALIGNMENT |
+# float32 data of shape (channels, samples). 'channel_offsets' in the header are relative to the data start.
+EEG_CACHE_MAGIC = b'B2MEEG01'
+EEG_CACHE_VERSION = 1
+EEG_CACHE_ALIGNMENT = 64
+EEG_CACHE_DTYPE = np.float32
+
+
+class EegRecording:
+    """Memory-mapped EEG recording, channel-major so that every channel is one contiguous block"""
+
+    def __init__(self, data: np.ndarray, sample_rate: int, channel_names: list[str]):
+        self.data = data
+        self.sample_rate = sample_rate
+        self.channel_names = channel_names
+        self.channel_index = {name: i for i, name in enumerate(channel_names)}
+
+    @property
+    def n_samples(self) -> int:
+        return self.data.shape[1]
+
+    @property
+    def n_channels(self) -> int:
+        return self.data.shape[0]
+
+    def channel(self, channel: Union[int, str]) -> np.ndarray:
+        """Whole signal of one channel, looked up by position or by name"""
+        if isinstance(channel, str):
+            channel = self.channel_index[channel]
+        return self.data[channel]
+
+    def samples(self, n_channels: Optional[int] = None) -> np.ndarray:
+        """(signal, channels) view over the first n_channels, no data is copied"""
+        return self.data[:n_channels].T
+
+    def window(self, start: int, stop: int, n_channels: Optional[int] = None) -> np.ndarray:
+        """(signal, channels) view over samples [start, stop)"""
+        return self.data[:n_channels, start:stop].T
+
+
+def get_cache_path(csv_path: str) -> str:
+    return csv_path + EEG_CACHE_SUFFIX
+
+
+def hash_file(path: str, block_size: int = 1 << 20) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_data_offset(header_len: int) -> int:
+    unaligned = len(EEG_CACHE_MAGIC) + 4 + header_len
+    return -(-unaligned // EEG_CACHE_ALIGNMENT) * EEG_CACHE_ALIGNMENT
+
+
+def read_cache_header(cache_path: str) -> tuple[dict, int]:
+    """Returns the JSON header and the byte offset where the samples start"""
+    with open(cache_path, 'rb') as f:
+        magic = f.read(len(EEG_CACHE_MAGIC))
+        if magic != EEG_CACHE_MAGIC:
+            raise ValueError(f'{cache_path} is not an EEG cache file')
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, get_data_offset(header_len)
+
+
+def refresh_cache_source(cache_path: str, header: dict, mtime_ns: int) -> bool:
+    """
+    Record a new mtime of an unchanged source CSV in the header, so later opens skip hashing it again.
+    The header is rewritten in place when it still ends before the samples start, False otherwise.
+    """
+    header = dict(header, source=dict(header['source'], mtime_ns=mtime_ns))
+    header_bytes = json.dumps(header).encode('utf-8')
+    _, data_offset = read_cache_header(cache_path)
+    if get_data_offset(len(header_bytes)) != data_offset:
+        return False
+    try:
+        with open(cache_path, 'r+b') as f:
+            f.seek(len(EEG_CACHE_MAGIC))
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_offset - f.tell()))
+    except OSError:  # e.g. a read-only copy, it stays valid and is only hashed again next time
+        return False
+    return True
+
+
+def is_cache_valid(csv_path: str, cache_path: str, sample_rate: int = SAMPLE_RATE) -> bool:
+    """
+    A cache is stale once the source CSV changed; mtime is checked first and the hash only if it differs.
+    When the hash still matches, the new mtime is stored so the file is not hashed on every open.
+    """
+    if not os.path.exists(cache_path):
+        return False
+    try:
+        header, _ = read_cache_header(cache_path)
+    except (ValueError, OSError, struct.error, json.JSONDecodeError):
+        return False
+    if header.get('version') != EEG_CACHE_VERSION or header['sample_rate'] != sample_rate:
+        return False
+
+    source = header['source']
+    stat = os.stat(csv_path)
+    if stat.st_size != source['size']:
+        return False
+    if stat.st_mtime_ns == source['mtime_ns']:
+        return True
+    if hash_file(csv_path) != source['sha1']:
+        return False
+    refresh_cache_source(cache_path, header, stat.st_mtime_ns)
+    return True
+
+
+def convert_csv_to_cache(csv_path: str, cache_path: Optional[str] = None, sample_rate: int = SAMPLE_RATE,
+                         chunk_len_s: float = EEG_READ_CHUNK_S) -> str:
+    """One-time conversion of an EEG CSV into the binary format, streamed so memory stays bounded"""
+    cache_path = get_cache_path(csv_path) if cache_path is None else cache_path
+    channel_names = [str(c) for c in read_csv(csv_path, nrows=0).columns]
+    n_channels = len(channel_names)
+    stat = os.stat(csv_path)
+
+    # The CSV is row-major, so samples are first spooled as-is and transposed block by block afterwards.
+    # Both files get unique names next to the cache, so concurrent conversions do not write into each other
+    folder = os.path.dirname(os.path.abspath(cache_path))
+    paths = []
+    try:
+        for suffix in ('.spool', '.tmp'):
+            fd, path = tempfile.mkstemp(dir=folder, suffix=suffix)
+            os.close(fd)
+            paths.append(path)
+        spool_path, tmp_path = paths
+        n_samples = 0
+        chunk_len = max(round(sample_rate * chunk_len_s), 1)
+        with open(spool_path, 'wb') as spool, read_csv(csv_path, chunksize=chunk_len) as reader:
+            for chunk in reader:
+                chunk.to_numpy(dtype=EEG_CACHE_DTYPE).tofile(spool)
+                n_samples += chunk.shape[0]
+
+        channel_bytes = n_samples * np.dtype(EEG_CACHE_DTYPE).itemsize
+        header = {
+            'version': EEG_CACHE_VERSION,
+            'sample_rate': sample_rate,
+            'channel_names': channel_names,
+            'n_samples': n_samples,
+            'dtype': np.dtype(EEG_CACHE_DTYPE).str,
+            'channel_offsets': [ch * channel_bytes for ch in range(n_channels)],
+            'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': hash_file(csv_path)},
+        }
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_offset = get_data_offset(len(header_bytes))
+
+        with open(tmp_path, 'wb') as f:
+            f.write(EEG_CACHE_MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_offset - f.tell()))
+
+        if n_samples > 0:
+            spool = np.memmap(spool_path, dtype=EEG_CACHE_DTYPE, mode='r', shape=(n_samples, n_channels))
+            data = np.memmap(tmp_path, dtype=EEG_CACHE_DTYPE, mode='r+', offset=data_offset,
+                             shape=(n_channels, n_samples))
+            for start in range(0, n_samples, chunk_len):
+                data[:, start:start + chunk_len] = spool[start:start + chunk_len].T
+            data.flush()
+            del data, spool
+        os.replace(tmp_path, cache_path)
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    return cache_path
+
+
+def open_eeg_recording(csv_path: str, sample_rate: int = SAMPLE_RATE) -> EegRecording:
+    """Open the binary copy of an EEG CSV, (re)building it first if it is missing or stale"""
+    cache_path = get_cache_path(csv_path)
+    if not is_cache_valid(csv_path, cache_path, sample_rate=sample_rate):
+        convert_csv_to_cache(csv_path, cache_path, sample_rate=sample_rate)
+    header, data_offset = read_cache_header(cache_path)
+    shape = (len(header['channel_names']), header['n_samples'])
+    if header['n_samples'] == 0:
+        data = np.empty(shape, dtype=header['dtype'])
+    else:
+        data = np.memmap(cache_path, dtype=header['dtype'], mode='r', offset=data_offset, shape=shape)
+    return EegRecording(data, sample_rate=header['sample_rate'], channel_names=header['channel_names'])
+
+
+if __name__ == "__main__":
+    from src.constants import SAMPLE_EEG_PATH
+
+    print(f'Converted {SAMPLE_EEG_PATH} to {convert_csv_to_cache(SAMPLE_EEG_PATH)}')
@@ -1,15 +1,31 @@
+from functools import lru_cache
+
 import numpy as np
 import pywt
-from scipy.signal import sosfiltfilt, butter
+from scipy.signal import sosfiltfilt, sosfilt, sosfilt_zi, butter
 
 from src.parameters import ChannelParameters
-from src.constants import N_CHANNELS
+from src.data.wavelet_bank import fft_wavelet_transform
+from src.data.metrics import record_stage
+from src.constants import N_CHANNELS, CWT_BACKEND
+
+from typing import Optional
+
+
+@lru_cache(maxsize=32)
+def get_wavelet_scales(cwavelet: str, frequencies: tuple, sample_rate: int) -> np.ndarray:
+    return pywt.frequency2scale(cwavelet, np.array(frequencies) / sample_rate)
 
 
 def wavelet_transform(wave: np.ndarray, channel_params: ChannelParameters,
-                      cwavelet: str = 'morl') -> np.ndarray:
-    scales = pywt.frequency2scale(cwavelet, channel_params.frequencies / channel_params.sample_rate)
-    transformed = pywt.cwt(wave, scales=scales, wavelet=cwavelet)[0]
+                      cwavelet: str = 'morl', method: str = 'conv', backend: str = CWT_BACKEND) -> np.ndarray:
+    """CWT along the last axis of wave, output has the scales prepended: (freqs, ..., time)"""
+    if backend == 'fft':
+        return fft_wavelet_transform(wave, channel_params=channel_params, cwavelet=cwavelet)
+    elif backend != 'pywt':
+        raise ValueError('backend can only be "fft" or "pywt"')
+    scales = get_wavelet_scales(cwavelet, tuple(channel_params.frequencies), channel_params.sample_rate)
+    transformed = pywt.cwt(wave, scales=scales, wavelet=cwavelet, method=method, axis=-1)[0]
     return transformed
 
 
@@ -26,28 +42,99 @@ def abs_spectrogram(spectrogram: np.ndarray, abs_mode: str) -> np.ndarray:
         raise ValueError('abs_mode can only be "none", "both", "plus" or "minus"')
 
 
-def extract_features(eeg: np.ndarray, ch: int, channel_params: ChannelParameters) -> np.ndarray:
+def extract_features(eeg: np.ndarray, ch: int, channel_params: ChannelParameters,
+                     backend: str = CWT_BACKEND) -> np.ndarray:
     """Get useful features from one EEG channel"""
     cleaned_signal = clean_signal(eeg[:, ch], channel_params=channel_params)
-    spectrogram = wavelet_transform(cleaned_signal, channel_params=channel_params)
+    spectrogram = wavelet_transform(cleaned_signal, channel_params=channel_params, backend=backend)
     spectrogram = abs_spectrogram(spectrogram, abs_mode=channel_params.abs_mode)
     return spectrogram
 
 
-def extract_all_features(eeg_and_params: tuple[np.ndarray, dict[int, ChannelParameters]]) -> list[np.ndarray]:
-    """Get combined spectrogram from EEG segments based on parameters"""
+def extract_features_batch(eeg: np.ndarray, params: dict[int, ChannelParameters],
+                           channels: Optional[list[int]] = None, backend: str = CWT_BACKEND,
+                           filters: Optional[dict[int, 'StreamingBandpassFilter']] = None) -> np.ndarray:
+    """
+    Get features from several EEG channels at once.
+    Channels sharing the same parameters are filtered and transformed in a single call,
+    the result is stacked as (channels, freqs, time).
+    If filters are given, channels are cleaned causally by their own StreamingBandpassFilter
+    instead of the zero-phase filter, so consecutive segments must be passed in order and without overlap.
+    """
+    channels = list(range(N_CHANNELS)) if channels is None else channels
+    groups = {}
+    for ch in channels:
+        groups.setdefault(get_params_key(params[ch]), []).append(ch)
+
+    spectrograms = [None] * len(channels)
+    position = {ch: i for i, ch in enumerate(channels)}
+    for group in groups.values():
+        channel_params = params[group[0]]
+        with record_stage('filter'):
+            if filters is None:
+                cleaned = clean_signal(eeg[:, group].T, channel_params=channel_params)  # (channels, samples)
+            else:
+                cleaned = np.stack([filters[ch].process(eeg[:, ch]) for ch in group])
+        with record_stage('cwt'):
+            transformed = wavelet_transform(cleaned, channel_params=channel_params, method='fft', backend=backend)
+            transformed = abs_spectrogram(transformed, abs_mode=channel_params.abs_mode)
+        for i, ch in enumerate(group):
+            spectrograms[position[ch]] = transformed[:, i]
+    return np.stack(spectrograms)
+
+
+def extract_all_features(eeg_and_params: tuple[np.ndarray, dict[int, ChannelParameters]],
+                         filters: Optional[dict[int, 'StreamingBandpassFilter']] = None) -> np.ndarray:
+    """Get stacked spectrograms (channels, freqs, time) from EEG segments based on parameters"""
     eeg, params = eeg_and_params
-    spectrograms = []
-    for ch in range(N_CHANNELS):
-        spectrogram = extract_features(eeg, ch=ch, channel_params=params[ch])
-        spectrograms.append(spectrogram)
-    return spectrograms
+    return extract_features_batch(eeg, params, filters=filters)
+
+
+def get_params_key(channel_params: ChannelParameters) -> tuple:
+    """Channels with equal keys can be processed together"""
+    return (channel_params.min_freq, channel_params.max_freq, channel_params.sample_rate,
+            channel_params.abs_mode, tuple(channel_params.frequencies))
+
+
+@lru_cache(maxsize=32)
+def get_bandpass_filter(min_freq: float, max_freq: float, sample_rate: int, order: int = 4) -> np.ndarray:
+    return butter(order, (min_freq, max_freq), 'bp', output='sos', fs=sample_rate)
 
 
 def clean_signal(signal: np.ndarray, channel_params: ChannelParameters) -> np.ndarray:
-    bandpass_filter = butter(4, (channel_params.min_freq, channel_params.max_freq), 'bp',
-                             output='sos', fs=channel_params.sample_rate)
-    return sosfiltfilt(bandpass_filter, signal)
+    """Zero-phase band-pass along the last axis, so a (channels, samples) block is filtered in one call"""
+    bandpass_filter = get_bandpass_filter(channel_params.min_freq, channel_params.max_freq,
+                                          channel_params.sample_rate)
+    return sosfiltfilt(bandpass_filter, signal, axis=-1)
+
+
+class StreamingBandpassFilter:
+    """
+    Causal counterpart of clean_signal for one channel. The filter state is carried between calls,
+    so a recording fed segment by segment is filtered as one continuous signal, without transients
+    at the segment boundaries, and every call only costs O(new samples).
+    """
+
+    def __init__(self, channel_params: ChannelParameters):
+        self.sos = get_bandpass_filter(channel_params.min_freq, channel_params.max_freq, channel_params.sample_rate)
+        self.zi = None
+
+    def reset(self) -> None:
+        self.zi = None
+
+    def process(self, signal: np.ndarray) -> np.ndarray:
+        """Filter the next samples of the channel"""
+        if signal.size == 0:
+            return signal.astype(np.float64)
+        if self.zi is None:
+            # start in steady state for the first sample to avoid a step response
+            self.zi = sosfilt_zi(self.sos) * signal[0]
+        filtered, self.zi = sosfilt(self.sos, signal, zi=self.zi)
+        return filtered
+
+
+def make_streaming_filters(params: dict[int, ChannelParameters]) -> dict[int, StreamingBandpassFilter]:
+    return {ch: StreamingBandpassFilter(channel_params) for ch, channel_params in params.items()}
 
 
 if __name__ == "__main__":
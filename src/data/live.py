@@ -0,0 +1,248 @@
+import os
+import queue
+import socket
+import threading
+import time
+from dataclasses import dataclass
+import numpy as np
+
+from src.data.audio_buffer import AudioBuffer
+from src.data.sample_gen import iter_eeg_chunks
+from src.data.utils import iter_segment_eeg
+from src.constants import SAMPLE_RATE, SEGMENT_LEN_S, SAMPLE_EEG_PATH, LIVE_CHUNK_S, LIVE_DEADLINE_S, \
+    PLAYBACK_QUEUE_SIZE
+
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
+
+_END = object()
+
+
+def iter_replayed_eeg_chunks(datapath: str = SAMPLE_EEG_PATH, n_channels: int = 2, chunk_len_s: float = LIVE_CHUNK_S,
+                             speed: float = 1.) -> Iterator[np.ndarray]:
+    """Replay a recorded CSV as if it was recorded right now, every chunk is released once its last sample is due"""
+    started = time.monotonic()
+    n_samples = 0
+    for chunk in iter_eeg_chunks(datapath, n_channels=n_channels, chunk_len_s=chunk_len_s):
+        n_samples += chunk.shape[0]
+        delay = started + n_samples / SAMPLE_RATE / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield chunk
+
+
+def iter_binary_eeg_chunks(stream: BinaryIO, n_channels: int = 2, chunk_len_s: float = LIVE_CHUNK_S,
+                           dtype: str = '<f4') -> Iterator[np.ndarray]:
+    """Interleaved samples (signal, channels) of the given dtype read from a byte stream until it closes"""
+    frame_bytes = np.dtype(dtype).itemsize * n_channels
+    chunk_bytes = max(round(SAMPLE_RATE * chunk_len_s), 1) * frame_bytes
+    pending = b''
+    while True:
+        data = stream.read(chunk_bytes - len(pending))
+        if not data:
+            break
+        pending += data
+        n_complete = len(pending) - len(pending) % frame_bytes
+        if n_complete == 0:
+            continue
+        yield np.frombuffer(pending[:n_complete], dtype=dtype).astype(np.float32).reshape(-1, n_channels)
+        pending = pending[n_complete:]
+
+
+def iter_socket_eeg_chunks(host: str, port: int, n_channels: int = 2, chunk_len_s: float = LIVE_CHUNK_S,
+                           dtype: str = '<f4') -> Iterator[np.ndarray]:
+    """Samples streamed by a local TCP server, see iter_binary_eeg_chunks for the format"""
+    with socket.create_connection((host, port)) as connection, connection.makefile('rb') as stream:
+        yield from iter_binary_eeg_chunks(stream, n_channels, chunk_len_s, dtype)
+
+
+def iter_pipe_eeg_chunks(path: str, n_channels: int = 2, chunk_len_s: float = LIVE_CHUNK_S,
+                         dtype: str = '<f4') -> Iterator[np.ndarray]:
+    """Samples written into a named pipe, which is created if missing, see iter_binary_eeg_chunks for the format"""
+    if not os.path.exists(path):
+        os.mkfifo(path)
+    with open(path, 'rb', buffering=0) as stream:
+        yield from iter_binary_eeg_chunks(stream, n_channels, chunk_len_s, dtype)
+
+
+def open_live_source(source: str, n_channels: int = 2, chunk_len_s: float = LIVE_CHUNK_S) -> Iterator[np.ndarray]:
+    """'tcp://host:port', 'pipe:///path/to/fifo' or the path of a CSV recording to replay in real time"""
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        return iter_socket_eeg_chunks(host, int(port), n_channels, chunk_len_s)
+    if source.startswith('pipe://'):
+        return iter_pipe_eeg_chunks(source[len('pipe://'):], n_channels, chunk_len_s)
+    if source.endswith('.csv'):
+        return iter_replayed_eeg_chunks(source, n_channels, chunk_len_s)
+    raise ValueError('source can only be "tcp://host:port", "pipe://path" or a .csv file')
+
+
+@dataclass
+class SegmentTiming:
+    index: int
+    captured_at: float  # arrival of the last sample of the window, time.monotonic()
+    deadline: float
+    finished_at: Optional[float] = None  # audio handed to playback
+    played_at: Optional[float] = None  # playback started
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.finished_at is None else self.finished_at - self.captured_at
+
+    @property
+    def missed(self) -> bool:
+        return self.finished_at is None or self.finished_at > self.deadline
+
+
+class DeadlineScheduler:
+    """
+    Keeps the deadline of every window, deadline_s after its last sample arrived,
+    and reports latency and missed deadlines once the audio for it is finished.
+    """
+
+    def __init__(self, deadline_s: float = LIVE_DEADLINE_S):
+        self.deadline_s = deadline_s
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def capture(self, index: int, captured_at: Optional[float] = None) -> None:
+        captured_at = time.monotonic() if captured_at is None else captured_at
+        with self._lock:
+            self.timings[index] = SegmentTiming(index, captured_at, captured_at + self.deadline_s)
+
+    def remaining(self, index: int) -> float:
+        """Seconds left until the deadline of the window"""
+        return self.timings[index].deadline - time.monotonic()
+
+    def finish(self, index: int) -> SegmentTiming:
+        timing = self.timings[index]
+        timing.finished_at = time.monotonic()
+        if timing.missed:
+            print(f'Segment {index + 1} missed its deadline by {timing.finished_at - timing.deadline:.2f} s')
+        return timing
+
+    def played(self, index: int) -> None:
+        if index in self.timings:
+            self.timings[index].played_at = time.monotonic()
+
+    def report(self) -> dict:
+        with self._lock:
+            captured = list(self.timings.values())
+        timings = [t for t in captured if t.finished_at is not None]
+        if not timings:
+            return {'segments': 0, 'unfinished': len(captured)}
+        latencies = np.array([t.latency for t in timings])
+        report = {
+            'segments': len(timings),
+            'unfinished': len(captured) - len(timings),
+            'missed_deadlines': sum(t.missed for t in timings),
+            'latency_mean_s': float(latencies.mean()),
+            'latency_p50_s': float(np.percentile(latencies, 50)),
+            'latency_p95_s': float(np.percentile(latencies, 95)),
+            'latency_max_s': float(latencies.max()),
+        }
+        played = [t.played_at - t.captured_at for t in timings if t.played_at is not None]
+        if played:
+            report['capture_to_playback_mean_s'] = float(np.mean(played))
+        return report
+
+
+class LiveEegStream:
+    """
+    Reads a live source on its own thread, so samples keep being collected and time-stamped on arrival
+    while the pipeline is busy, and cuts them into windows registered with the scheduler.
+    """
+
+    def __init__(self, chunks: Iterable[np.ndarray], scheduler: DeadlineScheduler,
+                 segment_len_s: float = SEGMENT_LEN_S, sample_rate: int = SAMPLE_RATE):
+        self.chunks = chunks
+        self.scheduler = scheduler
+        self.segment_len_s = segment_len_s
+        self.sample_rate = sample_rate
+        self.error = None
+        self._queue = queue.Queue()
+        self._last_arrival = None
+        self._reader = threading.Thread(target=self._read, name='live-eeg-reader', daemon=True)
+
+    def _read(self) -> None:
+        try:
+            for chunk in self.chunks:
+                self._queue.put((time.monotonic(), chunk))
+        except Exception as e:
+            self.error = e
+        self._queue.put(_END)
+
+    def _timed_chunks(self) -> Iterator[np.ndarray]:
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                if self.error is not None:
+                    raise self.error
+                return
+            self._last_arrival, chunk = item
+            yield chunk
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        self._reader.start()
+        segments = iter_segment_eeg(self._timed_chunks(), sample_rate=self.sample_rate,
+                                    segment_len_s=self.segment_len_s)
+        for index, segment in enumerate(segments):
+            # a window is complete once the chunk holding its last sample arrived
+            self.scheduler.capture(index, self._last_arrival)
+            yield segment
+
+
+def simpleaudio_player(audio: AudioBuffer) -> None:
+    import simpleaudio
+    simpleaudio.play_buffer(audio.to_int16().tobytes(), audio.n_channels, 2, audio.sample_rate).wait_done()
+
+
+def sleep_player(audio: AudioBuffer) -> None:
+    """Stand-in for a sound device, keeps the playback clock without producing sound"""
+    time.sleep(audio.duration_s)
+
+
+class PlaybackQueue:
+    """Plays finished segments one after another on a background thread, counting gaps between them"""
+
+    def __init__(self, player: Optional[Callable[[AudioBuffer], None]] = None,
+                 scheduler: Optional[DeadlineScheduler] = None, maxsize: int = PLAYBACK_QUEUE_SIZE):
+        if player is None:
+            try:
+                import simpleaudio  # noqa: F401
+                player = simpleaudio_player
+            except ImportError:
+                print("WARNING: simpleaudio is not installed, playback is simulated")
+                player = sleep_player
+        self.player = player
+        self.scheduler = scheduler
+        self.underruns = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._play, name='playback', daemon=True)
+        self._thread.start()
+
+    def put(self, index: int, audio: AudioBuffer) -> None:
+        self._queue.put((index, audio))
+
+    def _play(self) -> None:
+        started = False
+        while True:
+            starved = started and self._queue.empty()
+            item = self._queue.get()
+            if item is _END:
+                return
+            if starved:
+                self.underruns += 1
+            index, audio = item
+            started = True
+            if self.scheduler is not None:
+                self.scheduler.played(index)
+            try:
+                self.player(audio)
+            except Exception as e:
+                print(f"Playback of segment {index + 1} failed: {e}")
+
+    def close(self, wait: bool = True) -> None:
+        """Stop after the queued segments, wait=True blocks until they finished playing"""
+        self._queue.put(_END)
+        if wait:
+            self._thread.join()
@@ -0,0 +1,340 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field
+import numpy as np
+
+from src.constants import METRICS_HISTORY, METRICS_QUANTILES, METRICS_RSS_INTERVAL_S
+
+from typing import Any, Iterable, Iterator, Optional, Union
+
+_active_recorder = None
+_context = threading.local()  # indices of the segments the current thread is working on
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    index: Optional[int]  # segment, None outside of a segment context
+    wall_s: float
+    cpu_s: float  # CPU time of the stage thread plus library_cpu_s
+    rss_bytes: int  # resident memory of the process when the stage finished
+    peak_rss_bytes: int  # highest resident memory of the process sampled while the stage ran
+    cuda_peak_bytes: Optional[int]  # highest CUDA allocation of the process sampled while the stage ran
+    timestamp: float
+    library_cpu_s: float = 0.  # its share of the CPU time of library threads, e.g. torch intra-op and BLAS pools
+    overlapping: list[str] = field(default_factory=list)  # stages that ran at the same time
+    # Stages are measured where and when they run, nothing is serialised. Memory, CUDA and library thread CPU
+    # are process-wide: peaks also hold what the overlapping stages allocated and library thread CPU time is
+    # split evenly between the stages running while it was spent
+
+
+def get_rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes on Linux
+
+
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def get_thread_cpu_s() -> dict[int, float]:
+    """CPU time of every thread of the process by native thread id, empty without /proc"""
+    try:
+        tasks = os.listdir('/proc/self/task')
+    except OSError:
+        return {}
+    cpu_s = {}
+    for task in tasks:
+        try:
+            with open(f'/proc/self/task/{task}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # the thread exited meanwhile
+        cpu_s[int(task)] = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS  # utime and stime
+    return cpu_s
+
+
+def _cuda() -> Optional[Any]:
+    """torch.cuda if torch is already imported and a GPU is in use, metrics never import torch themselves"""
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda
+
+
+class _StageSampler:
+    """
+    Follows the measured stages while they run. Every interval, and whenever a stage starts or finishes,
+    the CPU time library threads spent since the last look is split between the running stages in proportion
+    to the CPU time their own threads spent meanwhile, evenly if none did, and the resident memory and CUDA
+    allocation are checked against the peaks of every running stage.
+    """
+
+    def __init__(self, interval_s: float = METRICS_RSS_INTERVAL_S):
+        self.interval_s = interval_s
+        self._running = []
+        self._library_cpu_s = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def add(self, measurement: '_Measurement') -> None:
+        with self._lock:
+            measurement.sampled_cpu_s = self._sample().get(measurement.thread, 0.)
+            for other in self._running:
+                other.overlapping.add(measurement.stage)
+                measurement.overlapping.add(other.stage)
+            self._running.append(measurement)
+
+    def remove(self, measurement: '_Measurement') -> None:
+        with self._lock:
+            self._sample()
+            self._running.remove(measurement)
+
+    def _sample(self) -> dict[int, float]:
+        thread_cpu_s = get_thread_cpu_s()
+        python_threads = {thread.native_id for thread in threading.enumerate()}
+        library_cpu_s = sum(cpu_s for thread, cpu_s in thread_cpu_s.items() if thread not in python_threads)
+        sharing = [m for m in self._running if m.library_threads]
+        if self._library_cpu_s is not None and sharing:
+            spent = max(library_cpu_s - self._library_cpu_s, 0.)
+            weights = [max(thread_cpu_s.get(m.thread, 0.) - m.sampled_cpu_s, 0.) for m in sharing]
+            total = sum(weights)
+            for measurement, weight in zip(sharing, weights):
+                measurement.library_cpu_s += spent * (weight / total if total > 0 else 1 / len(sharing))
+        self._library_cpu_s = library_cpu_s
+        for measurement in self._running:
+            measurement.sampled_cpu_s = thread_cpu_s.get(measurement.thread, 0.)
+        rss = get_rss_bytes()
+        cuda = _cuda()
+        cuda_allocated = cuda.memory_allocated() if cuda is not None else None
+        for measurement in self._running:
+            measurement.peak_rss = max(measurement.peak_rss, rss)
+            if cuda_allocated is not None:
+                measurement.cuda_peak = max(measurement.cuda_peak or 0, cuda_allocated)
+        return thread_cpu_s
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            with self._lock:
+                if self._running:
+                    self._sample()
+
+
+class MetricsRecorder:
+    """
+    Collects a StageRecord for every measured stage of every segment.
+    Records are appended to a JSON lines file as they come in, the last `history` values of every stage
+    are kept for percentiles, which write_prometheus exports as summaries in the Prometheus text format.
+    Call activate() to make record_stage() calls anywhere in the process report to this recorder.
+    Recording never changes when stages run, a background thread samples what they share (see StageRecord).
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, prometheus_path: Optional[str] = None,
+                 history: int = METRICS_HISTORY, quantiles: tuple[float, ...] = METRICS_QUANTILES):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.history = history
+        self.quantiles = quantiles
+        self._values = {}  # stage -> {'wall_s': deque, 'cpu_s': deque}
+        self._totals = {}  # stage -> [count, wall sum, cpu sum]
+        self._stage_peak_rss = {}  # stage -> highest peak_rss_bytes of its records
+        self._lock = threading.Lock()
+        self._sampler = _StageSampler()
+        self._jsonl = None
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(jsonl_path) or '.', exist_ok=True)
+            self._jsonl = open(jsonl_path, 'a', buffering=1)
+
+    def activate(self) -> 'MetricsRecorder':
+        global _active_recorder
+        _active_recorder = self
+        self._sampler.start()
+        return self
+
+    def deactivate(self) -> None:
+        global _active_recorder
+        if _active_recorder is self:
+            _active_recorder = None
+        self._sampler.stop()
+
+    def add(self, record: StageRecord) -> None:
+        with self._lock:
+            if record.stage not in self._values:
+                self._values[record.stage] = {'wall_s': deque(maxlen=self.history),
+                                              'cpu_s': deque(maxlen=self.history)}
+                self._totals[record.stage] = [0, 0., 0.]
+            self._values[record.stage]['wall_s'].append(record.wall_s)
+            self._values[record.stage]['cpu_s'].append(record.cpu_s)
+            totals = self._totals[record.stage]
+            totals[0] += 1
+            totals[1] += record.wall_s
+            totals[2] += record.cpu_s
+            self._stage_peak_rss[record.stage] = max(self._stage_peak_rss.get(record.stage, 0), record.peak_rss_bytes)
+            if self._jsonl is not None:
+                self._jsonl.write(json.dumps(asdict(record)) + '\n')
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Count, totals and percentiles of wall and CPU time per stage"""
+        with self._lock:
+            values = {stage: {k: np.array(v) for k, v in d.items()} for stage, d in self._values.items()}
+            totals = {stage: list(t) for stage, t in self._totals.items()}
+        summary = {}
+        for stage, metrics in values.items():
+            count, wall_sum, cpu_sum = totals[stage]
+            summary[stage] = {'count': count, 'wall_s_sum': wall_sum, 'cpu_s_sum': cpu_sum}
+            for name, arr in metrics.items():
+                for q in self.quantiles:
+                    summary[stage][f'{name}_p{round(q * 100)}'] = float(np.quantile(arr, q))
+        return summary
+
+    def to_prometheus(self, prefix: str = 'eeg_to_music') -> str:
+        summary = self.summary()
+        lines = []
+        for metric, help_text in (('wall_s', 'Wall time per stage call in seconds'),
+                                  ('cpu_s', 'CPU time of the stage thread and its share of library threads '
+                                            'per stage call in seconds')):
+            name = f'{prefix}_stage_{metric.replace("_s", "_seconds")}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} summary')
+            for stage, s in summary.items():
+                for q in self.quantiles:
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {s[f"{metric}_p{round(q * 100)}"]:.6f}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {s[f"{metric}_sum"]:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {s["count"]}')
+        with self._lock:
+            stage_peaks = dict(self._stage_peak_rss)
+        name = f'{prefix}_stage_peak_rss_bytes'
+        lines.append(f'# HELP {name} Highest resident memory of the process sampled during a stage, '
+                     f'overlapping stages included')
+        lines.append(f'# TYPE {name} gauge')
+        for stage, peak in stage_peaks.items():
+            lines.append(f'{name}{{stage="{stage}"}} {peak}')
+        lines.append(f'# HELP {prefix}_peak_rss_bytes High-water mark of the process resident memory')
+        lines.append(f'# TYPE {prefix}_peak_rss_bytes gauge')
+        lines.append(f'{prefix}_peak_rss_bytes {get_peak_rss_bytes()}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Optional[str] = None) -> None:
+        """Written under a temporary name first, so a textfile collector never reads a partial file"""
+        path = self.prometheus_path if path is None else path
+        if path is None:
+            return
+        folder = os.path.dirname(path) or '.'
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def close(self) -> None:
+        self.write_prometheus()
+        self.deactivate()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+@contextmanager
+def segment_context(indices: Union[int, list[int]]) -> Iterator[None]:
+    """Stages recorded inside belong to these segments, a batch shares its time equally"""
+    previous = getattr(_context, 'indices', None)
+    _context.indices = [indices] if isinstance(indices, int) else list(indices)
+    try:
+        yield
+    finally:
+        _context.indices = previous
+
+
+class _Measurement:
+    def __init__(self, recorder: MetricsRecorder, stage: str, library_threads: bool = True):
+        self.recorder = recorder
+        self.stage = stage
+        self.library_threads = library_threads  # whether it gets a share of the library thread CPU time
+        self.library_cpu_s = 0.
+        self.peak_rss = 0
+        self.cuda_peak = None
+        self.overlapping = set()
+        self.thread = threading.get_native_id()
+        self.sampled_cpu_s = 0.  # CPU time of its thread at the last sample
+        recorder._sampler.add(self)
+        self.wall_start, self.cpu_start = time.perf_counter(), time.thread_time()
+
+    def cancel(self) -> None:
+        self.recorder._sampler.remove(self)
+
+    def finish(self) -> None:
+        wall = time.perf_counter() - self.wall_start
+        thread_cpu = time.thread_time() - self.cpu_start
+        self.recorder._sampler.remove(self)
+        cpu = thread_cpu + self.library_cpu_s
+        indices = getattr(_context, 'indices', None) or [None]
+        rss, now = get_rss_bytes(), time.time()
+        n = len(indices)
+        for index in indices:
+            self.recorder.add(StageRecord(self.stage, index, wall / n, cpu / n, rss, self.peak_rss, self.cuda_peak,
+                                          now, self.library_cpu_s / n, sorted(self.overlapping)))
+
+
+@contextmanager
+def record_stage(stage: str) -> Iterator[None]:
+    """Measure the enclosed code as `stage` of the current segments, costs nothing without an active recorder"""
+    if _active_recorder is None:
+        yield
+        return
+    measurement = _Measurement(_active_recorder, stage)
+    try:
+        yield
+    finally:
+        measurement.finish()
+
+
+def record_iter(items: Iterable, stage: str) -> Iterator:
+    """
+    Measure how long every item takes to be produced, e.g. reading and cutting EEG windows.
+    Producing an item may mostly wait on a live source, so it gets no share of the library thread CPU time.
+    """
+    iterator = iter(items)
+    index = 0
+    while True:
+        measurement = _Measurement(_active_recorder, stage, library_threads=False) if _active_recorder is not None \
+            else None
+        try:
+            item = next(iterator)
+        except BaseException as error:
+            if measurement is not None:
+                measurement.cancel()
+            if isinstance(error, StopIteration):
+                return
+            raise
+        if measurement is not None:
+            with segment_context(index):
+                measurement.finish()
+        yield item
+        index += 1
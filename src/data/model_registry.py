@@ -0,0 +1,180 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import torch
+
+from src.constants import MODEL_RAM_BUDGET_BYTES
+
+from typing import Any, Callable, Optional
+
+
+class LazyModel:
+    """
+    Handle that defers loading a model until it is first needed.
+    info optionally describes the model the loader returns, so it can be told apart without loading it.
+    """
+
+    def __init__(self, loader: Callable[[], Any], info: Optional[dict] = None):
+        self.loader = loader
+        self.info = info
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self) -> Any:
+        with self._lock:
+            if self._model is None:
+                self._model = self.loader()
+            return self._model
+
+
+def resolve_model(model: Any) -> Any:
+    return model.get() if isinstance(model, LazyModel) else model
+
+
+def estimate_model_bytes(model: Any) -> int:
+    """Size of the parameters and buffers of torch modules, pipelines and tuples of them"""
+    if isinstance(model, torch.nn.Module):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    if isinstance(model, (tuple, list)):
+        return sum(estimate_model_bytes(m) for m in model)
+    components = getattr(model, 'components', None)  # diffusers pipelines
+    if isinstance(components, dict):
+        return sum(estimate_model_bytes(m) for m in components.values())
+    return 0
+
+
+@dataclass
+class ModelRecord:
+    model: Any = None
+    size_bytes: int = 0
+    load_time_s: float = 0.
+    loads: int = 0
+    hits: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def resident(self) -> bool:
+        return self.model is not None
+
+
+class ModelRegistry:
+    """
+    Process-wide store of loaded models. Every model is loaded once on first request and the same
+    instance is handed out afterwards; when the estimated total size exceeds budget_bytes the least
+    recently used models are dropped and get reloaded on their next request.
+    Room is made before a model loads, for the size measured at its previous load or else the size_bytes
+    hint, so the budget also holds while loading. Models that another thread is loading are never waited for.
+    """
+
+    def __init__(self, budget_bytes: float = MODEL_RAM_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.records = {}
+        self._usage = OrderedDict()  # resident model names, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, name: str, loader: Callable[[], Any], size_bytes: Optional[float] = None) -> Any:
+        with self._lock:
+            record = self.records.setdefault(name, ModelRecord())
+        with record.lock:
+            if record.model is None:
+                self._evict(keep=name, incoming_bytes=record.size_bytes or size_bytes or 0)
+                start = time.perf_counter()
+                record.model = loader()
+                record.load_time_s = time.perf_counter() - start
+                record.size_bytes = estimate_model_bytes(record.model)
+                record.loads += 1
+                print(f'Loaded model {name} in {record.load_time_s:.2f} s ({record.size_bytes / 1e6:.0f} MB)')
+            else:
+                record.hits += 1
+            model = record.model
+        with self._lock:
+            self._usage[name] = None
+            self._usage.move_to_end(name)
+        self._evict(keep=name)  # the estimate may have been off
+        return model
+
+    def lazy(self, name: str, loader: Callable[[], Any], info: Optional[dict] = None,
+             size_bytes: Optional[float] = None) -> 'RegistryModel':
+        return RegistryModel(self, name, loader, info=info, size_bytes=size_bytes)
+
+    def resident_bytes(self) -> int:
+        return sum(r.size_bytes for r in self.records.values() if r.resident)
+
+    def _evict(self, keep: str, incoming_bytes: float = 0) -> None:
+        """Drop least recently used models until they and incoming_bytes more fit into the budget"""
+        evicted = False
+        with self._lock:
+            for name in list(self._usage):
+                if self.resident_bytes() + incoming_bytes <= self.budget_bytes:
+                    break
+                if name == keep:
+                    continue
+                record = self.records[name]
+                if not record.lock.acquire(blocking=False):
+                    continue  # being loaded or handed out by another thread, skipped rather than waited for
+                try:
+                    record.model = None
+                finally:
+                    record.lock.release()
+                del self._usage[name]
+                evicted = True
+                print(f'Evicted model {name} ({record.size_bytes / 1e6:.0f} MB) to stay within the memory budget')
+        if evicted:
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def evict(self, name: str) -> None:
+        with self._lock:
+            record = self.records.get(name)
+        if record is not None:
+            with record.lock:
+                record.model = None
+            with self._lock:
+                self._usage.pop(name, None)
+        gc.collect()
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = {
+                name: {'resident': r.resident, 'size_mb': r.size_bytes / 1e6, 'load_time_s': r.load_time_s,
+                       'loads': r.loads, 'hits': r.hits}
+                for name, r in self.records.items()
+            }
+            return {'budget_mb': self.budget_bytes / 1e6, 'resident_mb': self.resident_bytes() / 1e6,
+                    'models': models}
+
+
+class RegistryModel(LazyModel):
+    """LazyModel backed by the registry, so the model can be evicted and reloaded in between uses"""
+
+    def __init__(self, registry: ModelRegistry, name: str, loader: Callable[[], Any], info: Optional[dict] = None,
+                 size_bytes: Optional[float] = None):
+        super().__init__(loader, info=info)
+        self.registry = registry
+        self.name = name
+        self.size_bytes = size_bytes
+
+    @property
+    def loaded(self) -> bool:
+        record = self.registry.records.get(self.name)
+        return record is not None and record.resident
+
+    def get(self) -> Any:
+        return self.registry.get(self.name, self.loader, size_bytes=self.size_bytes)
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_model(name: str, loader: Callable[[], Any], size_bytes: Optional[float] = None) -> Any:
+    """Model from the process-wide registry, loaded with loader if it is not resident"""
+    return MODEL_REGISTRY.get(name, loader, size_bytes=size_bytes)
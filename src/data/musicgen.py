@@ -0,0 +1,148 @@
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from src.data.audio_buffer import AudioBuffer
+from src.constants import MUSICGEN_PLAY_STEPS, MUSICGEN_CONTEXT_STEPS, MUSICGEN_LOOKAHEAD_STEPS
+
+from typing import Any, Callable, Optional, Union
+
+
+class MusicgenStreamer(BaseStreamer):
+    """
+    Decodes MusicGen tokens to audio while generate() is still running.
+    generate() hands over one token per codebook and step, codebook k lagging k steps behind the first one
+    (the delay pattern). Every play_steps steps the codec frames completed since the last chunk are decoded,
+    together with context_steps frames before them that warm up the codec decoder. Only those frames are
+    gathered from the tokens, so streaming costs linear time in the length.
+    The last lookahead_steps frames are held back until the next chunk, as the decoder convolutions still
+    need them. on_audio is called with one AudioBuffer per batch item for every chunk, in order.
+    Chunks are decoded on a background thread, the sampling loop only hands the tokens over, and end() waits
+    for the last one. generate() still decodes the whole clip once more when it returns.
+    Works with MusicgenForConditionalGeneration and MusicgenMelodyForConditionalGeneration of mono models.
+    """
+
+    def __init__(self, model: Any, on_audio: Callable[[list[AudioBuffer]], Any],
+                 play_steps: int = MUSICGEN_PLAY_STEPS, context_steps: int = MUSICGEN_CONTEXT_STEPS,
+                 lookahead_steps: int = MUSICGEN_LOOKAHEAD_STEPS):
+        if model.decoder.config.audio_channels != 1:
+            raise ValueError('MusicgenStreamer only supports mono models')
+        self.audio_encoder = model.audio_encoder
+        self.n_codebooks = model.decoder.num_codebooks
+        self.sample_rate = model.config.audio_encoder.sampling_rate
+        self.samples_per_frame = int(np.prod(model.config.audio_encoder.upsampling_ratios))
+        self.on_audio = on_audio
+        self.play_steps = play_steps
+        self.context_steps = context_steps
+        self.lookahead_steps = lookahead_steps
+        self.n_chunks = 0
+        self.n_samples = 0
+        self.decode_s = 0.
+        self.first_audio_s = None
+        self._tokens = []  # one (batch * codebooks,) column per position, the decoder prompt first
+        self._n_steps = 0
+        self._submitted = 0  # frames handed to the decoder thread so far
+        self._started = time.perf_counter()
+        self._decoder_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix='musicgen-decode')
+        self._pending = []
+
+    def put(self, value: torch.Tensor) -> None:
+        if not self._tokens:
+            # the first call holds the decoder prompt of shape (batch * codebooks, prompt length)
+            self._tokens.extend(value.unbind(-1))
+            return
+        self._tokens.append(value.reshape(-1))
+        self._n_steps += 1
+        if self._n_steps % self.play_steps == 0:
+            self._submit(final=False)
+
+    def end(self) -> None:
+        try:
+            if self._tokens:
+                self._submit(final=True)
+            for future in self._pending:
+                future.result()
+        finally:
+            self._decoder_thread.shutdown(cancel_futures=True)
+
+    def _submit(self, final: bool) -> None:
+        """Queue the decoding of the frames completed so far, errors of earlier chunks are raised here"""
+        for future in [f for f in self._pending if f.done()]:
+            self._pending.remove(future)
+            future.result()
+        # position 0 holds the start token, frame f of codebook k sits at position f + k + 1. generate() only
+        # applies the delay pattern to sequences of at least 2 * codebooks - 1 positions, shorter ones end here
+        delay = 0 if final and len(self._tokens) < 2 * self.n_codebooks - 1 else self.n_codebooks - 1
+        n_frames = max(len(self._tokens) - 1 - delay, 0)
+        end = n_frames if final else n_frames - self.lookahead_steps
+        if end <= self._submitted:
+            return
+        start = max(self._submitted - self.context_steps, 0)
+        tokens = self._tokens[start + 1:n_frames + 1 + delay]
+        self._pending.append(self._decoder_thread.submit(self._emit, tokens, delay, start, self._submitted, end))
+        self._submitted = end
+
+    def _codes(self, tokens: list[torch.Tensor], delay: int) -> torch.Tensor:
+        """Frames of the given token positions with the delay pattern undone, (batch, codebooks, frames)"""
+        tokens = torch.stack(tokens, dim=-1)
+        tokens = tokens.reshape(-1, self.n_codebooks, tokens.shape[-1])
+        n_frames = tokens.shape[-1] - delay
+        return torch.stack([tokens[:, k, k * bool(delay):k * bool(delay) + n_frames]
+                            for k in range(self.n_codebooks)], dim=1)
+
+    def _emit(self, tokens: list[torch.Tensor], delay: int, start: int, emitted: int, end: int) -> None:
+        """Decode frames start.. of the tokens, frames emitted..end are new and passed on to on_audio"""
+        started = time.perf_counter()
+        codes = self._codes(tokens, delay)
+        device = next(self.audio_encoder.parameters()).device
+        with torch.no_grad():
+            audio = self.audio_encoder.decode(codes[None].to(device),
+                                              audio_scales=[None] * codes.shape[0]).audio_values
+        offset = (emitted - start) * self.samples_per_frame
+        length = (end - emitted) * self.samples_per_frame
+        chunk = audio[..., offset:offset + length].float().cpu().numpy()
+        self.decode_s += time.perf_counter() - started
+        if self.first_audio_s is None:
+            self.first_audio_s = time.perf_counter() - self._started
+        self.n_chunks += 1
+        self.n_samples += chunk.shape[-1]
+        self.on_audio([AudioBuffer(samples, self.sample_rate) for samples in chunk])
+
+    def report(self) -> dict[str, Optional[float]]:
+        return {
+            'time_to_first_audio_s': self.first_audio_s,
+            'total_s': time.perf_counter() - self._started,
+            'chunks': self.n_chunks,
+            'audio_s': self.n_samples / self.sample_rate,
+            'decode_s': self.decode_s,
+        }
+
+
+def prepare_variations(inputs: dict[str, torch.Tensor], n_variations: int,
+                       guidance_scale: Optional[float]) -> dict[str, Any]:
+    """
+    generate() keyword arguments for n_variations samples of every prompt in inputs, the processor output.
+    Every prompt row is repeated for its variations and goes through generate()'s public inputs, so the
+    text encoder runs once per variation instead of once per prompt.
+    Results come out prompt by prompt, variations next to each other. generate(num_return_sequences=n)
+    expands the same way, but MusicGen then reshapes the codes to the prompt batch size, garbling them.
+    """
+    kwargs: dict[str, Any] = {key: value.repeat_interleave(n_variations, dim=0) for key, value in inputs.items()}
+    kwargs['guidance_scale'] = guidance_scale
+    return kwargs
+
+
+def variation_path(folder: str, prefix: str, description: str, variation: int) -> str:
+    """Same description and variation, same file: readable start of the description plus a hash of all of it"""
+    slug = re.sub(r'[^a-z0-9]+', '_', description.lower()).strip('_')[:40] or 'untitled'
+    digest = hashlib.sha1(description.encode()).hexdigest()[:8]
+    return os.path.join(folder, f'{prefix}_{slug}_{digest}_v{variation + 1}.wav')
+
+
+def as_description_list(description: Union[str, list[str]]) -> list[str]:
+    return [description] if isinstance(description, str) else list(description)
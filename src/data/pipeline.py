@@ -0,0 +1,230 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait
+from dataclasses import dataclass
+
+from src.data.metrics import segment_context
+
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+_END = object()
+
+
+@dataclass
+class Stage:
+    """
+    One step of the pipeline, func is called as func(index, payload) on a dedicated worker thread.
+    With batch_size > 1 up to that many queued items are collected and func is called as
+    func(indices, payloads), returning one result per payload.
+    With max_in_flight > 0 func returns a Future instead, e.g. from a process pool, and up to that many
+    items are worked on at once. Results are still passed on in input order.
+    """
+    name: str
+    func: Callable[[Any, Any], Any]
+    batch_size: int = 1
+    max_in_flight: int = 0
+
+
+@dataclass
+class StageFailure:
+    """Takes the place of a payload once a stage raised, later stages let it pass untouched"""
+    stage: str
+    error: BaseException
+
+
+@dataclass
+class StageRun:
+    """One call of a stage function, reported to the pipeline observer"""
+    stage: str
+    indices: list[int]
+    wall_s: float
+
+    @property
+    def wall_s_per_item(self) -> float:
+        return self.wall_s / max(len(self.indices), 1)
+
+
+class StagePipeline:
+    """
+    Runs items through stages connected by bounded queues, with one worker per stage,
+    so different items can be in different stages at the same time.
+    Every worker handles items in arrival order, hence results come out in input order.
+    The optional observer is called with a StageRun after every stage call, from that stage's worker thread.
+    Stage functions run inside a metrics segment_context, so record_stage calls are attributed to their items.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 2, observer: Optional[Callable[[StageRun], Any]] = None):
+        assert len(stages) > 0, "pipeline needs at least one stage"
+        self.stages = stages
+        self.queue_size = queue_size
+        self.observer = observer
+
+    def run(self, items: Iterable[Any]) -> Iterator[tuple[int, Any]]:
+        """Yields (index, result) pairs in input order, result is a StageFailure if any stage failed"""
+        stop = threading.Event()
+        errors = []  # exceptions that ended a worker before it could pass _END on
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        workers = [threading.Thread(target=self._guard, args=(self._feed, errors, items, queues[0], stop),
+                                    daemon=True)]
+        for stage, in_queue, out_queue in zip(self.stages, queues[:-1], queues[1:]):
+            assert stage.max_in_flight == 0 or stage.batch_size == 1, "asynchronous stages can not batch"
+            work = self._work_async if stage.max_in_flight > 0 else self._work
+            workers.append(threading.Thread(target=self._guard, args=(work, errors, stage, in_queue, out_queue, stop),
+                                            name=f'stage-{stage.name}', daemon=True))
+        for worker in workers:
+            worker.start()
+        try:
+            while True:
+                try:
+                    item = queues[-1].get(timeout=0.1)
+                except queue.Empty:
+                    # a dead worker never sends _END, waiting on would hang forever
+                    if errors:
+                        raise errors[0]
+                    continue
+                if item is _END:
+                    break
+                yield item
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    @staticmethod
+    def _guard(target: Callable[..., Any], errors: list[BaseException], *args: Any) -> None:
+        """Run a worker and keep what killed it, stage failures are passed on as StageFailure instead"""
+        try:
+            target(*args)
+        except BaseException as e:
+            errors.append(e)
+
+    @staticmethod
+    def _put(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @staticmethod
+    def _get(q: queue.Queue, stop: threading.Event) -> Any:
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _feed(self, items: Iterable[Any], out_queue: queue.Queue, stop: threading.Event) -> None:
+        index = 0
+        try:
+            for item in items:
+                if not self._put(out_queue, (index, item), stop):
+                    return
+                index += 1
+        except Exception as e:
+            self._put(out_queue, (index, StageFailure('read', e)), stop)
+        self._put(out_queue, _END, stop)
+
+    def _work(self, stage: Stage, in_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event) -> None:
+        finished = False
+        while not finished:
+            batch = []
+            while len(batch) < stage.batch_size:
+                item = self._get(in_queue, stop)
+                if item is _END:
+                    finished = True
+                    break
+                batch.append(item)
+
+            for item in self._process(stage, batch):
+                if not self._put(out_queue, item, stop):
+                    return
+        self._put(out_queue, _END, stop)
+
+    def _work_async(self, stage: Stage, in_queue: queue.Queue, out_queue: queue.Queue,
+                    stop: threading.Event) -> None:
+        pending = deque()  # (index, future, submission time) in input order
+        finished = False
+        last_collected = time.perf_counter()
+        while not finished or pending:
+            if not finished and len(pending) < stage.max_in_flight:
+                try:
+                    # poll while futures are pending, so finished ones are passed on without waiting for input
+                    item = in_queue.get(timeout=0.01 if pending else 0.1)
+                except queue.Empty:
+                    item = None
+                if stop.is_set():
+                    return
+                if item is _END:
+                    finished = True
+                elif item is not None:
+                    pending.append(self._submit(stage, *item))
+
+            # the oldest item blocks the ones behind it, which keeps the output in input order
+            while pending and (finished or len(pending) >= stage.max_in_flight or pending[0][1].done()):
+                index, future, submitted = pending.popleft()
+                while not future.done():
+                    wait([future], timeout=0.1)
+                    if stop.is_set():
+                        return
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = StageFailure(stage.name, e)
+                now = time.perf_counter()
+                if not isinstance(result, StageFailure) or result.stage == stage.name:
+                    # time this item added to the stage, items that overlapped are not counted twice
+                    self._observe(StageRun(stage.name, [index], now - max(submitted, last_collected)))
+                last_collected = now
+                if not self._put(out_queue, (index, result), stop):
+                    return
+        self._put(out_queue, _END, stop)
+
+    def _submit(self, stage: Stage, index: int, payload: Any) -> tuple[int, Future, float]:
+        submitted = time.perf_counter()
+        if isinstance(payload, StageFailure):
+            future = Future()
+            future.set_result(payload)
+            return index, future, submitted
+        try:
+            with segment_context(index):
+                future = stage.func(index, payload)
+        except Exception as e:
+            future = Future()
+            future.set_result(StageFailure(stage.name, e))
+        return index, future, submitted
+
+    def _observe(self, run: StageRun) -> None:
+        if self.observer is not None:
+            try:
+                self.observer(run)
+            except Exception as e:
+                print(f"Pipeline observer failed: {e}")
+
+    def _process(self, stage: Stage, batch: list[tuple[int, Any]]) -> list[tuple[int, Any]]:
+        todo = [i for i, (_, payload) in enumerate(batch) if not isinstance(payload, StageFailure)]
+        if not todo:
+            return batch
+        results = list(batch)
+        started = time.perf_counter()
+        try:
+            if stage.batch_size == 1:
+                index, payload = batch[0]
+                with segment_context(index):
+                    results[0] = (index, stage.func(index, payload))
+            else:
+                indices = [batch[i][0] for i in todo]
+                with segment_context(indices):
+                    outputs = stage.func(indices, [batch[i][1] for i in todo])
+                for i, output in zip(todo, outputs):
+                    results[i] = (batch[i][0], output)
+        except Exception as e:
+            for i in todo:
+                results[i] = (batch[i][0], StageFailure(stage.name, e))
+        self._observe(StageRun(stage.name, [batch[i][0] for i in todo], time.perf_counter() - started))
+        return results
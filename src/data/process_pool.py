@@ -0,0 +1,212 @@
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import torch
+
+from src.data.audio_buffer import AudioBuffer
+from src.data.audio_effects import postprocess_segment_
+from src.data.eeg_features import extract_all_features
+from src.data.spectral_transform import combine_spectrograms, prepare_spectrogram
+from src.data.torch_utils import SpectrogramConverter, SpectrogramParams
+from src.parameters import ChannelParameters
+from src.constants import SPECTROGRAM_HEIGHT, SPECTROGRAM_WIDTH
+
+from typing import Any, Optional
+
+_worker = {}  # state of a worker process, set up by _init_worker
+_attached = {}  # shared memory blocks a worker process has attached to, by name
+
+
+@dataclass(frozen=True)
+class SharedArrayRef:
+    """Stands in for an array written to a shared memory block, only this is pickled between processes"""
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+def _write_block(block: SharedMemory, name: str, array: np.ndarray) -> SharedArrayRef:
+    ref = SharedArrayRef(name, tuple(array.shape), array.dtype.str)
+    if ref.nbytes > block.size:
+        raise ValueError(f'array of {ref.nbytes} bytes does not fit into a shared block of {block.size} bytes')
+    np.ndarray(ref.shape, dtype=ref.dtype, buffer=block.buf)[...] = array
+    return ref
+
+
+def _view_block(block: SharedMemory, ref: SharedArrayRef) -> np.ndarray:
+    return np.ndarray(ref.shape, dtype=ref.dtype, buffer=block.buf)
+
+
+def _attach(name: str) -> SharedMemory:
+    block = _attached.get(name)
+    if block is None:
+        block = _attached[name] = SharedMemory(name=name)
+    return block
+
+
+def write_shared(name: str, array: np.ndarray) -> SharedArrayRef:
+    """Copy array into the shared block `name` from any process"""
+    return _write_block(_attach(name), name, array)
+
+
+def read_shared(ref: SharedArrayRef, copy: bool = True) -> np.ndarray:
+    """The array behind ref, without copy it is only valid until the block is reused"""
+    view = _view_block(_attach(ref.name), ref)
+    return view.copy() if copy else view
+
+
+class SharedArrayPool:
+    """
+    Fixed set of equally sized shared memory blocks, created and unlinked by the parent process.
+    acquire() hands out the name of a free block and blocks while all of them are in use,
+    which bounds memory and holds back producers that run ahead of their consumers.
+    """
+
+    def __init__(self, n_blocks: int, block_bytes: int):
+        self.block_bytes = block_bytes
+        self._blocks = {}
+        self._free = queue.Queue()
+        for _ in range(n_blocks):
+            block = SharedMemory(create=True, size=block_bytes)
+            self._blocks[block.name] = block
+            self._free.put(block.name)
+
+    def acquire(self) -> str:
+        return self._free.get()
+
+    def release(self, name: str) -> None:
+        self._free.put(name)
+
+    def write(self, name: str, array: np.ndarray) -> SharedArrayRef:
+        return _write_block(self._blocks[name], name, array)
+
+    def take(self, ref: SharedArrayRef) -> np.ndarray:
+        """Copy the array out and hand its block back to the pool"""
+        array = _view_block(self._blocks[ref.name], ref).copy()
+        self.release(ref.name)
+        return array
+
+    def close(self) -> None:
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks.clear()
+
+
+@dataclass
+class VocoderResult:
+    wave: SharedArrayRef
+    spiked: bool
+    griffin_lim_iters: Optional[int]
+    spectral_convergence: Optional[float]
+
+
+def _init_worker(parameters: dict[int, ChannelParameters], spectrogram_params: SpectrogramParams,
+                 n_threads: int) -> None:
+    # every worker gets its own cores, nested thread pools would only fight over them
+    torch.set_num_threads(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        _worker['thread_limits'] = threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+    _worker['parameters'] = parameters
+    _worker['converter'] = SpectrogramConverter(spectrogram_params, device='cpu')
+
+
+def _features_task(segment: np.ndarray, out_name: str) -> SharedArrayRef:
+    """Features, channel combination and filtering of one segment, written as (combined, prepared)"""
+    spectrograms = extract_all_features((segment, _worker['parameters']))
+    combined = combine_spectrograms(spectrograms)
+    return write_shared(out_name, np.stack([combined, prepare_spectrogram(combined)]))
+
+
+def _vocoder_task(index: int, spectrogram: SharedArrayRef, out_name: str, num_griffin_lim_iters: Optional[int],
+                  postprocess: dict[str, Any]) -> VocoderResult:
+    """Inverse mel, Griffin-Lim and post-processing of one segment"""
+    converter = _worker['converter']
+    converter.set_iterations(num_griffin_lim_iters)
+    # Griffin-Lim starts from random phase, seeding by segment keeps the output independent of the worker
+    torch.manual_seed(index)
+    audio = converter.buffer_from_spectrogram(read_shared(spectrogram, copy=False))
+    spiked = postprocess_segment_(audio.samples, audio.sample_rate, **postprocess)
+    return VocoderResult(write_shared(out_name, audio.samples), spiked, converter.last_griffin_lim_iters,
+                         converter.last_spectral_convergence)
+
+
+class ProcessStages:
+    """
+    Runs the CPU stages of generate_audio_from_segments in worker processes: feature extraction
+    with spectrogram filtering, and the vocoder with post-processing. Spectrograms and waves move
+    through shared memory blocks, only their names are pickled. Every segment is processed on its own,
+    so causal filter state and Griffin-Lim warm starts are not available here.
+    Workers are spawned, not forked, since the parent already runs threads.
+    """
+
+    def __init__(self, n_workers: int, parameters: dict[int, ChannelParameters],
+                 spectrogram_params: SpectrogramParams, max_in_flight: Optional[int] = None,
+                 queue_size: int = 2, batch_size: int = 1, threads_per_worker: int = 1):
+        self.n_workers = n_workers
+        self.max_in_flight = 2 * n_workers if max_in_flight is None else max_in_flight
+        self.sample_rate = spectrogram_params.sample_rate
+        self._executor = ProcessPoolExecutor(n_workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                                             initargs=(parameters, spectrogram_params, threads_per_worker))
+        # blocks held by a stage window, the queue behind it and the next stage's batch, plus one to acquire
+        n_blocks = self.max_in_flight + queue_size + batch_size + 1
+        spectrogram_bytes = SPECTROGRAM_HEIGHT * SPECTROGRAM_WIDTH * np.dtype(np.float64).itemsize
+        wave_bytes = (spectrogram_params.hop_length * SPECTROGRAM_WIDTH + spectrogram_params.n_fft) \
+            * np.dtype(np.float32).itemsize
+        self._spectrograms = SharedArrayPool(n_blocks, 2 * spectrogram_bytes)
+        self._vocoder_inputs = SharedArrayPool(self.max_in_flight, spectrogram_bytes)
+        self._waves = SharedArrayPool(n_blocks, wave_bytes)
+
+    def submit_features(self, segment: np.ndarray) -> Future:
+        """Future of a SharedArrayRef, pass it to take_spectrograms"""
+        out_name = self._spectrograms.acquire()
+        return self._submit(self._spectrograms, out_name, _features_task, segment, out_name)
+
+    def take_spectrograms(self, ref: SharedArrayRef) -> tuple[np.ndarray, np.ndarray]:
+        """Combined spectrogram and its filtered version ready for diffusion"""
+        combined, prepared = self._spectrograms.take(ref)
+        return combined, prepared
+
+    def submit_vocoder(self, index: int, spectrogram: np.ndarray, num_griffin_lim_iters: Optional[int] = None,
+                       **postprocess: Any) -> Future:
+        """Future of a VocoderResult, pass it to take_audio. Keyword arguments go to postprocess_segment_"""
+        in_name = self._vocoder_inputs.acquire()
+        in_ref = self._vocoder_inputs.write(in_name, spectrogram)
+        out_name = self._waves.acquire()
+        try:
+            future = self._submit(self._waves, out_name, _vocoder_task, index, in_ref, out_name,
+                                  num_griffin_lim_iters, postprocess)
+        except Exception:
+            self._vocoder_inputs.release(in_name)
+            raise
+        future.add_done_callback(lambda _: self._vocoder_inputs.release(in_name))
+        return future
+
+    def take_audio(self, result: VocoderResult) -> AudioBuffer:
+        return AudioBuffer(self._waves.take(result.wave), self.sample_rate)
+
+    def _submit(self, out_pool: SharedArrayPool, out_name: str, func: Any, *args: Any) -> Future:
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            out_pool.release(out_name)
+            raise
+        # a failed task never hands its output block to the next stage, so it comes back here
+        future.add_done_callback(lambda f: out_pool.release(out_name)
+                                 if f.cancelled() or f.exception() is not None else None)
+        return future
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        for pool in (self._spectrograms, self._vocoder_inputs, self._waves):
+            pool.close()
@@ -0,0 +1,117 @@
+import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass
+
+from src.data.pipeline import StageRun
+from src.constants import INFERENCE_STEPS, DENOISING_STRENGTH, SEGMENT_LEN_S, QUALITY_HIGH_WATER, \
+    QUALITY_LOW_WATER, QUALITY_WINDOW
+
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class QualityLevel:
+    name: str
+    use_diffusion: bool
+    inference_steps: int
+    denoising_strength: float
+    num_griffin_lim_iters: int
+
+
+# from best to cheapest, img2img runs about inference_steps * denoising_strength denoising steps.
+# The inverse mel scale is the cached pseudo-inverse, a single projection with no iterations to cut
+QUALITY_LEVELS = (
+    QualityLevel('full', True, INFERENCE_STEPS, DENOISING_STRENGTH, 32),
+    QualityLevel('reduced', True, 10, 0.55, 24),
+    QualityLevel('low', True, 6, 0.45, 16),
+    QualityLevel('no diffusion', False, 6, 0.45, 16),
+    QualityLevel('minimal', False, 6, 0.45, 8),
+)
+
+
+@dataclass
+class QualityChange:
+    index: int  # segment after which the change was made
+    old: str
+    new: str
+    reason: str
+
+
+class AdaptiveQualityController:
+    """
+    Holds the pipeline to the real-time budget of one segment per segment length.
+    Stages run side by side, so throughput is set by the slowest one: once its recent time per segment
+    exceeds high_water * budget_s, or a live deadline was missed, quality steps down one level,
+    and while it stays below low_water * budget_s it steps back up. After every change the
+    controller waits for `window` fresh measurements. A level that was too slow is only retried
+    after retry_after segments, otherwise bypassing diffusion would be undone as soon as it helped.
+    """
+
+    def __init__(self, budget_s: float = SEGMENT_LEN_S, levels: tuple[QualityLevel, ...] = QUALITY_LEVELS,
+                 high_water: float = QUALITY_HIGH_WATER, low_water: float = QUALITY_LOW_WATER,
+                 window: int = QUALITY_WINDOW, start_level: int = 0, retry_after: int = 10 * QUALITY_WINDOW):
+        assert 0 < low_water < high_water, "low_water must be positive and below high_water"
+        self.budget_s = budget_s
+        self.levels = levels
+        self.high_water = high_water
+        self.low_water = low_water
+        self.window = window
+        self.retry_after = retry_after
+        self.changes = []
+        self._level = start_level
+        self._since_change = window
+        self._too_slow = {}  # level -> segment index at which it was left for being too slow
+        self._times = defaultdict(lambda: deque(maxlen=window))
+        self._lock = threading.Lock()
+
+    @property
+    def level(self) -> QualityLevel:
+        return self.levels[self._level]
+
+    def observe(self, run: StageRun) -> None:
+        """Pipeline observer, records the time per segment of every stage call"""
+        with self._lock:
+            self._times[run.stage].append(run.wall_s_per_item)
+
+    def bottleneck(self) -> tuple[Optional[str], float]:
+        """Slowest stage over the last window, None until every stage has a full window"""
+        with self._lock:
+            if not self._times or any(len(t) < self.window for t in self._times.values()):
+                return None, 0.
+            means = {stage: sum(t) / len(t) for stage, t in self._times.items()}
+        stage = max(means, key=means.get)
+        return stage, means[stage]
+
+    def update(self, index: int, missed_deadline: bool = False) -> QualityLevel:
+        """Called once segment `index` is finished, returns the level for the segments to come"""
+        self._since_change += 1
+        if self._since_change < self.window:
+            # segments already in flight were produced at the previous level
+            return self.level
+        stage, seconds = self.bottleneck()
+        can_step_down = self._level < len(self.levels) - 1
+        if missed_deadline and can_step_down:
+            self._too_slow[self._level] = index
+            self._change(index, self._level + 1, f'segment {index + 1} missed its deadline')
+        elif stage is None:
+            pass
+        elif seconds > self.high_water * self.budget_s and can_step_down:
+            self._too_slow[self._level] = index
+            self._change(index, self._level + 1,
+                         f"'{stage}' takes {seconds:.2f} s per segment, over {self.high_water:.0%} "
+                         f"of the {self.budget_s:.2f} s budget")
+        elif seconds < self.low_water * self.budget_s and self._level > 0 \
+                and index - self._too_slow.get(self._level - 1, -self.retry_after) >= self.retry_after:
+            self._change(index, self._level - 1,
+                         f"slowest stage '{stage}' takes {seconds:.2f} s per segment, under {self.low_water:.0%} "
+                         f"of the {self.budget_s:.2f} s budget")
+        return self.level
+
+    def _change(self, index: int, new_level: int, reason: str) -> None:
+        change = QualityChange(index, self.level.name, self.levels[new_level].name, reason)
+        self.changes.append(change)
+        print(f"Quality {change.old} -> {change.new} after segment {index + 1}: {reason}")
+        with self._lock:
+            self._level = new_level
+            self._since_change = 0
+            self._times.clear()
@@ -1,16 +1,22 @@
+import os
 import threading
+import weakref
 import torch
 from PIL import Image
 from diffusers import StableDiffusionImg2ImgPipeline
 
-from src.constants import RIFFUSION_CHECKPOINT, SCHEDULER_OPTIONS, SEED
+from src.constants import RIFFUSION_CHECKPOINT, SCHEDULER_OPTIONS, SEED, RIFFUSION_MAX_BATCH, \
+    RIFFUSION_BYTES_PER_IMAGE, RIFFUSION_MEMORY_FRACTION, RIFFUSION_MODEL_PARAMS
 
 from typing import Optional, Any, Callable
 
+_PIPELINE_LOCK = threading.Lock()
+_prompt_embeds_cache = {}  # id(pipeline) -> {(prompt, negative_prompt): (prompt_embeds, negative_prompt_embeds)}
+
 
 def pipeline_lock() -> threading.Lock:
     """Singleton lock used to prevent concurrent access to any model pipeline."""
-    return threading.Lock()
+    return _PIPELINE_LOCK
 
 
 def get_scheduler(scheduler: str, config: Any) -> Any:
@@ -47,6 +53,43 @@ def nsfw_disabler(images, **kwargs):
     return images, False
 
 
+def get_pipeline_dtype(device: str, dtype: torch.dtype = torch.float16) -> torch.dtype:
+    """float16 is unsupported on the CPU and MPS, pipelines fall back to float32 there"""
+    if device == "cpu" or device.lower().startswith("mps"):
+        return torch.float32
+    return dtype
+
+
+def estimate_img2img_pipeline_bytes(device: str = "cuda", dtype: torch.dtype = torch.float16) -> float:
+    """Size the pipeline will have once loaded, for making room before loading it"""
+    return RIFFUSION_MODEL_PARAMS * torch.finfo(get_pipeline_dtype(device, dtype)).bits / 8
+
+
+def describe_img2img_pipeline(pipeline: StableDiffusionImg2ImgPipeline) -> dict[str, str]:
+    """Settings of a loaded pipeline that change its outputs, read from the pipeline itself"""
+    return {
+        'checkpoint': pipeline.config._name_or_path,
+        'scheduler': type(pipeline.scheduler).__name__,
+        'dtype': str(pipeline.dtype),
+        'device': pipeline.device.type,
+    }
+
+
+def describe_img2img_pipeline_settings(
+    checkpoint: str = RIFFUSION_CHECKPOINT,
+    device: str = "cuda",
+    dtype: torch.dtype = torch.float16,
+    scheduler: str = SCHEDULER_OPTIONS[0],
+) -> dict[str, str]:
+    """What describe_img2img_pipeline returns for the pipeline load_stable_diffusion_img2img_pipeline would load"""
+    return {
+        'checkpoint': checkpoint,
+        'scheduler': scheduler,
+        'dtype': str(get_pipeline_dtype(device, dtype)),
+        'device': torch.device(device).type,
+    }
+
+
 def load_stable_diffusion_img2img_pipeline(
     checkpoint: str = RIFFUSION_CHECKPOINT,
     device: str = "cuda",
@@ -57,7 +100,7 @@ def load_stable_diffusion_img2img_pipeline(
     Load the image to image pipeline.
     TODO(hayk): Merge this into RiffusionPipeline to just load one model.
     """
-    if device == "cpu" or device.lower().startswith("mps"):
+    if get_pipeline_dtype(device, dtype) != dtype:
         print(f"WARNING: Falling back to float32 on {device}, float16 is unsupported")
         dtype = torch.float32
 
@@ -78,6 +121,39 @@ def get_generator(seed: int, device: str) -> torch.Generator:
     return generator
 
 
+def get_prompt_embeddings(
+    pipeline: StableDiffusionImg2ImgPipeline,
+    prompt: str,
+    negative_prompt: Optional[str] = None,
+    batch_size: int = 1,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    CLIP embeddings of the prompt pair, encoded once per pipeline and repeated for batches.
+    Must be called while holding pipeline_lock().
+    """
+    pipeline_id = id(pipeline)
+    if pipeline_id not in _prompt_embeds_cache:
+        _prompt_embeds_cache[pipeline_id] = {}
+        weakref.finalize(pipeline, _prompt_embeds_cache.pop, pipeline_id, None)
+    cache = _prompt_embeds_cache[pipeline_id]
+
+    key = (prompt, negative_prompt or None)
+    if key not in cache:
+        with torch.no_grad():
+            cache[key] = pipeline.encode_prompt(
+                prompt,
+                device=pipeline.device,
+                num_images_per_prompt=1,
+                do_classifier_free_guidance=True,
+                negative_prompt=negative_prompt or None,
+            )
+    prompt_embeds, negative_prompt_embeds = cache[key]
+    if batch_size > 1:
+        prompt_embeds = prompt_embeds.repeat(batch_size, 1, 1)
+        negative_prompt_embeds = negative_prompt_embeds.repeat(batch_size, 1, 1)
+    return prompt_embeds, negative_prompt_embeds
+
+
 def run_img2img(
     pipeline: StableDiffusionImg2ImgPipeline,
     prompt: str,
@@ -96,16 +172,78 @@ def run_img2img(
 
     generator = get_generator(SEED, device)
     with pipeline_lock():
+        prompt_embeds, negative_prompt_embeds = get_prompt_embeddings(pipeline, prompt, negative_prompt)
         result = pipeline(
-            prompt=prompt,
+            prompt_embeds=prompt_embeds,
             image=init_image,
             strength=denoising_strength,
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
-            negative_prompt=negative_prompt or None,
+            negative_prompt_embeds=negative_prompt_embeds,
             num_images_per_prompt=1,
             generator=generator,
             callback=callback,
             callback_steps=1,
         )
         return result.images[0]
+
+
+def get_available_memory(device: str) -> Optional[int]:
+    """Free bytes on the device, None if it cannot be determined"""
+    if device.lower().startswith("cuda") and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info(torch.device(device))
+        return free
+    # CPU and MPS (unified memory) draw from system RAM
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def choose_img2img_batch_size(device: str, max_batch: int = RIFFUSION_MAX_BATCH,
+                              bytes_per_image: float = RIFFUSION_BYTES_PER_IMAGE, reserved_bytes: float = 0) -> int:
+    """
+    Largest batch that fits into the currently free memory of the device.
+    reserved_bytes is memory that is still free now but taken before the batches run,
+    e.g. estimate_img2img_pipeline_bytes() while the pipeline is not loaded yet.
+    """
+    available = get_available_memory(device)
+    if available is None:
+        return 1
+    available = max(available - reserved_bytes, 0)
+    return int(max(1, min(max_batch, available * RIFFUSION_MEMORY_FRACTION // bytes_per_image)))
+
+
+def run_img2img_batch(
+    pipeline: StableDiffusionImg2ImgPipeline,
+    prompt: str,
+    init_images: list[Image.Image],
+    denoising_strength: float,
+    num_inference_steps: int,
+    guidance_scale: float,
+    negative_prompt: Optional[str] = None,
+    seeds: Optional[list[int]] = None,
+    device: str = 'cuda'
+) -> list[Image.Image]:
+    """
+    Same as run_img2img for several init images in one pipeline call.
+    Every image gets its own generator, by default seeded with SEED, so each output
+    matches what run_img2img would produce for that image alone.
+    """
+    seeds = [SEED] * len(init_images) if seeds is None else seeds
+    assert len(seeds) == len(init_images), "need one seed per init image"
+    generators = [get_generator(seed, device) for seed in seeds]
+    with pipeline_lock():
+        prompt_embeds, negative_prompt_embeds = get_prompt_embeddings(pipeline, prompt, negative_prompt,
+                                                                      batch_size=len(init_images))
+        result = pipeline(
+            prompt_embeds=prompt_embeds,
+            image=init_images,
+            strength=denoising_strength,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            negative_prompt_embeds=negative_prompt_embeds,
+            num_images_per_prompt=1,
+            generator=generators,
+        )
+        return result.images
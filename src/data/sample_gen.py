@@ -2,23 +2,50 @@ import librosa as li
 import numpy as np
 from pandas import read_csv
 
-from src.constants import SAMPLE_RATE, SEGMENT_LEN_S, AUDIO_SAMPLE_RATE, SAMPLE_EEG_PATH
+from src.constants import SAMPLE_RATE, SEGMENT_LEN_S, AUDIO_SAMPLE_RATE, SAMPLE_EEG_PATH, EEG_READ_CHUNK_S
 from src.data.utils import segment_eeg
+from src.data.eeg_cache import open_eeg_recording
+
+from typing import Iterator
 
 
 def get_sample_eeg_segment() -> np.ndarray:
     datapath = SAMPLE_EEG_PATH
-    data = read_csv(datapath).to_numpy()[:SAMPLE_RATE * SEGMENT_LEN_S, :8]
+    recording = open_eeg_recording(datapath)
+    data = recording.window(0, SAMPLE_RATE * SEGMENT_LEN_S, n_channels=8)
     return data
 
 
 def get_offline_eeg_segments() -> list[np.ndarray]:
     datapath = SAMPLE_EEG_PATH
-    data = read_csv(datapath).to_numpy()[:, :2]
+    data = open_eeg_recording(datapath).samples(n_channels=2)
     segments = segment_eeg(data, sample_rate=SAMPLE_RATE, segment_len_s=SEGMENT_LEN_S, overlap_s=0)
     return segments
 
 
+def iter_eeg_chunks(datapath: str = SAMPLE_EEG_PATH, n_channels: int = 2,
+                    chunk_len_s: float = EEG_READ_CHUNK_S) -> Iterator[np.ndarray]:
+    """Parse an EEG CSV piece by piece, yielding arrays of shape (signal, channels)"""
+    chunk_len = max(round(SAMPLE_RATE * chunk_len_s), 1)
+    with read_csv(datapath, usecols=range(n_channels), chunksize=chunk_len) as reader:
+        for chunk in reader:
+            yield chunk.to_numpy()
+
+
+def iter_offline_eeg_segments(datapath: str = SAMPLE_EEG_PATH, n_channels: int = 2,
+                              overlap_s: float = 0) -> Iterator[np.ndarray]:
+    """
+    Lazy counterpart of get_offline_eeg_segments, (signal, channels) views into the memory-mapped copy of
+    the recording: the CSV is only parsed when the copy is missing or stale, and no samples are copied
+    """
+    recording = open_eeg_recording(datapath)
+    sample_len = round(SAMPLE_RATE * SEGMENT_LEN_S)
+    overlap_len = round(SAMPLE_RATE * overlap_s)
+    assert sample_len > overlap_len >= 0, "overlap_s must be non-negative and shorter than a segment"
+    for start in range(0, recording.n_samples - sample_len + 1, sample_len - overlap_len):
+        yield recording.window(start, start + sample_len, n_channels=n_channels)
+
+
 def get_sample_audio_wave() -> tuple[np.ndarray, float]:
     return li.load('../../samples/sample_music.wav')
 
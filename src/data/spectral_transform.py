@@ -4,10 +4,13 @@ import skimage
 
 from src.data.utils import resize_image, normalize_spectrogram_with_max_power, normalize_spectrogram
 from src.data.sample_gen import generate_sample_wave
-from src.constants import SPECTROGRAM_WIDTH, SPECTROGRAM_HEIGHT, SPECTROGRAM_SHIFT, NOTE_MASK, MEL_NOTES
-from src.data.ai_models import run_rave, run_riffusion
+from src.constants import SPECTROGRAM_WIDTH, SPECTROGRAM_HEIGHT, SPECTROGRAM_SHIFT, NOTE_MASK, MEL_NOTES, \
+    TEXT_PROMPT, TEXT_NEGATIVE_PROMPT, DENOISING_STRENGTH, INFERENCE_STEPS
+from src.data.ai_models import run_rave, run_riffusion, run_riffusion_batch
+from src.data.model_registry import LazyModel
+from src.data.diffusion_cache import DiffusionCache
 
-from typing import Optional
+from typing import Optional, Union
 
 
 def combine_spectrograms(spectrograms: list[np.ndarray]) -> np.ndarray:
@@ -19,13 +22,45 @@ def combine_spectrograms(spectrograms: list[np.ndarray]) -> np.ndarray:
 
 
 def transform_spectrogram(spectrogram: np.ndarray,
-                          riffusion_model: Optional[StableDiffusionImg2ImgPipeline] = None,
-                          measure_difference: bool = True) -> np.ndarray:
-    """Apply algorithms over the whole spectrogram"""
-    transformed = np.roll(spectrogram, shift=SPECTROGRAM_SHIFT, axis=0)
-    transformed = filter_spectrogram(transformed)
+                          riffusion_model: Optional[Union[StableDiffusionImg2ImgPipeline, LazyModel]] = None,
+                          measure_difference: bool = True,
+                          diffusion_cache: Optional[DiffusionCache] = None,
+                          prompt: str = TEXT_PROMPT, negative_prompt: str = TEXT_NEGATIVE_PROMPT,
+                          strength: float = DENOISING_STRENGTH, steps: int = INFERENCE_STEPS,
+                          prepared: Optional[np.ndarray] = None) -> np.ndarray:
+    """Apply algorithms over the whole spectrogram, prepared skips prepare_spectrogram when already done"""
+    transformed = prepare_spectrogram(spectrogram) if prepared is None else prepared
     if riffusion_model is not None:
-        transformed = run_riffusion(spectrogram=transformed, riffusion_model=riffusion_model)
+        transformed = run_riffusion(spectrogram=transformed, riffusion_model=riffusion_model, cache=diffusion_cache,
+                                    prompt=prompt, negative_prompt=negative_prompt, strength=strength, steps=steps)
+    return finish_spectrogram(spectrogram, transformed, measure_difference=measure_difference)
+
+
+def transform_spectrograms(spectrograms: list[np.ndarray],
+                           riffusion_model: Optional[Union[StableDiffusionImg2ImgPipeline, LazyModel]] = None,
+                           measure_difference: bool = True,
+                           diffusion_cache: Optional[DiffusionCache] = None,
+                           prompt: str = TEXT_PROMPT, negative_prompt: str = TEXT_NEGATIVE_PROMPT,
+                           strength: float = DENOISING_STRENGTH, steps: int = INFERENCE_STEPS,
+                           prepared: Optional[list[np.ndarray]] = None) -> list[np.ndarray]:
+    """transform_spectrogram for a batch, the Riffusion step runs as one batched call"""
+    transformed = [prepare_spectrogram(s) for s in spectrograms] if prepared is None else list(prepared)
+    if riffusion_model is not None:
+        transformed = run_riffusion_batch(spectrograms=transformed, riffusion_model=riffusion_model,
+                                          cache=diffusion_cache, prompt=prompt, negative_prompt=negative_prompt,
+                                          strength=strength, steps=steps)
+    return [finish_spectrogram(s, t, measure_difference=measure_difference)
+            for s, t in zip(spectrograms, transformed)]
+
+
+def prepare_spectrogram(spectrogram: np.ndarray) -> np.ndarray:
+    """Steps before the Riffusion model"""
+    transformed = np.roll(spectrogram, shift=SPECTROGRAM_SHIFT, axis=0)
+    return filter_spectrogram(transformed)
+
+
+def finish_spectrogram(spectrogram: np.ndarray, transformed: np.ndarray, measure_difference: bool = True) -> np.ndarray:
+    """Steps after the Riffusion model"""
     transformed = normalize_spectrogram_with_max_power(transformed, with_power=True)
     if measure_difference:
         diff = measure_diff_between_spectrograms(spectrogram, transformed)
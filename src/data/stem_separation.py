@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from demucs import pretrained
+from demucs.apply import apply_model
+from demucs.audio import convert_audio
+
+from src.constants import (DEMUCS_MODEL, DEMUCS_MAX_BYTES, DEMUCS_SEGMENT_BYTES, DEMUCS_BYTES_PER_SAMPLE,
+                           DEMUCS_OVERLAP_S, STEM_CACHE_FOLDER, STEM_CACHE_MAX_BYTES)
+from src.data.model_registry import get_model
+
+from typing import Any, Callable, Optional, Sequence, Union
+
+
+@dataclass
+class Stems:
+    sources: list[str]
+    audio: np.ndarray  # (stems, channels, samples), memory-mapped when it comes from the cache
+    sample_rate: int
+
+    def remix(self, sources: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Sum of the chosen stems, all of them for None, (channels, samples)"""
+        names = self.sources if sources is None else list(sources)
+        unknown = set(names) - set(self.sources)
+        if unknown:
+            raise ValueError(f'Unknown stems {sorted(unknown)}, the model separates {self.sources}')
+        mix = np.zeros(self.audio.shape[1:], dtype=np.float32)
+        for name in names:
+            mix += self.audio[self.sources.index(name)]  # stem by stem, a memory-mapped entry is never read at once
+        return mix
+
+
+class StemCache:
+    """
+    Persistent store of separated stems, keyed by the hash of the input audio and the model name.
+    Entries are .npy files, opened memory-mapped, next to a JSON file with the stem names and sample rate;
+    least recently used entries are removed once the folder grows beyond max_bytes.
+    """
+
+    def __init__(self, folder: str = STEM_CACHE_FOLDER, max_bytes: float = STEM_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def make_key(wav: np.ndarray, sample_rate: int, model_name: str) -> str:
+        wav = np.ascontiguousarray(wav, dtype=np.float32)
+        digest = hashlib.sha256()
+        digest.update(f'{wav.shape}:{sample_rate}:{model_name}'.encode('utf-8'))
+        digest.update(wav.tobytes())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.folder, f'{key}.npy')
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.folder, f'{key}.json')
+
+    def _load(self, key: str) -> Stems:
+        with open(self._meta_path(key)) as f:
+            meta = json.load(f)
+        audio = np.load(self._path(key), mmap_mode='r')
+        return Stems(meta['sources'], audio, meta['sample_rate'])
+
+    def get(self, key: str) -> Optional[Stems]:
+        try:
+            stems = self._load(key)
+            os.utime(self._path(key))  # mark as recently used
+        except (FileNotFoundError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return stems
+
+    def put(self, key: str, sources: Sequence[str], sample_rate: int, shape: tuple[int, int, int],
+            fill: Callable[[np.ndarray], Any]) -> Stems:
+        """
+        Let fill write the stems straight into a memory-mapped file of the given shape and store it as an entry.
+        The array is written under a temporary name first, so readers never see a partial entry.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        os.close(fd)
+        try:
+            audio = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+            fill(audio)
+            audio.flush()
+            del audio
+            with open(self._meta_path(key), 'w') as f:
+                json.dump({'sources': list(sources), 'sample_rate': sample_rate}, f)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        stems = self._load(key)
+        self.evict()
+        return stems
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the cache fits into max_bytes"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for stale in (path, path[:-len('.npy')] + '.json'):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.}
+
+
+def load_demucs(model_name: str = DEMUCS_MODEL, device: Optional[torch.device] = None) -> Any:
+    """Pretrained Demucs model, loaded once per process and device"""
+    device = device or torch.device('cpu')
+    return get_model(f'demucs-{model_name}@{device}', lambda: pretrained.get_model(model_name).to(device).eval())
+
+
+def chunk_samples(max_bytes: float = DEMUCS_MAX_BYTES) -> int:
+    """Longest chunk, in samples, whose separation stays within max_bytes"""
+    samples = int((max_bytes - DEMUCS_SEGMENT_BYTES) / DEMUCS_BYTES_PER_SAMPLE)
+    if samples <= 0:
+        raise ValueError(f'max_bytes has to exceed the {DEMUCS_SEGMENT_BYTES / 1e9:.1f} GB of a single Demucs segment')
+    return samples
+
+
+def chunk_bounds(length: int, chunk: int, overlap: int) -> list[tuple[int, int]]:
+    """Start and end of the chunks covering length samples, neighbouring chunks share exactly overlap samples"""
+    if length <= chunk:
+        return [(0, length)]
+    return [(start, min(start + chunk, length)) for start in range(0, length - overlap, chunk - overlap)]
+
+
+def separate_chunked(model: Any, wav: torch.Tensor, out: Optional[np.ndarray] = None,
+                     max_bytes: float = DEMUCS_MAX_BYTES, overlap_s: float = DEMUCS_OVERLAP_S,
+                     device: Optional[torch.device] = None) -> np.ndarray:
+    """
+    Stems of wav, (channels, samples) at the sample rate and channel count of the model, written into out.
+    The track is separated in chunks of at most max_bytes working memory that are crossfaded linearly over
+    overlap_s seconds, so memory stays flat however long the track is. The chunks are kept on the CPU and
+    only their Demucs segments move to device. out may be memory-mapped, (stems, channels, samples).
+    """
+    wav = wav.cpu()
+    channels, length = wav.shape
+    chunk = chunk_samples(max_bytes)
+    overlap = int(overlap_s * model.samplerate)
+    if chunk <= 2 * overlap:
+        raise ValueError(f'max_bytes allows chunks of {chunk / model.samplerate:.1f} s, '
+                         f'that is too short for an overlap of {overlap_s} s')
+    if out is None:
+        out = np.zeros((len(model.sources), channels, length), dtype=np.float32)
+    fade_in = np.linspace(0, 1, overlap + 2, dtype=np.float32)[1:-1]  # fade_in + fade_out == 1 in every sample
+    fade_out = fade_in[::-1]
+    with torch.no_grad():
+        for start, end in chunk_bounds(length, chunk, overlap):
+            stems = apply_model(model, wav[None, :, start:end], device=device)[0].numpy()
+            if start > 0:
+                stems[..., :overlap] *= fade_in
+            if end < length:
+                stems[..., -overlap:] *= fade_out
+            out[..., start:end] += stems
+    return out
+
+
+def separate_stems(wav: Union[np.ndarray, torch.Tensor], sample_rate: int, model_name: str = DEMUCS_MODEL,
+                   device: Optional[torch.device] = None, max_bytes: float = DEMUCS_MAX_BYTES,
+                   overlap_s: float = DEMUCS_OVERLAP_S, cache: Optional[StemCache] = None) -> Stems:
+    """
+    Stems of wav, (channels, samples) or (samples,) at sample_rate, separated by the Demucs model model_name
+    with separate_chunked. With a cache the stems are written straight into it, and audio that was separated
+    before with the same model is read back without loading the model at all.
+    """
+    wav = torch.as_tensor(wav, dtype=torch.float32).cpu()
+    if wav.dim() == 1:
+        wav = wav[None]
+    key = None
+    if cache is not None:
+        key = StemCache.make_key(wav.numpy(), sample_rate, model_name)
+        stems = cache.get(key)
+        if stems is not None:
+            return stems
+
+    model = load_demucs(model_name, device)
+    wav = convert_audio(wav, sample_rate, model.samplerate, model.audio_channels)
+
+    def separate(out: Optional[np.ndarray] = None) -> np.ndarray:
+        return separate_chunked(model, wav, out, max_bytes=max_bytes, overlap_s=overlap_s, device=device)
+
+    if cache is None:
+        return Stems(list(model.sources), separate(), model.samplerate)
+    shape = (len(model.sources), model.audio_channels, wav.shape[-1])
+    return cache.put(key, model.sources, model.samplerate, shape, separate)
+
+
+def remix(wav: Union[np.ndarray, torch.Tensor], sample_rate: int, sources: Optional[Sequence[str]] = None,
+          **separation: Any) -> tuple[torch.Tensor, int]:
+    """
+    The chosen stems of wav mixed back together and their sample rate, sources=None keeps all of them.
+    Demucs stems add up to the track they were separated from, so keeping all of them bypasses the separation
+    and returns wav as it is; only a selection runs separate_stems, with separation as its keyword arguments.
+    """
+    if sources is None:
+        return torch.as_tensor(wav), sample_rate
+    stems = separate_stems(wav, sample_rate, **separation)
+    return torch.from_numpy(stems.remix(sources)), stems.sample_rate
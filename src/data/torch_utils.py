@@ -1,3 +1,4 @@
+import time
 from dataclasses import dataclass
 import numpy as np
 import torch
@@ -5,7 +6,9 @@ import torchaudio
 import pydub
 
 from src.constants import AUDIO_SAMPLE_RATE, MIN_AUDIO_FREQUENCY, MAX_AUDIO_FREQUENCY, SPECTROGRAM_HEIGHT
-from src.data.utils import produce_audio_from_wave, postprocess_wave
+from src.data.utils import postprocess_wave
+from src.data.audio_buffer import AudioBuffer
+from src.data.metrics import record_stage
 
 from typing import Optional
 
@@ -51,6 +54,115 @@ def slerp(t: float, v0: torch.Tensor, v1: torch.Tensor, dot_threshold: float = 0
     return v2
 
 
+@dataclass
+class GriffinLimResult:
+    waveform: torch.Tensor
+    phase: torch.Tensor  # final phase estimate of every frame, (..., freq, frames)
+    n_iter: int  # iterations actually run
+    spectral_convergence: float  # ||S - |STFT(x)||| / ||S|| of the phase the waveform was built from
+
+
+def propagate_phase(last_phase: torch.Tensor, n_frames: int, n_fft: int, hop_length: int) -> torch.Tensor:
+    """
+    Continue the phase of the frames preceding a segment over its first n_frames, phase vocoder style.
+    last_phase holds the two final frames (..., freq, 2), their difference gives the instantaneous frequency of every bin.
+    istft returns hop_length * (frames - 1) samples per segment, so frame 0 of a segment is centred on the same
+    sample as the last frame of the previous one and keeps its phase, later frames advance by one hop each.
+    """
+    n_freqs = last_phase.shape[-2]
+    expected = 2 * np.pi * hop_length / n_fft * torch.arange(n_freqs, device=last_phase.device)
+    deviation = last_phase[..., 1] - last_phase[..., 0] - expected
+    deviation = torch.remainder(deviation + np.pi, 2 * np.pi) - np.pi
+    advance = expected + deviation
+    steps = torch.arange(0, n_frames, device=last_phase.device)
+    return last_phase[..., 1].unsqueeze(-1) + advance.unsqueeze(-1) * steps
+
+
+def griffin_lim(
+    specgram: torch.Tensor,
+    n_fft: int,
+    hop_length: int,
+    win_length: int,
+    window: torch.Tensor,
+    n_iter: int,
+    momentum: float = 0.99,
+    init_phase: Optional[torch.Tensor] = None,
+    tolerance: float = 0.,
+    patience: int = 2,
+) -> GriffinLimResult:
+    """
+    Same algorithm as torchaudio.functional.griffinlim for a magnitude spectrogram (..., freq, frames), plus
+    - init_phase: starting phase instead of a random one, e.g. from propagate_phase
+    - tolerance: stop once the best spectral convergence has not improved by this relative amount
+      for `patience` consecutive iterations (0 always runs n_iter iterations)
+    The waveform is built from the phase with the lowest spectral convergence seen, not the last one.
+    """
+    momentum = momentum / (1 + momentum)
+    if init_phase is None:
+        angles = torch.rand(specgram.size(), dtype=torch.complex64, device=specgram.device)
+    else:
+        angles = torch.polar(torch.ones_like(init_phase), init_phase).to(torch.complex64)
+
+    specgram_norm = torch.linalg.vector_norm(specgram).clamp(min=1e-16)
+    tprev = torch.tensor(0.0, dtype=specgram.dtype, device=specgram.device)
+    convergence = best = lowest = float('inf')
+    best_angles = angles
+    stalled = 0
+    iterations = 0
+    for iterations in range(1, n_iter + 1):
+        inverse = torch.istft(specgram * angles, n_fft=n_fft, hop_length=hop_length, win_length=win_length,
+                              window=window)
+        rebuilt = torch.stft(inverse, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window=window,
+                             center=True, pad_mode="reflect", normalized=False, onesided=True, return_complex=True)
+        # convergence of the phase this iteration started from
+        convergence = (torch.linalg.vector_norm(specgram - rebuilt.abs()) / specgram_norm).item()
+        if convergence < lowest:
+            lowest, best_angles = convergence, angles
+        angles = rebuilt
+        if momentum:
+            angles = angles - tprev.mul_(momentum)
+        angles = angles.div(angles.abs().add(1e-16))
+        tprev = rebuilt
+
+        if tolerance > 0:
+            if convergence < best * (1 - tolerance):
+                best, stalled = convergence, 0
+            else:
+                best, stalled = min(best, convergence), stalled + 1
+            if stalled >= patience:
+                break
+
+    waveform = torch.istft(specgram * best_angles, n_fft=n_fft, hop_length=hop_length, win_length=win_length,
+                           window=window)
+    return GriffinLimResult(waveform, torch.angle(best_angles), iterations, lowest)
+
+
+_inverse_mel_cache = {}
+
+
+def get_inverse_mel_matrix(params: 'SpectrogramParams', device: str) -> torch.Tensor:
+    """
+    Pseudo-inverse of the mel filter bank, shape (n_stft, n_mels), computed once per parameter set and device.
+    Replaces the per-call optimisation of InverseMelScale with one matmul.
+    """
+    key = (params.n_fft, params.num_frequencies, params.sample_rate, params.min_frequency, params.max_frequency,
+           params.mel_scale_norm, params.mel_scale_type, str(device))
+    matrix = _inverse_mel_cache.get(key)
+    if matrix is None:
+        fb = torchaudio.functional.melscale_fbanks(
+            n_freqs=params.n_fft // 2 + 1,
+            f_min=params.min_frequency,
+            f_max=params.max_frequency,
+            n_mels=params.num_frequencies,
+            sample_rate=params.sample_rate,
+            norm=params.mel_scale_norm,
+            mel_scale=params.mel_scale_type,
+        )
+        matrix = torch.linalg.pinv(fb.T.double()).float().to(device)
+        _inverse_mel_cache[key] = matrix
+    return matrix
+
+
 @dataclass(frozen=False)
 class SpectrogramParams:
 
@@ -67,9 +179,14 @@ class SpectrogramParams:
     mel_scale_norm: Optional[str] = None
     mel_scale_type: str = "htk"
     max_mel_iters: int = 200
+    inverse_mel_backend: str = "sgd"  # "sgd": torchaudio InverseMelScale, "pinv": cached pseudo-inverse projection
 
     # Griffin Lim parameters
     num_griffin_lim_iters: int = 32
+    griffin_lim_warm_start: bool = False  # seed the first frames from the phase the previous segment ended with
+    griffin_lim_warm_frames: int = 16
+    griffin_lim_tolerance: float = 0.  # > 0 stops once spectral convergence improves by less than this
+    griffin_lim_patience: int = 2
 
     # Image parameterization
     power_for_image: float = 0.25
@@ -87,6 +204,19 @@ class SpectrogramParams:
         return int(self.step_size_ms / 1000.0 * self.sample_rate)
 
 
+def get_pipeline_spectrogram_params(warm_start_griffin_lim: bool = True, carry_phase: bool = True) -> SpectrogramParams:
+    """
+    Vocoder settings of generate_audio_from_segments, so benchmarks measure what the pipeline runs.
+    Warm start needs the segments in order in one converter, carry_phase=False leaves only the early stop.
+    """
+    return SpectrogramParams(
+        inverse_mel_backend="pinv",
+        griffin_lim_warm_start=warm_start_griffin_lim and carry_phase,
+        # about 9 iterations instead of 32 per segment, for a spectral convergence within 5% and quieter joins
+        griffin_lim_tolerance=1e-2 if warm_start_griffin_lim else 0.,
+    )
+
+
 class SpectrogramConverter:
     def __init__(self, params: Optional[SpectrogramParams] = None, device: str = "cuda"):
         if params is None:
@@ -121,6 +251,11 @@ class SpectrogramConverter:
             rand_init=True,
         ).to(self.device)
 
+        self.window = torch.hann_window(params.win_length, device=self.device)
+        self.last_phase = None  # phase of the last two frames of the previous segment
+        self.last_griffin_lim_iters = None
+        self.last_spectral_convergence = None
+
         self.mel_scaler = torchaudio.transforms.MelScale(
             n_mels=params.num_frequencies,
             sample_rate=params.sample_rate,
@@ -159,10 +294,31 @@ class SpectrogramConverter:
         waveform = self.waveform_from_amplitudes(amplitudes, use_mel)
         return waveform.cpu().numpy().squeeze()
 
-    def audio_from_spectrogram(self, spectrogram: np.ndarray, use_mel: bool = True) -> pydub.AudioSegment:
+    def buffer_from_spectrogram(self, spectrogram: np.ndarray, use_mel: bool = True) -> AudioBuffer:
         wave = self.wave_from_spectrogram(spectrogram, use_mel)
         wave = postprocess_wave(wave)
-        return produce_audio_from_wave(wave)
+        return AudioBuffer.from_wave(wave, self.p.sample_rate)
+
+    def audio_from_spectrogram(self, spectrogram: np.ndarray, use_mel: bool = True) -> pydub.AudioSegment:
+        return self.buffer_from_spectrogram(spectrogram, use_mel).to_pydub()
+
+    def waves_from_spectrograms(self, spectrograms: np.ndarray, use_mel: bool = True) -> np.ndarray:
+        """
+        Vocode a stack of consecutive spectrograms (N, mels, frames) with a single device copy and inverse mel
+        pass, returns waveforms of shape (N, samples). Griffin-Lim runs once for the stack, or segment by segment
+        with warm start (see reconstruct_phase)
+        """
+        assert spectrograms.ndim == 3, "spectrograms must be stacked as (N, mels, frames)"
+        amplitudes = torch.from_numpy(np.ascontiguousarray(spectrograms)).float().to(self.device)
+        waveforms = self.waveform_from_amplitudes(amplitudes, use_mel, batched=True)
+        return waveforms.cpu().numpy()
+
+    def buffers_from_spectrograms(self, spectrograms: np.ndarray, use_mel: bool = True) -> list[AudioBuffer]:
+        waves = self.waves_from_spectrograms(spectrograms, use_mel)
+        return [AudioBuffer.from_wave(postprocess_wave(wave), self.p.sample_rate) for wave in waves]
+
+    def audios_from_spectrograms(self, spectrograms: np.ndarray, use_mel: bool = True) -> list[pydub.AudioSegment]:
+        return [buffer.to_pydub() for buffer in self.buffers_from_spectrograms(spectrograms, use_mel)]
 
     def amplitudes_from_waveform(self, waveform: torch.Tensor, use_mel: bool = True) -> torch.Tensor:
         spectrogram_complex = self.spectrogram_func(waveform)
@@ -172,8 +328,109 @@ class SpectrogramConverter:
         else:
             return amplitudes
 
-    def waveform_from_amplitudes(self, amplitudes: torch.Tensor, use_mel: bool = True) -> torch.Tensor:
+    def waveform_from_amplitudes(self, amplitudes: torch.Tensor, use_mel: bool = True,
+                                 batched: bool = False) -> torch.Tensor:
         if use_mel:
+            with record_stage('inverse_mel'):
+                amplitudes = self.linear_from_mel(amplitudes)
+        with record_stage('griffin_lim'):
+            # spectrograms reach ~1e29 after SPECTROGRAM_POWER, where complex magnitudes overflow float32,
+            # Griffin-Lim is scale invariant, so it runs on unit peak amplitudes and the scale is restored after
+            scale = amplitudes.amax().clamp(min=1e-16)
+            amplitudes = amplitudes / scale
+            if not self.p.griffin_lim_warm_start and self.p.griffin_lim_tolerance <= 0:
+                return self.inverse_spectrogram_func(amplitudes) * scale
+            return self.reconstruct_phase(amplitudes, batched=batched) * scale
+
+    def linear_from_mel(self, amplitudes: torch.Tensor, backend: Optional[str] = None) -> torch.Tensor:
+        backend = self.p.inverse_mel_backend if backend is None else backend
+        if backend == "pinv":
+            # non-negative least-squares solutions are approximated by clipping the least-squares one
+            inverse = get_inverse_mel_matrix(self.p, self.device)
+            return torch.matmul(inverse, amplitudes).clamp_(min=0)
+        elif backend == "sgd":
             with torch.enable_grad():
-                amplitudes = self.inverse_mel_scaler(amplitudes)
-        return self.inverse_spectrogram_func(amplitudes)
+                return self.inverse_mel_scaler(amplitudes)
+        raise ValueError('inverse_mel_backend can only be "sgd" or "pinv"')
+
+    def reconstruct_phase(self, amplitudes: torch.Tensor, batched: bool = False) -> torch.Tensor:
+        """
+        Griffin-Lim with warm start and early stopping, consecutive calls must be consecutive segments.
+        With batched=True the first axis holds consecutive segments. Without warm start they are solved jointly,
+        with it one after another, every segment seeded from the phase the one before it ended with, so the
+        joins sound the same as with one call per segment. The iterations reported are then the most any
+        segment needed and the spectral convergence is their mean.
+        """
+        if batched and self.p.griffin_lim_warm_start:
+            waveforms, iterations, convergences = [], [], []
+            for segment in amplitudes:
+                waveforms.append(self.reconstruct_phase(segment))
+                iterations.append(self.last_griffin_lim_iters)
+                convergences.append(self.last_spectral_convergence)
+            self.last_griffin_lim_iters = max(iterations)
+            self.last_spectral_convergence = float(np.mean(convergences))
+            return torch.stack(waveforms)
+
+        last = (-1,) if batched else ()
+        init_phase = None
+        if self.p.griffin_lim_warm_start and self.last_phase is not None \
+                and self.last_phase.shape[:-1] == amplitudes.shape[:-1]:
+            # continuing the previous phase only at the boundary removes the click at the joint, while the rest
+            # of the segment starts from random phase, which converges better than propagating it all the way
+            init_phase = 2 * np.pi * torch.rand(amplitudes.shape, device=amplitudes.device)
+            n_warm = min(self.p.griffin_lim_warm_frames, amplitudes.shape[-1])
+            init_phase[..., :n_warm] = propagate_phase(self.last_phase, n_warm, self.p.n_fft, self.p.hop_length)
+        result = griffin_lim(
+            amplitudes,
+            n_fft=self.p.n_fft,
+            hop_length=self.p.hop_length,
+            win_length=self.p.win_length,
+            window=self.window,
+            n_iter=self.p.num_griffin_lim_iters,
+            init_phase=init_phase,
+            tolerance=self.p.griffin_lim_tolerance,
+            patience=self.p.griffin_lim_patience,
+        )
+        self.last_phase = result.phase[last + (..., slice(-2, None))] if result.phase.shape[-1] > 1 else None
+        self.last_griffin_lim_iters = result.n_iter
+        self.last_spectral_convergence = result.spectral_convergence
+        return result.waveform
+
+    def reset_phase(self) -> None:
+        """Forget the carried phase, e.g. before starting an unrelated recording"""
+        self.last_phase = None
+
+    def set_iterations(self, num_griffin_lim_iters: Optional[int] = None, max_mel_iters: Optional[int] = None) -> None:
+        """Change the iteration budgets between calls, the torchaudio transforms read them on every call"""
+        if num_griffin_lim_iters is not None:
+            self.p.num_griffin_lim_iters = num_griffin_lim_iters
+            self.inverse_spectrogram_func.n_iter = num_griffin_lim_iters
+        if max_mel_iters is not None:
+            self.p.max_mel_iters = max_mel_iters
+            self.inverse_mel_scaler.max_iter = max_mel_iters
+
+
+def benchmark_inverse_mel(converter: SpectrogramConverter, mel_amplitudes: torch.Tensor,
+                          n_runs: int = 3) -> dict[str, dict[str, float]]:
+    """Time per call of each inverse mel backend and how well the result maps back onto the mel input"""
+    results = {}
+    outputs = {}
+    mel_norm = torch.linalg.vector_norm(mel_amplitudes).item()
+    for backend in ("sgd", "pinv"):
+        start = time.perf_counter()
+        for _ in range(n_runs):
+            linear = converter.linear_from_mel(mel_amplitudes, backend=backend).detach()
+        elapsed = (time.perf_counter() - start) / n_runs
+        outputs[backend] = linear
+        mel_error = torch.linalg.vector_norm(converter.mel_scaler(linear) - mel_amplitudes).item() / mel_norm
+        results[backend] = {"time_s": elapsed, "mel_relative_error": mel_error}
+    difference = torch.linalg.vector_norm(outputs["pinv"] - outputs["sgd"]).item()
+    results["pinv"]["relative_difference_to_sgd"] = difference / torch.linalg.vector_norm(outputs["sgd"]).item()
+    return results
+
+
+if __name__ == "__main__":
+    converter = SpectrogramConverter(device="cpu")
+    mel = torch.rand(converter.p.num_frequencies, 512) ** 4
+    for backend, metrics in benchmark_inverse_mel(converter, mel).items():
+        print(backend, ", ".join(f"{k}={v:.4g}" for k, v in metrics.items()))
@@ -1,13 +1,15 @@
 import os
 import re
-from io import BytesIO
 import numpy as np
 import pydub
 from pydub import AudioSegment
 import librosa as li
-from scipy.io import wavfile
 import skimage
 
+from typing import Iterable, Iterator, Optional
+
+from src.data.audio_buffer import AudioBuffer
+from src.data.audio_writer import StreamingAudioWriter
 from src.constants import AUDIO_SAMPLE_RATE, SPECTROGRAM_MAX_VALUE, SPECTROGRAM_POWER, DESIRED_DB, CROSSFADE_SAVE_MS, \
     DEFAULT_SAVE_AUDIO_FOLDER, ANTISPIKE_THRESHOLD
 
@@ -32,6 +34,33 @@ def segment_eeg(eeg: np.ndarray, sample_rate: int, segment_len_s: int, overlap_s
     return samples
 
 
+def iter_cut_chunks(chunks: Iterable[np.ndarray], segment_len: int, overlap_len: int) -> Iterator[np.ndarray]:
+    """Lazy version of cut_array over a stream of chunks, keeps at most one chunk plus one segment in memory"""
+    assert segment_len > overlap_len >= 0, "overlap_len must be non-negative and smaller than segment_len"
+    step = segment_len - overlap_len
+    buffer = None
+    for chunk in chunks:
+        buffer = chunk if buffer is None else np.concatenate((buffer, chunk))
+        start = 0
+        while buffer.shape[0] - start >= segment_len:
+            yield buffer[start:start + segment_len].copy()
+            start += step
+        buffer = buffer[start:]
+
+
+def iter_segment_eeg(eeg_chunks: Iterable[np.ndarray], sample_rate: int, segment_len_s: int,
+                     overlap_s: float = 0) -> Iterator[np.ndarray]:
+    """Same windows as segment_eeg, but produced lazily from chunks of shape (signal, channels)"""
+    assert segment_len_s > 0, "segment_len_s must be a positive number"
+    assert overlap_s >= 0, "overlap_s must be a non-negative number"
+
+    sample_len = round(sample_rate * segment_len_s)
+    overlap_len = round(overlap_s * sample_rate)
+    for segment in iter_cut_chunks(eeg_chunks, sample_len, overlap_len):
+        assert segment.ndim == 2, "eeg chunks must be 2-dimensional arrays of shape (signal, channels)"
+        yield segment
+
+
 def resize_image(img: np.ndarray, width: int = None, height: int = None) -> np.ndarray:
     height = img.shape[0] if height is None else height
     width = img.shape[1] if width is None else width
@@ -52,12 +81,9 @@ def produce_wave_with_torch(spectrogram: np.ndarray, converter) -> np.ndarray:
 
 
 def produce_audio_from_wave(wave: np.ndarray, normalize: bool = True) -> AudioSegment:
-    if normalize:
-        wave = wave * np.iinfo(np.int16).max / np.max(np.abs(wave))
-    wav_bytes = BytesIO()
-    wavfile.write(wav_bytes, rate=AUDIO_SAMPLE_RATE, data=wave.astype(np.int16))
-    wav_bytes.seek(0)
-    return AudioSegment.from_wav(wav_bytes)
+    if not normalize:
+        wave = wave / np.iinfo(np.int16).max  # wave is already on the int16 scale
+    return AudioBuffer.from_wave(wave, AUDIO_SAMPLE_RATE, normalize=normalize).to_pydub()
 
 
 def postprocess_wave(wave: np.ndarray, threshold: float = ANTISPIKE_THRESHOLD) -> np.ndarray:
@@ -87,20 +113,32 @@ def save_audio_to_file(numbered_audio: tuple[int, AudioSegment],
 
 
 def combine_pydub_audio_from_queue(queue) -> AudioSegment:  # queue: torch.Queue
-    combined = queue.get()
+    first = AudioBuffer.from_pydub(queue.get())
+    writer = StreamingAudioWriter(sample_rate=first.sample_rate, n_channels=first.n_channels,
+                                  crossfade_ms=CROSSFADE_SAVE_MS)
+    writer.write(first)
     while not queue.empty():
-        combined = combined.append(queue.get(), crossfade=CROSSFADE_SAVE_MS)
-    return combined
+        writer.write(AudioBuffer.from_pydub(queue.get()))
+    return writer.close().to_pydub()
 
 
-def combine_pydub_audio_from_folder(folder_path: str) -> AudioSegment:
+def combine_audio_from_folder(folder_path: str, output_path: Optional[str] = None,
+                              crossfade_ms: float = CROSSFADE_SAVE_MS) -> Optional[AudioBuffer]:
+    """Crossfade the WAV files of a folder in name order, streamed into output_path if given"""
     audio_files = sorted(os.listdir(folder_path))
     assert len(audio_files) > 1, "No meaning in combining less than 2 files"
-    combined = AudioSegment.from_wav(os.path.join(folder_path, audio_files[0]))
-    for f in audio_files[1:]:
-        segment = AudioSegment.from_wav(os.path.join(folder_path, f))
-        combined = combined.append(segment, crossfade=CROSSFADE_SAVE_MS)
-    return combined
+    writer = None
+    for f in audio_files:
+        segment = AudioBuffer.read_wav(os.path.join(folder_path, f))
+        if writer is None:
+            writer = StreamingAudioWriter(output_path, sample_rate=segment.sample_rate,
+                                          n_channels=segment.n_channels, crossfade_ms=crossfade_ms)
+        writer.write(segment)
+    return writer.close()
+
+
+def combine_pydub_audio_from_folder(folder_path: str) -> AudioSegment:
+    return combine_audio_from_folder(folder_path).to_pydub()
 
 
 def normalize_spectrogram(s: np.ndarray) -> np.ndarray:
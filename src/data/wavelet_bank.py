@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pywt
+from scipy.fft import rfft, irfft, next_fast_len
+
+from src.constants import WAVELET_BANK_CACHE_SIZE
+from src.parameters import ChannelParameters
+
+_bank_cache = OrderedDict()
+_bank_cache_lock = threading.Lock()
+
+
+class WaveletBank:
+    """
+    Frequency-domain filters reproducing pywt.cwt(method='conv') for a fixed signal length.
+    pywt convolves with the integrated wavelet and differentiates afterwards; both steps, the scaling
+    by -sqrt(scale) and the centre cropping are folded into one kernel per scale, so a whole CWT
+    becomes rfft -> multiply -> irfft.
+    """
+
+    def __init__(self, frequencies: tuple, sample_rate: int, length: int, cwavelet: str = 'morl',
+                 precision: int = 12):
+        wavelet = pywt.ContinuousWavelet(cwavelet)
+        if wavelet.complex_cwt:
+            raise ValueError(f'WaveletBank only supports real wavelets, got {cwavelet}')
+        self.length = length
+        self.scales = pywt.frequency2scale(cwavelet, np.array(frequencies) / sample_rate)
+
+        int_psi, x = pywt.integrate_wavelet(wavelet, precision=precision)
+        step = x[1] - x[0]
+        kernels = []
+        for scale in self.scales:
+            # same integrated wavelet sampling as pywt.cwt
+            j = (np.arange(scale * (x[-1] - x[0]) + 1) / (scale * step)).astype(int)
+            j = j[j < int_psi.size]
+            int_psi_scale = int_psi[j][::-1]
+            kernel = -np.sqrt(scale) * np.diff(int_psi_scale, prepend=0, append=0)
+            # pywt keeps conv[1 + floor(d):][:length] of the full convolution, shift the kernel to match
+            shift = 1 + int(np.floor((int_psi_scale.size - 2) / 2))
+            kernels.append((kernel, shift))
+
+        self.n_fft = next_fast_len(length + max(k.size for k, _ in kernels))
+        self.filters = np.empty((len(kernels), self.n_fft // 2 + 1), dtype=np.complex128)
+        for i, (kernel, shift) in enumerate(kernels):
+            wrapped = np.zeros(self.n_fft)
+            np.add.at(wrapped, (np.arange(kernel.size) - shift) % self.n_fft, kernel)
+            self.filters[i] = rfft(wrapped)
+
+    def transform(self, wave: np.ndarray) -> np.ndarray:
+        """CWT along the last axis of wave, output has the scales prepended: (freqs, ..., time)"""
+        assert wave.shape[-1] == self.length, f"WaveletBank was built for {self.length} samples"
+        spectrum = rfft(wave, n=self.n_fft, axis=-1)
+        transformed = irfft(spectrum[..., None, :] * self.filters, n=self.n_fft, axis=-1)[..., :self.length]
+        return np.moveaxis(transformed, -2, 0)
+
+
+def get_wavelet_bank(frequencies: tuple, sample_rate: int, length: int, cwavelet: str = 'morl',
+                     max_size: int = WAVELET_BANK_CACHE_SIZE) -> WaveletBank:
+    """Least-recently-used cache of filter banks, so the design cost is only paid for new configurations"""
+    key = (frequencies, sample_rate, length, cwavelet)
+    with _bank_cache_lock:
+        bank = _bank_cache.get(key)
+        if bank is not None:
+            _bank_cache.move_to_end(key)
+            return bank
+    bank = WaveletBank(frequencies, sample_rate, length, cwavelet)
+    with _bank_cache_lock:
+        _bank_cache[key] = bank
+        while len(_bank_cache) > max_size:
+            _bank_cache.popitem(last=False)
+    return bank
+
+
+def fft_wavelet_transform(wave: np.ndarray, channel_params: ChannelParameters, cwavelet: str = 'morl') -> np.ndarray:
+    bank = get_wavelet_bank(tuple(channel_params.frequencies), channel_params.sample_rate, wave.shape[-1], cwavelet)
+    return bank.transform(wave)
+
+
+def compare_with_pywt(wave: np.ndarray, channel_params: ChannelParameters,
+                      cwavelet: str = 'morl') -> tuple[float, float]:
+    """Max absolute and max relative (to the peak magnitude) difference between both engines"""
+    scales = pywt.frequency2scale(cwavelet, channel_params.frequencies / channel_params.sample_rate)
+    expected = pywt.cwt(wave, scales=scales, wavelet=cwavelet, axis=-1)[0]
+    actual = fft_wavelet_transform(wave, channel_params, cwavelet)
+    max_abs_diff = np.max(np.abs(actual - expected))
+    return max_abs_diff, max_abs_diff / np.max(np.abs(expected))
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+    from src.constants import SAMPLE_RATE, SEGMENT_LEN_S
+
+    params = ChannelParameters()
+    wave = np.random.default_rng(0).standard_normal((2, SAMPLE_RATE * SEGMENT_LEN_S))
+    abs_diff, rel_diff = compare_with_pywt(wave, params)
+    print(f'FFT bank vs pywt.cwt | max abs diff={abs_diff:.3e}, max rel diff={rel_diff:.3e}')
+
+    scales = pywt.frequency2scale('morl', params.frequencies / params.sample_rate)
+    for name, func in (('pywt', lambda: pywt.cwt(wave, scales=scales, wavelet='morl', axis=-1)),
+                       ('fft bank', lambda: fft_wavelet_transform(wave, params))):
+        start = perf_counter()
+        for _ in range(20):
+            func()
+        print(f'{name}: {(perf_counter() - start) / 20 * 1000:.2f} ms per segment')
@@ -2,49 +2,92 @@ from transformers import AutoProcessor, MusicgenForConditionalGeneration
 import torch
 import scipy
 import os
+from src.data.model_registry import get_model
+from src.data.musicgen import MusicgenStreamer, prepare_variations, variation_path, as_description_list
+from src.data.audio_writer import StreamingAudioWriter
 USE_DIFFUSION_DECODER = False  # True: use diffusion decoder, False: use VQ-VAE decoder
 
-def generate_music_from_text(description, device=None):
+
+def load_musicgen(device):
+    """Processor and model for MusicGen small, loaded once per process and device"""
+    def loader():
+        processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
+        model = MusicgenForConditionalGeneration.from_pretrained("facebook/musicgen-small").to(device)
+        return processor, model
+    return get_model(f"musicgen-small@{device}", loader)
+
+def generate_music_from_text(description, device=None, stream=False, playback=None, n_variations=1):
     """
-    Generate music from a given text description and save it as a WAV file.
+    Generate music from text descriptions and save every clip as a WAV file.
     
     Args:
-        description (str): The text description of the music to generate.
+        description (str or list[str]): The text description(s) of the music to generate,
+            all of them run through MusicGen as one padded batch.
         device (torch.device, optional): The device to use (e.g., "cuda", "mps", "cpu").
+        stream (bool): Decode the audio in chunks while tokens are generated and append them to the
+            files as they arrive, time to first audio is reported.
+        playback (PlaybackQueue, optional): Also play the streamed chunks of the first clip as they arrive,
+            implies stream.
+        n_variations (int): Clips per description, the text is encoded only once for all of them.
+
+    Returns:
+        list[str]: Paths of the clips, description by description, its variations next to each other.
+            Named after description and variation, so the same request writes the same files.
     """
     # Set the device
     if device is None:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
-    # Load processor and model
-    processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
-    model = MusicgenForConditionalGeneration.from_pretrained("facebook/musicgen-small").to(device)
+    # Load processor and model (reused across calls)
+    processor, model = load_musicgen(device)
 
     # Prepare inputs
+    descriptions = as_description_list(description)
     inputs = processor(
-        text=[description],  # Use provided description
+        text=descriptions,  # Use provided descriptions
         padding=True,
         return_tensors="pt",
     )
     inputs = {key: value.to(device) for key, value in inputs.items()}
+    inputs = prepare_variations(inputs, n_variations, guidance_scale=3.0)  # Adjust guidance for flexibility
 
-    # Generate audio
-    audio_values = model.generate(
-        **inputs,
-        do_sample=True,
-        guidance_scale=3.0,  # Adjust for flexibility
-        max_new_tokens=512   # Adjust for output length
-    )
-    print('Saving...')
     # Get sampling rate
     sampling_rate = model.config.audio_encoder.sampling_rate
 
     # check if output directory exists
     os.makedirs('output', exist_ok=True)
-    
-    # Save the audio
-    filename = './output/final_text.wav'
-    audio_data = audio_values[0, 0].detach().cpu().numpy()  # Ensure the data is on the CPU
-    scipy.io.wavfile.write(filename, rate=sampling_rate, data=audio_data)
-    print(f"Music is saved as {filename}")
+    filenames = [variation_path('./output', 'text', d, v) for d in descriptions for v in range(n_variations)]
+
+    streamer = None
+    if stream or playback is not None:
+        # Chunks are appended to the files (and played) while generation goes on
+        writers = [StreamingAudioWriter(filename, sample_rate=sampling_rate) for filename in filenames]
+
+        def on_audio(chunks):
+            for writer, chunk in zip(writers, chunks):
+                writer.write(chunk)
+            if playback is not None:
+                playback.put(streamer.n_chunks - 1, chunks[0])
+        streamer = MusicgenStreamer(model, on_audio)
+
+    # Generate audio
+    audio_values = model.generate(
+        **inputs,
+        do_sample=True,
+        max_new_tokens=512,  # Adjust for output length
+        streamer=streamer
+    )
+    if streamer is not None:
+        for writer in writers:
+            writer.close()
+        print(f"Streaming | {streamer.report()}")
+    else:
+        print('Saving...')
+        # Save the audio
+        for filename, values in zip(filenames, audio_values):
+            audio_data = values[0].detach().cpu().numpy()  # Ensure the data is on the CPU
+            scipy.io.wavfile.write(filename, rate=sampling_rate, data=audio_data)
+    for filename in filenames:
+        print(f"Music is saved as {filename}")
+    return filenames